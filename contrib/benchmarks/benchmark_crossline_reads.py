@@ -0,0 +1,82 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""Microbenchmark of inline vs crossline reads from memory-mapped DutchF3 volumes
+
+Writes a random volume with the shape of the DutchF3 training volume to a temporary folder together with its
+crossline-major copy and times reading whole sections and single patches from both layouts. The files are
+read through the page cache, so the numbers show the cost of the strided access rather than of the disk.
+
+Example:
+    python benchmark_crossline_reads.py --shape=[401,701,255] --patch-size=99
+"""
+import tempfile
+from os import path
+
+import fire
+import numpy as np
+
+from benchmark_utils import format_table, microseconds, random_volume, time_function
+from deepseismic_interpretation.dutchf3.data import load_volume, load_xline_volume, write_xline_volume
+
+
+def _read_sections(volume, indices, strided):
+    for index in indices:
+        np.array(volume[:, index] if strided else volume[index])
+
+
+def _read_patches(volume, indices, patch_size, strided):
+    for index in indices:
+        np.array(volume[:patch_size, index, :patch_size] if strided else volume[index, :patch_size, :patch_size])
+
+
+def _throughput(seconds, num_bytes):
+    return f"{num_bytes / seconds / 2 ** 20:.0f}MB/s"
+
+
+def run(shape=(401, 701, 255), patch_size=99, reads=50, number=3, repeat=3):
+    """Print the latency of reading sections and patches along inlines and crosslines
+
+    Args:
+        shape (list[int], optional): inline x crossline x depth shape of the volume. Defaults to (401, 701, 255).
+        patch_size (int, optional): size of the patches. Defaults to 99.
+        reads (int, optional): sections or patches read per measurement. Defaults to 50.
+        number (int, optional): calls per measurement. Defaults to 3.
+        repeat (int, optional): number of measurements. Defaults to 3.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = path.join(tmp_dir, "seismic.npy")
+        np.save(filename, random_volume(shape))
+        write_xline_volume(filename)
+        volume, xline_volume = load_volume(filename), load_xline_volume(filename)
+
+        random_state = np.random.RandomState(0)
+        inlines = random_state.randint(shape[0], size=reads)
+        crosslines = random_state.randint(shape[1], size=reads)
+        # the crossline-major copy is read like the inline-major volume
+        layouts = [
+            ("inline", volume, inlines, False),
+            ("crossline", volume, crosslines, True),
+            ("crossline-major", xline_volume, crosslines, False),
+        ]
+
+        rows = []
+        for layout, layout_volume, indices, strided in layouts:
+            section = time_function(_read_sections, layout_volume, indices, strided, number=number, repeat=repeat)
+            patch = time_function(
+                _read_patches, layout_volume, indices, patch_size, strided, number=number, repeat=repeat
+            )
+            section_bytes = volume.nbytes // shape[0 if layout == "inline" else 1]
+            rows.append(
+                [
+                    layout,
+                    microseconds(section / reads),
+                    _throughput(section / reads, section_bytes),
+                    microseconds(patch / reads),
+                ]
+            )
+        del volume, xline_volume
+    print(format_table(["layout", "section", "section throughput", f"patch {patch_size}"], rows))
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -0,0 +1,59 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""Microbenchmark of the depth channel builders used by the DutchF3 patch loaders
+
+Compares the original row by row implementation of add_patch_depth_channels against the broadcast
+implementation with a cached depth ramp, for the patch sizes used in the dutchf3_patch configs.
+
+Example:
+    python benchmark_depth_channels.py --patch-sizes=[99,128,256]
+"""
+import fire
+import numpy as np
+
+from benchmark_utils import format_table, microseconds, random_volume, time_function
+from deepseismic_interpretation.dutchf3.data import add_patch_depth_channels
+
+
+def _add_patch_depth_channels_loop(image_array):
+    # Reference implementation the loaders used before the depth ramp was vectorised
+    h, w = image_array.shape
+    image = np.zeros([3, h, w])
+    image[0] = image_array
+    for row, const in enumerate(np.linspace(0, 1, h)):
+        image[1, row, :] = const
+    image[2] = image[0] * image[1]
+    return image
+
+
+def run(patch_sizes=(99, 128, 256), number=1000, repeat=5):
+    """Print the per patch latency of the depth channel builders
+
+    Args:
+        patch_sizes (list[int], optional): patch sizes to benchmark. Defaults to (99, 128, 256).
+        number (int, optional): calls per measurement. Defaults to 1000.
+        repeat (int, optional): number of measurements. Defaults to 5.
+    """
+    rows = []
+    for patch_size in patch_sizes:
+        patch = random_volume((patch_size, patch_size))
+        out = np.empty((3, patch_size, patch_size), dtype=np.float32)
+        np.testing.assert_allclose(_add_patch_depth_channels_loop(patch), add_patch_depth_channels(patch), atol=1e-6)
+
+        loop = time_function(_add_patch_depth_channels_loop, patch, number=number, repeat=repeat)
+        vectorised = time_function(add_patch_depth_channels, patch, number=number, repeat=repeat)
+        preallocated = time_function(add_patch_depth_channels, patch, out=out, number=number, repeat=repeat)
+        rows.append(
+            [
+                patch_size,
+                microseconds(loop),
+                microseconds(vectorised),
+                microseconds(preallocated),
+                f"{loop / preallocated:.1f}x",
+            ]
+        )
+    print(format_table(["patch", "loop", "vectorised", "vectorised+out", "speedup"], rows))
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
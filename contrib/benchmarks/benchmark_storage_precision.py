@@ -0,0 +1,66 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""Size and precision of the reduced precision DutchF3 volumes against the float32 originals
+
+Reads the float16 and int8 copies written by `scripts/prepare_dutchf3.py reduced_precision` for the train,
+test1 and test2 volumes and reports their size together with the error they introduce after the
+normalisation the experiments apply (TRAIN.MEAN and TRAIN.STD of the dutchf3 configs).
+
+Example:
+    python benchmark_storage_precision.py --data-dir=/mnt/dutchf3
+"""
+from os import path
+
+import fire
+import numpy as np
+
+from benchmark_utils import format_table
+from deepseismic_interpretation.dutchf3.data import load_volume, load_volume_scale, storage_path
+
+_VOLUMES = {
+    "train": path.join("train", "train_seismic.npy"),
+    "test1": path.join("test_once", "test1_seismic.npy"),
+    "test2": path.join("test_once", "test2_seismic.npy"),
+}
+
+
+def _normalised_errors(volume, stored, scale, std):
+    # accumulated per inline so that the volumes never have to fit in memory
+    squared_error, max_error = 0.0, 0.0
+    for inline, stored_inline in zip(volume, stored):
+        error = (np.multiply(stored_inline, scale, dtype=np.float64) - inline) / std
+        squared_error += float(np.sum(error ** 2))
+        max_error = max(max_error, float(np.abs(error).max()))
+    return np.sqrt(squared_error / volume.size), max_error
+
+
+def run(data_dir, std=0.20977, storages=("float16", "int8")):
+    """Print size, RMSE and maximum error of the normalised amplitudes for every stored volume
+
+    Args:
+        data_dir (str): DutchF3 data directory
+        std (float, optional): standard deviation used to normalise the amplitudes. Defaults to 0.20977.
+        storages (list[str], optional): storages to compare against float32. Defaults to (float16, int8).
+    """
+    rows = []
+    for split, filename in _VOLUMES.items():
+        filename = path.join(data_dir, filename)
+        if not path.exists(filename):
+            continue
+        volume = load_volume(filename)
+        rows.append([split, "float32", f"{volume.nbytes / 2 ** 20:.1f}MB", 0, 0, "inf"])
+        for storage in storages:
+            stored_filename = storage_path(filename, storage)
+            if not path.exists(stored_filename):
+                continue
+            stored = load_volume(stored_filename)
+            rmse, max_error = _normalised_errors(volume, stored, load_volume_scale(stored_filename), std)
+            snr = 20 * np.log10(np.std(volume) / std / rmse) if rmse > 0 else np.inf
+            rows.append(
+                [split, storage, f"{stored.nbytes / 2 ** 20:.1f}MB", f"{rmse:.2e}", f"{max_error:.2e}", f"{snr:.1f}dB"]
+            )
+    print(format_table(["volume", "storage", "size", "rmse", "max error", "snr"], rows))
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
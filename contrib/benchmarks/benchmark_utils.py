@@ -0,0 +1,50 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import timeit
+
+import numpy as np
+
+
+def time_function(func, *args, number=100, repeat=5, **kwargs):
+    """Time a function call
+
+    Args:
+        func (callable): function to time
+        *args: positional arguments passed to func
+        number (int, optional): calls per measurement. Defaults to 100.
+        repeat (int, optional): number of measurements. Defaults to 5.
+        **kwargs: keyword arguments passed to func
+
+    Returns:
+        float: best time per call in seconds over all measurements
+    """
+    timer = timeit.Timer(lambda: func(*args, **kwargs))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def format_table(header, rows):
+    """Format benchmark results as a plain text table
+
+    Args:
+        header (list[str]): column names
+        rows (list[list]): one list of values per row
+
+    Returns:
+        str: the table
+    """
+    rows = [[str(v) for v in row] for row in rows]
+    widths = [max(len(str(h)), *(len(row[i]) for row in rows)) for i, h in enumerate(header)]
+    lines = ["  ".join(str(h).rjust(w) for h, w in zip(header, widths))]
+    lines.extend("  ".join(v.rjust(w) for v, w in zip(row, widths)) for row in rows)
+    return "\n".join(lines)
+
+
+def microseconds(seconds):
+    return f"{seconds * 1e6:.1f}us"
+
+
+def random_volume(shape, dtype=np.float32, seed=0):
+    """Random normally distributed amplitudes standing in for a seismic volume
+    """
+    return np.random.RandomState(seed).randn(*shape).astype(dtype)
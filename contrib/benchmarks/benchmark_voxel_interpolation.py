@@ -0,0 +1,77 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""Throughput of the interpolation backends used to cut augmented voxels out of a seismic cube
+
+Builds a class balanced batch worth of augmented grids around random centres of a synthetic cube with the shape
+of the DutchF3 training volume and times interpolating them one grid at a time with trilinear_interpolation, with
+the numpy batch backend and with the torch grid_sample backend for every number of torch threads given.
+
+Example:
+    python benchmark_voxel_interpolation.py --shape=[401,701,255] --batch-size=32 --threads=[1,4]
+"""
+import fire
+import numpy as np
+import torch
+
+from benchmark_utils import format_table, random_volume, time_function
+from deepseismic_interpretation.dutchf3.utils.batch import (
+    affine_grids,
+    augmentation_matrix,
+    trilinear_interpolation,
+    trilinear_interpolation_batch,
+    trilinear_interpolation_torch,
+)
+
+
+def _interpolate_one_by_one(cube, grids):
+    return np.stack([trilinear_interpolation(cube, grid) for grid in grids])
+
+
+def _throughput(seconds, num_voxels):
+    return f"{num_voxels / seconds / 1e6:.1f}M voxels/s"
+
+
+def run(shape=(401, 701, 255), window_size=65, batch_size=32, threads=None, number=1, repeat=3):
+    """Print the time per batch and the voxel throughput of every interpolation backend
+
+    Args:
+        shape (list[int], optional): inline x crossline x depth shape of the cube. Defaults to (401, 701, 255).
+        window_size (int, optional): size of the voxels. Defaults to 65.
+        batch_size (int, optional): number of voxels per batch. Defaults to 32.
+        threads (list[int], optional): torch threads to time the torch backend with. Defaults to all of them.
+        number (int, optional): calls per measurement. Defaults to 1.
+        repeat (int, optional): number of measurements. Defaults to 3.
+    """
+    threads = threads if threads else [torch.get_num_threads()]
+    cube = random_volume(shape)
+
+    np.random.seed(0)
+    im_size = [window_size] * 3
+    matrices = np.stack([augmentation_matrix(True, 0.2, 180, 15) for _ in range(batch_size)])
+    # centres far enough from the sides for the stretched and rotated voxels to stay inside the cube
+    margin = np.minimum(window_size, np.array(shape) // 2 - 1)
+    offsets = np.random.uniform(margin, np.array(shape) - margin, size=(batch_size, 3))
+    grids = affine_grids(im_size, matrices, offsets)
+    num_voxels = grids.shape[0] * grids.shape[2]
+
+    backends = [
+        ("numpy one by one", _interpolate_one_by_one),
+        ("numpy batch", trilinear_interpolation_batch),
+    ]
+    rows = []
+    for name, interpolate in backends:
+        seconds = time_function(interpolate, cube, grids, number=number, repeat=repeat)
+        rows.append([name, 1, f"{seconds:.3f}s", _throughput(seconds, num_voxels)])
+
+    num_threads = torch.get_num_threads()
+    for num in threads:
+        torch.set_num_threads(num)
+        seconds = time_function(trilinear_interpolation_torch, cube, grids, number=number, repeat=repeat)
+        rows.append(["torch grid_sample", num, f"{seconds:.3f}s", _throughput(seconds, num_voxels)])
+    torch.set_num_threads(num_threads)
+
+    print(format_table(["backend", "threads", "batch", "throughput"], rows))
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
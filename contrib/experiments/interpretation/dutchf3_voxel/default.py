@@ -51,6 +51,8 @@ _C.TRAIN.LR = 0.01
 _C.TRAIN.MOMENTUM = 0.9
 _C.TRAIN.WEIGHT_DECAY = 0.0001
 _C.TRAIN.DEPTH = "voxel"  # Options are None, Patch and Section
+# interpolation of the augmented voxels, numpy or torch (grid_sample on all torch threads, best with WORKERS=0)
+_C.TRAIN.INTERPOLATION = "numpy"
 _C.TRAIN.MODEL_DIR = "models"  # This will be a subdirectory inside OUTPUT_DIR
 
 # validation
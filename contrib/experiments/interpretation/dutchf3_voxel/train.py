@@ -50,15 +50,16 @@ from default import update_config
 
 def _prepare_batch(batch, device=None, non_blocking=False, t_type=torch.FloatTensor):
     x, y = batch
-    new_x = convert_tensor(torch.squeeze(x, 1), device=device, non_blocking=non_blocking)
-    new_y = convert_tensor(torch.unsqueeze(y, 2), device=device, non_blocking=non_blocking)
+    # the loader yields whole batches, Bx1xDxHxW voxels and one label per voxel
+    new_x = convert_tensor(x, device=device, non_blocking=non_blocking)
+    new_y = convert_tensor(y.view(-1, 1, 1, 1), device=device, non_blocking=non_blocking)
     if device == "cuda":
         return (
             new_x.type(t_type).cuda(),
-            torch.unsqueeze(new_y, 3).type(torch.LongTensor).cuda(),
+            new_y.type(torch.LongTensor).cuda(),
         )
     else:
-        return new_x.type(t_type), torch.unsqueeze(new_y, 3).type(torch.LongTensor)
+        return new_x.type(t_type), new_y.type(torch.LongTensor)
 
 
 def run(*options, cfg=None):
@@ -97,28 +98,27 @@ def run(*options, cfg=None):
         config.DATASET.FILENAME,
         split="train",
         window_size=config.WINDOW_SIZE,
-        len=config.TRAIN.BATCH_SIZE_PER_GPU * config.TRAIN.BATCH_PER_EPOCH,
+        len=config.TRAIN.BATCH_PER_EPOCH,
         batch_size=config.TRAIN.BATCH_SIZE_PER_GPU,
+        interpolation=config.TRAIN.INTERPOLATION,
     )
     val_set = TrainVoxelLoader(
         config.DATASET.ROOT,
         config.DATASET.FILENAME,
         split="val",
         window_size=config.WINDOW_SIZE,
-        len=config.TRAIN.BATCH_SIZE_PER_GPU * config.TRAIN.BATCH_PER_EPOCH,
-        batch_size=config.TRAIN.BATCH_SIZE_PER_GPU,
+        len=config.TRAIN.BATCH_PER_EPOCH,
+        batch_size=config.VALIDATION.BATCH_SIZE_PER_GPU,
+        interpolation=config.TRAIN.INTERPOLATION,
     )
 
     n_classes = train_set.n_classes
 
-    # set dataset length to batch size to be consistent with 5000 iterations
+    # set dataset length to the number of batches to be consistent with 5000 iterations
     # each of size 32 in the original Waldeland implementation
-    train_loader = data.DataLoader(
-        train_set, batch_size=config.TRAIN.BATCH_SIZE_PER_GPU, num_workers=config.WORKERS, shuffle=False,
-    )
-    val_loader = data.DataLoader(
-        val_set, batch_size=config.VALIDATION.BATCH_SIZE_PER_GPU, num_workers=config.WORKERS, shuffle=False,
-    )
+    # the datasets build whole batches, so the loaders don't collate
+    train_loader = data.DataLoader(train_set, batch_size=None, num_workers=config.WORKERS, shuffle=False)
+    val_loader = data.DataLoader(val_set, batch_size=None, num_workers=config.WORKERS, shuffle=False)
 
     # this is how we import model for CV - here we're importing a seismic
     # segmentation model
@@ -10,14 +10,19 @@ import segyio
 from os import listdir
 import numpy as np
 import scipy.misc
+from cv_lib.utils import peak_memory
 
 
-def read_segy(filename):
+def read_segy(filename, out_filename=None):
     """
     Read in a SEGY-format file given a filename
 
+    The traces are streamed one line at a time straight into a preallocated array with the temporal axis first,
+    so reading a cube takes about as much memory as the cube itself.
+
     Args:
         filename: input filename
+        out_filename: .npy file to stream the cube into and return memory-mapped, None to keep it in memory
 
     Returns:
         numpy data array and its info as a dictionary (tuple)
@@ -25,42 +30,72 @@ def read_segy(filename):
     """
     print("Loading data cube from", filename, "with:")
 
-    # Read full data cube
-    data = segyio.tools.cube(filename)
-
-    # Put temporal axis first
-    data = np.moveaxis(data, -1, 0)
-
-    # Make data cube fast to access
-    data = np.ascontiguousarray(data, "float32")
+    with segyio.open(filename, "r") as segyfile:
+        if len(segyfile.offsets) != 1:
+            raise ValueError("Only post-stack segy files are supported, {} has several offsets".format(filename))
+
+        # traces are stored line by line along the fast dimension, like segyio.tools.cube lays them out
+        if segyfile.sorting == segyio.TraceSortingFormat.INLINE_SORTING:
+            n_fast, n_slow = len(segyfile.ilines), len(segyfile.xlines)
+        else:
+            n_fast, n_slow = len(segyfile.xlines), len(segyfile.ilines)
+        shape = (len(segyfile.samples), n_fast, n_slow)
+
+        print("  Crosslines: ", segyfile.xlines[0], ":", segyfile.xlines[-1])
+        print("  Inlines:    ", segyfile.ilines[0], ":", segyfile.ilines[-1])
+        print("  Timeslices: ", "1", ":", shape[0])
+
+        # Put temporal axis first
+        if out_filename is None:
+            data = np.empty(shape, dtype=np.float32)
+        else:
+            data = np.lib.format.open_memmap(out_filename, mode="w+", dtype=np.float32, shape=shape)
+        progress_step = max(int(np.ceil(n_fast / 10)), 1)
+        for line in range(n_fast):
+            data[:, line, :] = segyfile.trace.raw[line * n_slow : (line + 1) * n_slow].T
+            if (line + 1) % progress_step == 0 or line + 1 == n_fast:
+                print("  Read {} of {} lines".format(line + 1, n_fast))
+
+        # Make dict with cube-info
+        # TODO: read this from segy
+        # Read dt and other params needed to do create a new
+        data_info = {
+            "crossline_start": segyfile.xlines[0],
+            "inline_start": segyfile.ilines[0],
+            "timeslice_start": 1,
+            "shape": data.shape,
+        }
+
+    if out_filename is not None:
+        data.flush()
+    memory = peak_memory()
+    if memory is not None:
+        print("  Peak memory: {:.2f} GB".format(memory / 2 ** 30))
 
-    # Read meta data
-    segyfile = segyio.open(filename, "r")
-    print("  Crosslines: ", segyfile.xlines[0], ":", segyfile.xlines[-1])
-    print("  Inlines:    ", segyfile.ilines[0], ":", segyfile.ilines[-1])
-    print("  Timeslices: ", "1", ":", data.shape[0])
+    return data, data_info
 
-    # Make dict with cube-info
-    # TODO: read this from segy
-    # Read dt and other params needed to do create a new
-    data_info = {
-        "crossline_start": segyfile.xlines[0],
-        "inline_start": segyfile.ilines[0],
-        "timeslice_start": 1,
-        "shape": data.shape,
-    }
 
-    return data, data_info
+def _line_chunks(out_cube, lines_per_chunk=16):
+    # cubes are handed out a few lines at a time so memory-mapped ones are never read in full
+    if not isinstance(out_cube, np.ndarray):
+        return out_cube
+    return (out_cube[:, start : start + lines_per_chunk] for start in range(0, out_cube.shape[1], lines_per_chunk))
 
 
 def write_segy(out_filename, in_filename, out_cube):
     """
     Writes out_cube to a segy-file (out_filename) with same header/size as in_filename
 
+    Only the headers are cloned from in_filename, the traces and their headers are streamed into the new file chunk
+    by chunk. So the cube can be memory-mapped or even be scored while it's being written, without ever holding it
+    in memory.
+
     Args:
-        out_filename:
-        in_filename:
-        out_cube:
+        out_filename: segy file to write
+        in_filename: segy file with the headers and the geometry of the cube
+        out_cube: cube with the temporal axis first, like read_segy returns it, or an iterator over chunks of it -
+            depth x lines x traces arrays with the next lines of the cube along the second axis. Of a list of cubes
+            the last one is written.
 
     Returns:
 
@@ -70,26 +105,30 @@ def write_segy(out_filename, in_filename, out_cube):
         out_cube = out_cube[-1]
 
     print("Writing interpretation to " + out_filename)
-    # Copy segy file
-    from shutil import copyfile
-
-    copyfile(in_filename, out_filename)
-
-    # Moving temporal axis back again
-    out_cube = np.moveaxis(out_cube, 0, -1)
-
-    # Open out-file
-    with segyio.open(out_filename, "r+") as src:
-        iline_start = src.ilines[0]
-        dtype = src.iline[iline_start].dtype
-        # loop through inlines and insert output
-        for i in src.ilines:
-            iline = out_cube[i - iline_start, :, :]
-            src.iline[i] = np.ascontiguousarray(iline.astype(dtype))
-
-    # TODO: rewrite this whole function
-    # Moving temporal axis first again - just in case the user want to keep working on it
-    out_cube = np.moveaxis(out_cube, -1, 0)
+    with segyio.open(in_filename, "r") as src:
+        spec = segyio.tools.metadata(src)
+        with segyio.create(out_filename, spec) as dst:
+            for i in range(1 + spec.ext_headers):
+                dst.text[i] = src.text[i]
+            dst.bin = src.bin
+
+            # traces are stored line by line along the fast dimension, in the order of the lines of the cube
+            trace = 0
+            for chunk in _line_chunks(out_cube):
+                # lines x traces x samples, converted to the data type of the file a chunk at a time
+                traces = np.ascontiguousarray(np.moveaxis(chunk, 0, -1), dtype=dst.dtype)
+                traces = traces.reshape(-1, traces.shape[-1])
+                if trace + len(traces) > src.tracecount:
+                    raise ValueError("The cube has more traces than the {} of {}".format(src.tracecount, in_filename))
+                dst.trace[trace : trace + len(traces)] = traces
+                # the headers of the same traces, cloned a chunk at a time too
+                dst.header[trace : trace + len(traces)] = src.header[trace : trace + len(traces)]
+                trace += len(traces)
+
+            if trace != src.tracecount:
+                raise ValueError(
+                    "The cube has {} traces for the {} traces of {}".format(trace, src.tracecount, in_filename)
+                )
 
     print("Writing interpretation - Finished")
     return
@@ -101,6 +140,52 @@ crossline_alias = ["crossline", "cross-line", "xline", "x"]
 timeslice_alias = ["timeslice", "time-slice", "t", "z", "depthslice", "depth"]
 
 
+class VoxelCoordinates(object):
+    """Centres of the voxels at least window away from the sides of a cube, worked out from a flat index
+
+    Indexes like the list(itertools.product(x_list, y_list, z_list)) of the centres did, in the same order, but
+    nothing is stored: memory is constant and creating it is instant whatever the size of the cube.
+
+    Args:
+        shape: shape of the cube
+        window: distance of the centres from the sides of the cube
+        start (int, optional): first flat index covered. Defaults to 0.
+        stop (int, optional): flat index after the last one covered. Defaults to covering all of them.
+    """
+
+    def __init__(self, shape, window, start=0, stop=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.window = window
+        self.extents = tuple(max(n - 2 * window, 0) for n in self.shape)
+        n_voxels = self.extents[0] * self.extents[1] * self.extents[2]
+        self.start = start
+        self.stop = n_voxels if stop is None else min(stop, n_voxels)
+
+    def __len__(self):
+        return max(self.stop - self.start, 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Only contiguous ranges of voxel coordinates are supported")
+            return VoxelCoordinates(self.shape, self.window, self.start + start, self.start + max(start, stop))
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Voxel index {} out of range for {} voxels".format(index, len(self)))
+        x, yz = divmod(self.start + int(index), self.extents[1] * self.extents[2])
+        y, z = divmod(yz, self.extents[2])
+        return x + self.window, y + self.window, z + self.window
+
+    def shard(self, rank, world_size):
+        """Contiguous part of the coordinates for one of world_size processes, split like np.array_split"""
+        size, remainder = divmod(len(self), world_size)
+        start = rank * size + min(rank, remainder)
+        return self[start : start + size + (1 if rank < remainder else 0)]
+
+
 def read_labels(fname, data_info):
     """
     Read labels from an image.
@@ -145,19 +230,17 @@ def read_labels(fname, data_info):
     # Get coordinates for slice
     coords = get_coordinates_for_slice(slice_type, slice_no, data_info)
 
-    # Loop through labels in label_img and append to label_coordinates
-    for cls in np.unique(label_img):
-        if cls > -1:
-            if str(cls) not in label_coordinates.keys():
-                label_coordinates[str(cls)] = np.array(np.zeros([3, 0]))
-            inds_with_cls = label_img == cls
-            cords_with_cls = coords[:, inds_with_cls.ravel()]
-            label_coordinates[str(cls)] = np.concatenate((label_coordinates[str(cls)], cords_with_cls), 1)
-            print(
-                " ", str(np.sum(inds_with_cls)), "labels for class", str(cls),
-            )
-    if len(np.unique(label_img)) == 1:
-        print(" ", 0, "labels", str(cls))
+    # Group the coordinates of the labelled pixels by class in one pass, in the order of the pixels
+    labels = label_img.ravel()
+    labelled = labels > -1
+    order = np.argsort(labels[labelled], kind="stable")
+    classes, counts = np.unique(labels[labelled], return_counts=True)
+    cords_by_cls = np.split(coords[:, labelled][:, order], np.cumsum(counts)[:-1], axis=1)
+    for cls, count, cords_with_cls in zip(classes, counts, cords_by_cls):
+        label_coordinates[str(cls)] = cords_with_cls
+        print(" ", str(count), "labels for class", str(cls))
+    if len(classes) == 0:
+        print(" ", 0, "labels")
 
     # Add label_img to output
     label_imgs.append([label_img, slice_type, slice_no])
@@ -258,39 +341,19 @@ def get_coordinates_for_slice(slice_type, slice_no, data_info):
     """
     ds = data_info["shape"]
 
-    # Coordinates for cube
-    x0, x1, x2 = np.meshgrid(
-        np.linspace(0, ds[0] - 1, ds[0]),
-        np.linspace(0, ds[1] - 1, ds[1]),
-        np.linspace(0, ds[2] - 1, ds[2]),
-        indexing="ij",
-    )
-    if slice_type == "inline":
-        start = data_info["inline_start"]
-        slice_no = slice_no - start
+    # Coordinates along every axis of the cube
+    axes = [np.arange(n, dtype=np.float64) for n in ds]
 
-        x0 = x0[:, slice_no, :]
-        x1 = x1[:, slice_no, :]
-        x2 = x2[:, slice_no, :]
+    # Fix the axis of the slice so that only the plane of the slice is built, not the whole cube
+    if slice_type == "inline":
+        axes[1] = axes[1][[slice_no - data_info["inline_start"]]]
     elif slice_type == "crossline":
-        start = data_info["crossline_start"]
-        slice_no = slice_no - start
-        x0 = x0[:, :, slice_no]
-        x1 = x1[:, :, slice_no]
-        x2 = x2[:, :, slice_no]
-
+        axes[2] = axes[2][[slice_no - data_info["crossline_start"]]]
     elif slice_type == "timeslice":
-        start = data_info["timeslice_start"]
-        slice_no = slice_no - start
-        x0 = x0[slice_no, :, :]
-        x1 = x1[slice_no, :, :]
-        x2 = x2[slice_no, :, :]
+        axes[0] = axes[0][[slice_no - data_info["timeslice_start"]]]
 
     # Collect indexes
-    x0 = np.expand_dims(x0.ravel(), 0)
-    x1 = np.expand_dims(x1.ravel(), 0)
-    x2 = np.expand_dims(x2.ravel(), 0)
-    coords = np.concatenate((x0, x1, x2), axis=0)
+    coords = np.stack([x.ravel() for x in np.meshgrid(*axes, indexing="ij")])
 
     return coords
 
@@ -19,7 +19,6 @@ IM_SIZE = 65
 
 import random
 import argparse
-import json
 
 import torch
 import torch.nn as nn
@@ -30,16 +29,13 @@ import torch.distributed as dist
 if torch.cuda.is_available():
     device_str = os.environ["CUDA_VISIBLE_DEVICES"]
     device = torch.device("cuda:" + device_str)
-else:
-    raise Exception("No GPU detected for parallel scoring!")
 
 # ability to perform multiprocessing
 import multiprocessing
 
 from os.path import join
-from data import read_segy, get_slice
+from data import read_segy, get_slice, VoxelCoordinates
 from texture_net import TextureNet
-import itertools
 import numpy as np
 import tb_logger
 from data import write_segy
@@ -72,7 +68,6 @@ class MyDataset(Dataset):
 
     def __getitem__(self, index):
 
-        # TODO: can we specify a pixel mathematically by index?
         pixel = self.coord_list[index]
         x, y, z = pixel
         # TODO: current bottleneck - can we slice out voxels any faster
@@ -88,6 +83,29 @@ class MyDataset(Dataset):
         return self.len
 
 
+def score_dense(network, data, window, args):
+    """
+    Score a contiguous range of inline slices with TextureNet.dense_scores instead of voxel by voxel
+
+    :param network: trained TextureNet on the device of the worker.
+    :param data: 3D cube.
+    :param window: half window size.
+    :param args: various arguments for the code in the worker.
+    :return: nothing, the predictions are written to the shared predictions cube
+    """
+    # only the inlines with a full window around them get scores
+    inlines = np.array_split(np.arange(window, max(data.shape[0] - window, window)), args.world_size)[args.rank]
+    if args.debug:
+        inlines = inlines[:1]
+
+    classified_cube = np.load(args.predictions, mmap_mode="r+")
+    inside = (slice(window, data.shape[1] - window), slice(window, data.shape[2] - window))
+    for inline in tqdm(inlines):
+        scores = network.dense_scores(data, axis=0, index=int(inline), window=IM_SIZE)
+        classified_cube[(int(inline),) + inside] = scores[:, 0].argmax(axis=0)[inside]
+    classified_cube.flush()
+
+
 def main_worker(gpu, ngpus_per_node, args):
     """
     Main worker function, given the gpu parameter and how many GPUs there are per node
@@ -103,9 +121,6 @@ def main_worker(gpu, ngpus_per_node, args):
 
     args.rank = gpu
 
-    # loop around in round-robin fashion if we want to run multiple processes per GPU
-    args.gpu = gpu % ngpus_per_node
-
     # initialize the distributed process and join the group
     print(
         "setting rank", args.rank, "world size", args.world_size, args.dist_backend, args.dist_url,
@@ -114,28 +129,34 @@ def main_worker(gpu, ngpus_per_node, args):
         backend=args.dist_backend, init_method=args.dist_url, world_size=args.world_size, rank=args.rank,
     )
 
-    # set default GPU device for this worker
-    torch.cuda.set_device(args.gpu)
-    # set up device for the rest of the code
-    local_device = torch.device("cuda:" + str(args.gpu))
+    if ngpus_per_node:
+        # loop around in round-robin fashion if we want to run multiple processes per GPU
+        args.gpu = gpu % ngpus_per_node
+        # set default GPU device for this worker
+        torch.cuda.set_device(args.gpu)
+        # set up device for the rest of the code
+        local_device = torch.device("cuda:" + str(args.gpu))
+    else:
+        # scoring on CPU with the gloo backend
+        local_device = torch.device("cpu")
 
     # Load trained model (run train.py to create trained
     network = TextureNet(n_classes=N_CLASSES)
     model_state_dict = torch.load(join(args.data, "saved_model.pt"), map_location=local_device)
     network.load_state_dict(model_state_dict)
     network.eval()
-    network.cuda(args.gpu)
+    network.to(local_device)
 
     # set the scoring wrapper also to eval mode
     model = ModelWrapper(network)
     model.eval()
-    model.cuda(args.gpu)
+    model.to(local_device)
 
     # When using a single GPU per process and per
     # DistributedDataParallel, we need to divide the batch size
     # ourselves based on the total number of GPUs we have.
     # Min batch size is 1
-    args.batch_size = max(int(args.batch_size / ngpus_per_node), 1)
+    args.batch_size = max(int(args.batch_size / max(ngpus_per_node, 1)), 1)
     # obsolete: number of data loading workers - this is only used when reading from disk, which we're not
     # args.workers = int((args.workers + ngpus_per_node - 1) / ngpus_per_node)
 
@@ -157,21 +178,13 @@ def main_worker(gpu, ngpus_per_node, args):
     if args.debug:
         data = data[0 : 3 * window]
 
-    # generate full list of coordinates
-    # memory footprint of this isn't large yet, so not need to wrap as a generator
-    nx, ny, nz = data.shape
-    x_list = range(window, nx - window)
-    y_list = range(window, ny - window)
-    z_list = range(window, nz - window)
-
-    print("-- generating coord list --")
-    # TODO: is there any way to use a generator with pyTorch data loader?
-    coord_list = list(itertools.product(x_list, y_list, z_list))
+    if args.dense:
+        score_dense(network, data, window, args)
+        return
 
+    # coordinates of the full cube, computed from the index rather than stored
     # we need to map the data manually to each rank - DistributedDataParallel doesn't do this at score time
-    print("take a subset of coord_list by chunk")
-    coord_list = list(np.array_split(np.array(coord_list), args.world_size)[args.rank])
-    coord_list = [tuple(x) for x in coord_list]
+    coord_list = VoxelCoordinates(data.shape, window).shard(args.rank, args.world_size)
 
     # we only score first batch in debug mode
     if args.debug:
@@ -180,7 +193,7 @@ def main_worker(gpu, ngpus_per_node, args):
     # prepare the data
     print("setup dataset")
     # TODO: RuntimeError: cannot pin 'torch.cuda.FloatTensor' only dense CPU tensors can be pinned
-    data_torch = torch.cuda.FloatTensor(data).cuda(args.gpu, non_blocking=True)
+    data_torch = torch.from_numpy(data).to(local_device, non_blocking=True)
     dataset = MyDataset(data_torch, window, coord_list)
 
     # not sampling like in training
@@ -202,46 +215,22 @@ def main_worker(gpu, ngpus_per_node, args):
 
     print("running loop")
 
-    pixels_x = []
-    pixels_y = []
-    pixels_z = []
-    predictions = []
+    # every rank writes its predictions straight into the shared cube, the shards don't overlap
+    classified_cube = np.load(args.predictions, mmap_mode="r+")
 
     # Loop through center pixels in output cube
     with torch.no_grad():
         print("no grad")
         for (chunk, pixel) in tqdm(my_loader):
-            data_input = chunk.cuda(args.gpu, non_blocking=True)
+            data_input = chunk.to(local_device, non_blocking=True)
             output = model(data_input)
-            # save and deal with it later on CPU
-            # we want to make sure order is preserved
-            pixels_x += pixel[0].tolist()
-            pixels_y += pixel[1].tolist()
-            pixels_z += pixel[2].tolist()
-            predictions += output.tolist()
+            classified_cube[pixel[0].numpy(), pixel[1].numpy(), pixel[2].numpy()] = output.view(-1).cpu().numpy()
             # just score a single batch in debug mode
             if args.debug:
                 break
 
-    # TODO: legacy Queue Manager code from multiprocessing which we left here for illustration purposes
-    # result_queue.append([deepcopy(coord_list), deepcopy(predictions)])
-    # result_queue.append([coord_list, predictions])
-    # transform pixels into x, y, z list format
-    with open("results_{}.json".format(args.rank), "w") as f:
-        json.dump(
-            {
-                "pixels_x": pixels_x,
-                "pixels_y": pixels_y,
-                "pixels_z": pixels_z,
-                "preds": [int(x[0][0][0][0]) for x in predictions],
-            },
-            f,
-        )
-
-    # TODO: we cannot use pickle to dump from multiprocess - processes lock up
-    # with open("result_predictions_{}.pkl".format(args.rank), "wb") as f:
-    #    print ("dumping predictions pickle file")
-    #    pickle.dump(predictions, f)
+    # make sure the predictions are on disk before the parent process reads them
+    classified_cube.flush()
 
 
 parser = argparse.ArgumentParser(description="Seismic Distributed Scoring")
@@ -261,16 +250,31 @@ parser.add_argument(
     "-b", "--batch-size", default=2 ** 11, type=int, help="batch size which we use for scoring",
 )
 parser.add_argument(
-    "-p", "--n-proc-per-gpu", default=1, type=int, help="number of multiple processes to run per each GPU",
+    "-p",
+    "--n-proc-per-gpu",
+    default=1,
+    type=int,
+    help="number of multiple processes to run per each GPU, or in total on CPU",
 )
 parser.add_argument(
     "--dist-url", default="tcp://127.0.0.1:12345", type=str, help="url used to set up distributed training",
 )
-parser.add_argument("--dist-backend", default="nccl", type=str, help="distributed backend")
+parser.add_argument(
+    "--dist-backend", default="nccl", type=str, help="distributed backend, gloo scores on CPU when there is no GPU"
+)
+parser.add_argument(
+    "--predictions",
+    default="predictions.npy",
+    type=str,
+    help="memory-mapped cube the processes write their predictions to",
+)
 parser.add_argument("--seed", default=0, type=int, help="default random number seed")
 parser.add_argument(
     "--debug", action="store_true", help="debug flag - if on we will only process one batch",
 )
+parser.add_argument(
+    "--dense", action="store_true", help="score whole inline slices at once rather than voxel by voxel",
+)
 
 
 def main():
@@ -284,8 +288,13 @@ def main():
     args.gpu = None
     args.rank = 0
 
+    ngpus_per_node = torch.cuda.device_count()
+    print("nGPUs per node", ngpus_per_node)
+    if not ngpus_per_node and args.dist_backend != "gloo":
+        raise Exception("No GPU detected for parallel scoring! Use --dist-backend=gloo to score on CPU")
+
     # world size is the total number of processes we want to run across all nodes and GPUs
-    args.world_size = N_GPU * args.n_proc_per_gpu
+    args.world_size = N_GPU * args.n_proc_per_gpu if ngpus_per_node else args.n_proc_per_gpu
 
     if args.debug:
         args.batch_size = 4
@@ -297,11 +306,23 @@ def main():
 
     print("RESOLUTION {}".format(RESOLUTION))
 
-    ##########################################################################
-    print("-- scoring on GPU --")
+    # Read 3D cube
+    data, data_info = read_segy(join(args.data, "data.segy"))
 
-    ngpus_per_node = torch.cuda.device_count()
-    print("nGPUs per node", ngpus_per_node)
+    # Log to tensorboard - input slice
+    logger = tb_logger.TBLogger("log", "Test")
+    logger.log_images(
+        args.slice + "_" + str(args.slice_num), get_slice(data, data_info, args.slice, args.slice_num), cm="gray",
+    )
+
+    # shared output cube, the processes write their predictions straight into it on disk
+    classified_cube = np.lib.format.open_memmap(args.predictions, mode="w+", dtype=np.uint8, shape=data.shape)
+    del classified_cube
+    # every process reads its own copy of the cube, the parent doesn't need to hold on to one while they run
+    del data
+
+    ##########################################################################
+    print("-- scoring on {} --".format("GPU" if ngpus_per_node else "CPU"))
 
     """
     First, read this: https://thelaziestprogrammer.com/python/a-multiprocessing-pool-pickle
@@ -332,8 +353,10 @@ def main():
     
     Turns out that for the reasons mentioned in the first article both approaches are too costly.
     
-    The only reasonable way to deserialize data from a Python process is to write it to text, in which case
-    writing to JSON is a saner approach: https://www.datacamp.com/community/tutorials/pickle-python-tutorial
+    Writing the results to text (JSON) and concatenating them back in the parent works, but serializing millions
+    of coordinates is slow and takes a lot of disk. So instead every process opens the same memory-mapped uint8
+    cube and writes its predictions into it directly - the coordinates of the processes don't overlap, so no
+    locking is needed and there's nothing left to gather once they're done.
     """
 
     # invoke processes manually suppressing error queue
@@ -351,61 +374,18 @@ def main():
     for process in processes:
         process.join()
 
-    print("-- aggregating results --")
-
-    # Read 3D cube
-    data, data_info = read_segy(join(args.data, "data.segy"))
-
-    # Log to tensorboard - input slice
-    logger = tb_logger.TBLogger("log", "Test")
-    logger.log_images(
-        args.slice + "_" + str(args.slice_num), get_slice(data, data_info, args.slice, args.slice_num), cm="gray",
-    )
-
-    x_coords = []
-    y_coords = []
-    z_coords = []
-    predictions = []
-    for i in range(args.world_size):
-        with open("results_{}.json".format(i), "r") as f:
-            results_dict = json.load(f)
-
-        x_coords += results_dict["pixels_x"]
-        y_coords += results_dict["pixels_y"]
-        z_coords += results_dict["pixels_z"]
-        predictions += results_dict["preds"]
+    # the predictions of a process that died are missing from the cube, don't write it out as if it was complete
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise Exception(
+            "Scoring processes {} failed with exit codes {}, {} is incomplete".format(
+                failed, [processes[rank].exitcode for rank in failed], args.predictions
+            )
+        )
 
-    """
-    So because of Python's GIL having multiple workers write to the same array is not efficient - basically
-    the only way we can have shared memory is with threading but thanks to GIL only one thread can execute at a time, 
-    so we end up with the overhead of managing multiple threads when writes happen sequentially.
-    
-    A much faster alternative is to just invoke underlying compiled code (C) through the use of array indexing.
-    
-    So basically instead of the following:
-    
-    NUM_CORES = multiprocessing.cpu_count()
-    print("Post-processing will run on {} CPU cores on your machine.".format(NUM_CORES))
-    
-    def worker(classified_cube, coord):
-        x, y, z = coord
-        ind = new_coord_list.index(coord)
-        # print (coord, ind)
-        pred_class = predictions[ind]
-        classified_cube[x, y, z] = pred_class
-
-    # launch workers in parallel with memory sharing ("threading" backend)
-    _ = Parallel(n_jobs=4*NUM_CORES, backend="threading")(
-        delayed(worker)(classified_cube, coord) for coord in tqdm(pixels)
-    )
-    
-    We do this:
-    """
+    print("-- aggregating results --")
 
-    # placeholder for results
-    classified_cube = np.zeros(data.shape)
-    # store final results
-    classified_cube[x_coords, y_coords, z_coords] = predictions
+    classified_cube = np.load(args.predictions, mmap_mode="r")
 
     print("-- writing segy --")
     in_file = join(args.data, "data.segy".format(RESOLUTION))
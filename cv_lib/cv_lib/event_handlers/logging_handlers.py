@@ -7,6 +7,8 @@ from toolz import curry
 
 import numpy as np
 
+from cv_lib.utils import child_pids, process_memory
+
 np.set_printoptions(precision=3)
 
 
@@ -44,6 +46,28 @@ def log_class_metrics(log_msg, engine, metrics_dict):
     logger.info(f"{log_msg} - Epoch {engine.state.epoch} [{engine.state.max_epochs}]\n" + metrics_msg)
 
 
+def _to_mb(num_bytes):
+    return "n/a" if num_bytes is None else f"{num_bytes / 2 ** 20:.0f}MB"
+
+
+@curry
+def log_process_memory(engine, log_interval=100):
+    """Logs the resident memory of this process and its children (the DataLoader workers)
+
+    Memory-mapped volumes show up under the shared file-backed part, so with them the private
+    part of every worker should stay small.
+    """
+    logger = logging.getLogger(__name__)
+
+    if engine.state.iteration % log_interval == 0:
+        for name, pid in [("main", "self")] + [(f"worker {p}", p) for p in child_pids()]:
+            memory = process_memory(pid)
+            logger.info(
+                f"Memory {name} - rss {_to_mb(memory['rss'])} "
+                f"private {_to_mb(memory['rss_anon'])} shared {_to_mb(memory['rss_file'])}"
+            )
+
+
 class Evaluator:
     def __init__(self, evaluation_engine, data_loader):
         self._evaluation_engine = evaluation_engine
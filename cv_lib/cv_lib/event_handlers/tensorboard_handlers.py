@@ -6,6 +6,8 @@ import torchvision
 import logging
 import logging.config
 
+from deepseismic_interpretation.dutchf3.data import decode_segmap, get_seismic_labels
+
 try:
     from tensorboardX import SummaryWriter
 except ImportError:
@@ -67,3 +69,27 @@ def create_image_writer(summary_writer, label, output_variable, normalize=False,
             logger.warning("Predictions and or ground truth labels not available to report")
 
     return write_to
+
+
+def create_segmentation_image_writer(
+    summary_writer, label, output_variable, n_classes, label_colours=get_seismic_labels(), select_max=False
+):
+    """Writes the masks or, with select_max, the predicted classes in output_variable as colour images
+
+    The labels are decoded with decode_segmap on the device of the output tensors, so only the image grid
+    is copied to the host.
+
+    Args:
+        summary_writer (SummaryWriter): tensorboard writer
+        label (str): tag of the images
+        output_variable (str): key of the engine output to write
+        n_classes (int): number of classes
+        label_colours (np.ndarray, optional): RGB colour of every class. Defaults to get_seismic_labels().
+        select_max (bool, optional): take the class with the highest score along dim 1. Defaults to False.
+    """
+
+    def _to_colours(output_tensor):
+        labels = output_tensor.max(1)[1] if select_max else output_tensor.squeeze(1)
+        return decode_segmap(labels.detach(), n_classes=n_classes, label_colours=label_colours)
+
+    return create_image_writer(summary_writer, label, output_variable, transform_func=_to_colours)
@@ -0,0 +1,110 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""Model outputs kept on disk to be reused by later runs with the same weights and the same inputs"""
+
+import collections
+import hashlib
+import os
+
+import numpy as np
+
+
+def file_digest(filename, chunk_size=2 ** 20):
+    """SHA-256 of the contents of a file, e.g. a model checkpoint, read chunk by chunk"""
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def digest(*parts):
+    """SHA-256 of the string representations of any number of parts, e.g. a file digest and config values"""
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode()).hexdigest()
+
+
+class PredictionCache(object):
+    """Arrays stored as compressed float16 .npz files under cache_dir/namespace/key.npz
+
+    The namespace stands for everything the arrays depend on other than the key, e.g. the digest of the model
+    checkpoint and of the config values that go into computing the outputs, so that a change to any of them
+    misses the cache rather than reading stale arrays. The files of all the namespaces under cache_dir count
+    towards max_bytes, and the least recently used ones are removed whenever a new array takes the cache over it.
+    Reading a file sets its modification time, which is what the order of use is taken from when the cache is
+    opened again.
+
+    Args:
+        cache_dir (str): directory holding the cache
+        namespace (str): name of the subdirectory the arrays are read from and written to
+        max_bytes (int): size on disk the cache is kept under
+    """
+
+    def __init__(self, cache_dir, namespace, max_bytes):
+        self.namespace_dir = os.path.join(cache_dir, namespace)
+        os.makedirs(self.namespace_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # sizes of the files of every namespace, from the least to the most recently used
+        entries = []
+        for root, _, names in os.walk(cache_dir):
+            for name in names:
+                if name.endswith(".npz"):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime, os.path.join(root, name), stat.st_size))
+        self._sizes = collections.OrderedDict((filename, size) for _, filename, size in sorted(entries))
+        self._total = sum(self._sizes.values())
+
+    def _filename(self, key):
+        return os.path.join(self.namespace_dir, key + ".npz")
+
+    def get(self, key):
+        """Array stored under key, None if there is none"""
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as f:
+                array = f["array"]
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(filename)
+        self._track(filename)
+        self.hits += 1
+        return array
+
+    def put(self, key, array):
+        """Store an array under key, as float16
+
+        Returns:
+            numpy.ndarray: the float16 array as it is stored, so that results computed from it match the ones
+                computed from the array read back later
+        """
+        array = np.asarray(array, dtype=np.float16)
+        filename = self._filename(key)
+        # written under another name first so that an interrupted write never leaves a truncated entry
+        with open(filename + ".tmp", "wb") as f:
+            np.savez_compressed(f, array=array)
+        os.replace(filename + ".tmp", filename)
+        self._track(filename)
+        self._evict()
+        return array
+
+    def size(self):
+        """Size of the cache on disk in bytes"""
+        return self._total
+
+    def _track(self, filename):
+        # file written or read, the most recently used from now on
+        self._total -= self._sizes.pop(filename, 0)
+        self._sizes[filename] = os.path.getsize(filename)
+        self._total += self._sizes[filename]
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._sizes:
+            filename, size = self._sizes.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
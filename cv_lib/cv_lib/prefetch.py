@@ -0,0 +1,107 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""Background preparation of the items of an iterable, e.g. batches, while the main thread consumes them"""
+
+import queue
+import threading
+import time
+
+import torch
+
+# ends the queue of items, together with the exception the background thread raised if any
+_END = object()
+
+
+class Prefetcher(object):
+    """Runs iterables in a background thread that keeps up to depth of their items ready for the consumer
+
+    Keeps count of how long the consumer waited for items, which is time the consumer was input bound, of how long
+    the background thread waited for room in the queue, which is time the consumer was compute bound, and of the
+    number of items ready in the queue whenever the consumer asked for one. The counters add up over every
+    iterable the prefetcher runs, until reset. The background thread runs in the grad mode of the thread the
+    iterable is handed over from.
+
+    Args:
+        depth (int, optional): number of items prepared ahead of the consumer. Defaults to 2.
+
+    Example:
+        prefetcher = Prefetcher(depth=2)
+        for batch in prefetcher(batches):
+            ...
+        print(prefetcher.stats())
+    """
+
+    def __init__(self, depth=2):
+        if depth < 1:
+            raise ValueError(f"Prefetch depth must be at least 1, got {depth}")
+        self.depth = depth
+        self.reset()
+
+    def reset(self):
+        self.items = 0
+        self.queue_depth = 0
+        self.input_stall_time = 0.0
+        self.compute_stall_time = 0.0
+
+    def stats(self):
+        """Counters of the items prefetched since the last reset
+
+        Returns:
+            dict: number of items, mean number of items ready when the consumer asked for one, and the seconds the
+                consumer waited for items (input stall) and the background thread waited for room (compute stall)
+        """
+        return {
+            "items": self.items,
+            "mean_queue_depth": self.queue_depth / self.items if self.items else 0.0,
+            "input_stall_time": self.input_stall_time,
+            "compute_stall_time": self.compute_stall_time,
+        }
+
+    def _put(self, items, item, stop):
+        start = time.perf_counter()
+        try:
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            self.compute_stall_time += time.perf_counter() - start
+
+    def __call__(self, iterable):
+        items = queue.Queue(self.depth)
+        stop = threading.Event()
+        grad_enabled = torch.is_grad_enabled()
+
+        def _produce():
+            try:
+                with torch.set_grad_enabled(grad_enabled):
+                    for item in iterable:
+                        if not self._put(items, (item, None), stop):
+                            return
+            except Exception as e:
+                self._put(items, (_END, e), stop)
+            else:
+                self._put(items, (_END, None), stop)
+
+        producer = threading.Thread(target=_produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                queue_depth = items.qsize()
+                start = time.perf_counter()
+                item, error = items.get()
+                self.input_stall_time += time.perf_counter() - start
+                if item is _END:
+                    if error is not None:
+                        raise error
+                    return
+                self.queue_depth += queue_depth
+                self.items += 1
+                yield item
+        finally:
+            # stops the background thread when the consumer stops early
+            stop.set()
+            producer.join()
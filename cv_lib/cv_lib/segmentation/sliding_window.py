@@ -0,0 +1,224 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""Sliding window inference over whole sections
+
+The windows of a section are views cut out with unfold, scored a fixed size batch at a time and added back up
+with fold, so nothing but the scores of the section ever leaves the device the section is on. Batches are filled
+up with the windows of as many consecutive sections as it takes, so that the model only ever sees full batches
+however the windows of a section divide into them, and can be prepared in the background while the model scores
+the previous ones.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+def _window_counts(n_windows, patch_size, stride, size, device):
+    # number of windows covering every position along one axis
+    ones = torch.ones(1, patch_size, n_windows, device=device)
+    counts = F.fold(ones, output_size=(size, 1), kernel_size=(patch_size, 1), stride=(stride, 1))
+    return counts.view(size)
+
+
+class _Section(object):
+    """Windows of one image and the sum of the scores of the windows scored so far
+    """
+
+    def __init__(self, key, image, patch_size, stride, num_classes):
+        if image.dim() == 2:
+            image = image.unsqueeze(0)
+        self.key = key
+        self.patch_size = patch_size
+        self.stride = stride
+        _, self.h, self.w = image.shape
+
+        pad = patch_size // 2 - 1
+        padded = F.pad(image, (0, pad, 0, pad))
+        height, width = padded.shape[-2:]
+        self.output = torch.zeros(1, num_classes, max(height, self.h), max(width, self.w), device=image.device)
+        if height < patch_size or width < patch_size:
+            self.windows = None
+            self.n_h, self.n_w = 0, 0
+        else:
+            # n_h x n_w x C x patch_size x patch_size views of the windows
+            self.windows = padded.unfold(1, patch_size, stride).unfold(2, patch_size, stride).permute(1, 2, 0, 3, 4)
+            self.n_h, self.n_w = self.windows.shape[:2]
+
+        # windows handed out to batches and windows whose scores were added, in row major order
+        self.taken = 0
+        self.scored = 0
+
+    @property
+    def remaining(self):
+        return self.n_h * self.n_w - self.taken
+
+    @property
+    def done(self):
+        return self.scored == self.n_h * self.n_w
+
+    def take(self, n):
+        """Hands out up to n more windows as runs within a row
+
+        Returns:
+            list[tuple]: (row, first column, last column) of the runs
+        """
+        runs = []
+        while n > 0 and self.remaining > 0:
+            row, col = divmod(self.taken, self.n_w)
+            last_col = min(col + n, self.n_w)
+            runs.append((row, col, last_col))
+            n -= last_col - col
+            self.taken += last_col - col
+        return runs
+
+    def add(self, row, first_col, last_col, scores):
+        # overlap-add the scores of a run of windows
+        band = F.fold(
+            scores.reshape(len(scores), -1).t().unsqueeze(0),
+            output_size=(self.patch_size, (last_col - first_col - 1) * self.stride + self.patch_size),
+            kernel_size=self.patch_size,
+            stride=self.stride,
+        )
+        top, left = row * self.stride, first_col * self.stride
+        self.output[:, :, top : top + band.shape[2], left : left + band.shape[3]] += band
+        self.scored += last_col - first_col
+
+    def scores(self):
+        if self.windows is not None:
+            # only the part of the image the windows cover
+            height = (self.n_h - 1) * self.stride + self.patch_size
+            width = (self.n_w - 1) * self.stride + self.patch_size
+            counts = (
+                _window_counts(self.n_h, self.patch_size, self.stride, height, self.output.device)[:, None]
+                * _window_counts(self.n_w, self.patch_size, self.stride, width, self.output.device)[None, :]
+            )
+            self.output[:, :, :height, :width] /= counts.clamp(min=1)
+        return self.output[:, :, : self.h, : self.w]
+
+
+def _batches(images, patch_size, stride, batch_size, num_classes, pre_processing):
+    # the sections started, the runs of windows and their pre-processed batch, for every batch of the stream
+    images = iter(images)
+    section = None
+    exhausted = False
+    while not exhausted:
+        started, runs = [], []
+        n = 0
+        while n < batch_size:
+            if section is None or section.remaining == 0:
+                try:
+                    key, image = next(images)
+                except StopIteration:
+                    exhausted = True
+                    break
+                section = _Section(key, image, patch_size, stride, num_classes)
+                started.append(section)
+                continue
+            for row, first_col, last_col in section.take(batch_size - n):
+                runs.append((section, row, first_col, last_col))
+                n += last_col - first_col
+
+        batch = None
+        if runs:
+            batch = torch.cat([section.windows[row, first_col:last_col] for section, row, first_col, last_col in runs])
+            if pre_processing is not None:
+                batch = pre_processing(batch)
+        if started or runs:
+            yield started, runs, batch
+
+
+def predict_sliding_windows(
+    model,
+    images,
+    patch_size,
+    stride,
+    batch_size,
+    num_classes,
+    pre_processing=None,
+    output_processing=None,
+    prefetcher=None,
+):
+    """Average of the model scores of every patch_size x patch_size window that covers a pixel, for a stream of
+    images
+
+    Windows start every stride pixels from the top left of an image and reach up to patch_size // 2 - 1 pixels
+    past its bottom and right, which are padded with zeros, like the windows the test scripts used to cut out
+    patch by patch. Every batch holds batch_size windows, taken from the next images as soon as the windows of an
+    image run out, except for the last batch of the stream. Only the images with windows in the batches being
+    prepared or scored are held on to, and the images are pulled from the stream as their windows are needed.
+
+    Args:
+        model (torch.nn.Module): segmentation model taking N x C x H x W batches
+        images (iterable): (key, image) pairs of any key and an H x W or C x H x W image on the device to score on
+        patch_size (int): size of the windows
+        stride (int): distance between the windows
+        batch_size (int): number of windows scored at once
+        num_classes (int): number of classes the model scores
+        pre_processing (callable, optional): takes and returns N x C x H x W batches of windows before the model.
+            Defaults to None.
+        output_processing (callable, optional): takes the N x num_classes x H x W output of the model and returns
+            N x num_classes x patch_size x patch_size window scores. Defaults to None.
+        prefetcher (cv_lib.prefetch.Prefetcher, optional): pulls the images from the stream, cuts out and
+            pre-processes the batches of windows in the background while the model scores the previous ones.
+            Defaults to None, which prepares every batch right before scoring it.
+
+    Yields:
+        tuple: key and 1 x num_classes x H x W scores of an image, on the device of the image, as soon as all of
+            its windows are scored, which need not be in the order of the stream
+    """
+    batches = _batches(images, patch_size, stride, batch_size, num_classes, pre_processing)
+    if prefetcher is not None:
+        batches = prefetcher(batches)
+
+    sections = []
+    for started, runs, batch in batches:
+        sections.extend(started)
+        if runs:
+            scores = model(batch)
+            if output_processing is not None:
+                scores = output_processing(scores)
+
+            # route the scores back to the sections the windows were cut out of
+            start = 0
+            for section, row, first_col, last_col in runs:
+                section.add(row, first_col, last_col, scores[start : start + last_col - first_col])
+                start += last_col - first_col
+
+        for section in [section for section in sections if section.done]:
+            sections.remove(section)
+            yield section.key, section.scores()
+
+
+def predict_sliding_window(
+    model, image, patch_size, stride, batch_size, num_classes, pre_processing=None, output_processing=None,
+):
+    """Average of the model scores of every patch_size x patch_size window of an image that covers a pixel
+
+    Scores a single image with predict_sliding_windows.
+
+    Args:
+        model (torch.nn.Module): segmentation model taking N x C x H x W batches
+        image (torch.Tensor): H x W or C x H x W image on the device to score on
+        patch_size (int): size of the windows
+        stride (int): distance between the windows
+        batch_size (int): number of windows scored at once
+        num_classes (int): number of classes the model scores
+        pre_processing (callable, optional): takes and returns N x C x H x W batches of windows before the model.
+            Defaults to None.
+        output_processing (callable, optional): takes the N x num_classes x H x W output of the model and returns
+            N x num_classes x patch_size x patch_size window scores. Defaults to None.
+
+    Returns:
+        torch.Tensor: 1 x num_classes x H x W scores on the device of image
+    """
+    ((_, scores),) = predict_sliding_windows(
+        model,
+        [(None, image)],
+        patch_size,
+        stride,
+        batch_size,
+        num_classes,
+        pre_processing=pre_processing,
+        output_processing=output_processing,
+    )
+    return scores
@@ -0,0 +1,104 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""Augmentations for whole batches of torch tensors
+
+They mirror the albumentations transforms used in the experiments (Normalize, PadIfNeeded, Resize and
+HorizontalFlip) but work on BxCxHxW images and Bx1xHxW masks at once, on whichever device the tensors are on.
+Masks are padded with the ignore value 255 and resized with nearest neighbour interpolation so that no new
+labels are made up. Without labels, e.g. at inference, the mask is None and passed through as it is.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+class Compose(object):
+    def __init__(self, augmentations):
+        self.augmentations = augmentations
+
+    def __call__(self, img, mask):
+        for a in self.augmentations:
+            img, mask = a(img, mask)
+        return img, mask
+
+
+class Normalize(object):
+    """Normalize the images as (img - mean * max_pixel_value) / (std * max_pixel_value) per channel
+    """
+
+    def __init__(self, mean, std, max_pixel_value=255.0):
+        self.mean = mean
+        self.std = std
+        self.max_pixel_value = max_pixel_value
+
+    def _per_channel(self, values, img):
+        values = torch.as_tensor(values, dtype=torch.float32, device=img.device) * self.max_pixel_value
+        return values.view(1, -1, 1, 1)
+
+    def __call__(self, img, mask):
+        mean = self._per_channel(self.mean, img)
+        denominator = torch.reciprocal(self._per_channel(self.std, img))
+        return (img.float() - mean) * denominator, mask
+
+
+class PadIfNeeded(object):
+    """Pad the images and masks to at least min_height x min_width, splitting the padding evenly between
+    both sides like albumentations does with a constant border
+    """
+
+    def __init__(self, min_height, min_width, value=0, mask_value=255):
+        self.min_height = min_height
+        self.min_width = min_width
+        self.value = value
+        self.mask_value = mask_value
+
+    def __call__(self, img, mask):
+        h, w = img.shape[-2:]
+        pad_h, pad_w = max(self.min_height - h, 0), max(self.min_width - w, 0)
+        if pad_h == 0 and pad_w == 0:
+            return img, mask
+
+        padding = (pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2)
+        img = F.pad(img, padding, mode="constant", value=self.value)
+        if mask is not None:
+            mask = F.pad(mask, padding, mode="constant", value=self.mask_value)
+        return img, mask
+
+
+class Resize(object):
+    """Resize the images bilinearly and the masks with nearest neighbour interpolation
+    """
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+
+    def __call__(self, img, mask):
+        if img.shape[-2:] == (self.height, self.width):
+            return img, mask
+
+        size = (self.height, self.width)
+        img = F.interpolate(img, size=size, mode="bilinear", align_corners=False)
+        if mask is not None:
+            mask = F.interpolate(mask.float(), size=size, mode="nearest").to(mask.dtype)
+        return img, mask
+
+
+class HorizontalFlip(object):
+    """Flip every image and its mask along the width with probability p
+    """
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, img, mask):
+        flip = torch.rand(img.shape[0], device=img.device) < self.p
+        if not flip.any():
+            return img, mask
+
+        img = img.clone()
+        img[flip] = img[flip].flip(-1)
+        if mask is not None:
+            mask = mask.clone()
+            mask[flip] = mask[flip].flip(-1)
+        return img, mask
@@ -33,7 +33,7 @@ def save_image(image_numpy_array, output_dir, num_classes, colours, extra_identi
         colours ([type]): [description]
         extra_identifier (str, optional): [description]. Defaults to "".
     """
-    im_array = decode_segmap(image_numpy_array, n_classes=num_classes, label_colours=colours,)
-    im = pipe((im_array * 255).astype(np.uint8).squeeze(), _chw_to_hwc, Image.fromarray,)
+    im_array = decode_segmap(image_numpy_array, n_classes=num_classes, label_colours=colours, dtype=np.uint8)
+    im = pipe(im_array.squeeze(), _chw_to_hwc, Image.fromarray,)
     filename = path.join(output_dir, f"{id}_{extra_identifier}.png")
     im.save(filename)
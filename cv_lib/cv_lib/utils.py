@@ -17,3 +17,65 @@ def load_log_configuration(log_config_file):
         logging.getLogger(__name__).error("Failed to load configuration from %s!", log_config_file)
         logging.getLogger(__name__).debug(str(e), exc_info=True)
         raise e
+
+
+def peak_memory():
+    """Returns the peak resident memory of the current process in bytes
+
+    Returns:
+        int: peak resident memory or None on platforms without the resource module
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def process_memory(pid="self"):
+    """Returns the resident memory of a process in bytes
+
+    Memory that is backed by memory-mapped files (RssFile) lives in the page cache and is shared
+    between every process that maps the same file, whereas RssAnon is private to the process.
+
+    Args:
+        pid (int or str, optional): process id to inspect. Defaults to the current process.
+
+    Returns:
+        dict: rss, rss_anon and rss_file in bytes. Only rss (the peak) is filled in for the current process on
+            platforms without /proc
+    """
+    fields = {"VmRSS:": "rss", "RssAnon:": "rss_anon", "RssFile:": "rss_file"}
+    memory = dict.fromkeys(fields.values())
+    try:
+        with open(os.path.join("/proc", str(pid), "status")) as f:
+            for line in f:
+                key, *value = line.split()
+                if key in fields:
+                    memory[fields[key]] = int(value[0]) * 1024  # reported in kB
+    except (FileNotFoundError, ProcessLookupError):
+        if pid == "self":
+            memory["rss"] = peak_memory()
+    return memory
+
+
+def child_pids(pid="self"):
+    """Returns the ids of the child processes of a process, e.g. the DataLoader workers
+
+    Args:
+        pid (int or str, optional): parent process id. Defaults to the current process.
+
+    Returns:
+        list[int]: child process ids, empty if they can't be determined
+    """
+    pids = []
+    task_dir = os.path.join("/proc", str(pid), "task")
+    if not os.path.isdir(task_dir):
+        return pids
+    for task in os.listdir(task_dir):
+        try:
+            with open(os.path.join(task_dir, task, "children")) as f:
+                pids.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return pids
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+
+from cv_lib.prediction_cache import PredictionCache, digest
+
+
+def test_prediction_cache_round_trip(tmpdir):
+    cache = PredictionCache(str(tmpdir), digest("checkpoint", "config"), max_bytes=2 ** 20)
+    assert cache.get("test1_i_0") is None
+
+    scores = np.random.RandomState(0).randn(1, 6, 20, 30).astype(np.float32)
+    stored = cache.put("test1_i_0", scores)
+    assert stored.dtype == np.float16
+    np.testing.assert_array_equal(cache.get("test1_i_0"), stored)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # another namespace misses, the same one opened again hits
+    other = PredictionCache(str(tmpdir), digest("checkpoint", "other config"), max_bytes=2 ** 20)
+    assert other.get("test1_i_0") is None
+    np.testing.assert_array_equal(
+        PredictionCache(str(tmpdir), digest("checkpoint", "config"), max_bytes=2 ** 20).get("test1_i_0"), stored
+    )
+
+
+def test_prediction_cache_evicts_least_recently_used(tmpdir):
+    arrays = {key: np.random.RandomState(seed).randn(100, 100) for seed, key in enumerate("abcd")}
+    cache = PredictionCache(str(tmpdir), "namespace", max_bytes=2 ** 30)
+    for key in "abc":
+        cache.put(key, arrays[key])
+    entry_size = cache.size() // 3
+
+    # room for three entries, a is used after b so b goes first
+    cache = PredictionCache(str(tmpdir), "namespace", max_bytes=entry_size * 3 + entry_size // 2)
+    cache.get("a")
+    cache.put("d", arrays["d"])
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in "acd")
+    assert sorted(os.listdir(str(tmpdir.join("namespace")))) == ["a.npz", "c.npz", "d.npz"]
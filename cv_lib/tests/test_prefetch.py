@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from cv_lib.prefetch import Prefetcher
+from cv_lib.segmentation.sliding_window import predict_sliding_windows
+
+
+def test_prefetcher_yields_every_item_and_counts_them():
+    prefetcher = Prefetcher(depth=3)
+    assert list(prefetcher(range(10))) == list(range(10))
+    assert list(prefetcher(iter("abc"))) == ["a", "b", "c"]
+
+    stats = prefetcher.stats()
+    assert stats["items"] == 13
+    assert 0 <= stats["mean_queue_depth"] <= 3
+    assert stats["input_stall_time"] >= 0 and stats["compute_stall_time"] >= 0
+
+    prefetcher.reset()
+    stats = prefetcher.stats()
+    assert stats == {"items": 0, "mean_queue_depth": 0.0, "input_stall_time": 0.0, "compute_stall_time": 0.0}
+
+    with pytest.raises(ValueError):
+        Prefetcher(depth=0)
+
+
+def test_prefetcher_counts_stalls():
+    def _slow_items():
+        for item in range(3):
+            time.sleep(0.05)
+            yield item
+
+    # an input bound consumer waits for every item
+    prefetcher = Prefetcher(depth=2)
+    list(prefetcher(_slow_items()))
+    assert prefetcher.stats()["input_stall_time"] >= 0.1
+
+    # a compute bound consumer keeps the background thread waiting for room in the queue
+    prefetcher = Prefetcher(depth=1)
+    for _ in prefetcher(range(4)):
+        time.sleep(0.05)
+    assert prefetcher.stats()["compute_stall_time"] >= 0.1
+
+
+def test_prefetcher_reraises_errors_of_the_iterable():
+    def _failing():
+        yield 1
+        yield 2
+        raise KeyError("broken")
+
+    items = []
+    with pytest.raises(KeyError, match="broken"):
+        for item in Prefetcher()(_failing()):
+            items.append(item)
+    assert items == [1, 2]
+
+
+def test_prefetcher_stops_the_background_thread_when_the_consumer_stops():
+    produced = []
+
+    def _endless():
+        while True:
+            produced.append(len(produced))
+            yield produced[-1]
+
+    threads = threading.active_count()
+    items = Prefetcher(depth=2)(_endless())
+    assert [next(items) for _ in range(5)] == list(range(5))
+    items.close()
+
+    # the thread is joined on close, after preparing no more than depth items and the one it was waiting to queue
+    assert threading.active_count() == threads
+    n_produced = len(produced)
+    assert n_produced <= 5 + 3
+    time.sleep(0.2)
+    assert len(produced) == n_produced
+
+
+def test_prefetcher_runs_in_the_grad_mode_of_the_consumer():
+    def _grad_modes():
+        for _ in range(2):
+            yield torch.is_grad_enabled()
+
+    with torch.no_grad():
+        assert list(Prefetcher()(_grad_modes())) == [False, False]
+    assert list(Prefetcher()(_grad_modes())) == [True, True]
+
+
+def test_prefetched_sliding_windows_match():
+    torch.manual_seed(0)
+    model = torch.nn.Conv2d(1, 2, 3, padding=1).eval()
+    images = [(key, torch.randn(1, 20 + key, 30)) for key in range(4)]
+
+    with torch.no_grad():
+        expected = dict(predict_sliding_windows(model, images, 16, 8, 3, 2))
+        prefetcher = Prefetcher()
+        scores = dict(predict_sliding_windows(model, images, 16, 8, 3, 2, prefetcher=prefetcher))
+    assert sorted(scores) == sorted(expected)
+    for key in expected:
+        assert torch.equal(scores[key], expected[key])
+    assert prefetcher.stats()["items"] > 0
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from cv_lib.segmentation.sliding_window import predict_sliding_window, predict_sliding_windows
+
+_NUM_CLASSES = 3
+
+
+def _model():
+    torch.manual_seed(0)
+    return torch.nn.Conv2d(2, _NUM_CLASSES, 3, padding=1).eval()
+
+
+def _window_by_window(model, image, patch_size, stride):
+    # the windows cut out one at a time, like the test scripts used to
+    pad = patch_size // 2 - 1
+    padded = F.pad(image, (0, pad, 0, pad))
+    h, w = image.shape[-2:]
+    scores = torch.zeros(1, _NUM_CLASSES, max(padded.shape[-2], h), max(padded.shape[-1], w))
+    counts = torch.zeros_like(scores)
+    for top in range(0, padded.shape[-2] - patch_size + 1, stride):
+        for left in range(0, padded.shape[-1] - patch_size + 1, stride):
+            window = padded[:, top : top + patch_size, left : left + patch_size]
+            scores[:, :, top : top + patch_size, left : left + patch_size] += model(window.unsqueeze(0))
+            counts[:, :, top : top + patch_size, left : left + patch_size] += 1
+    return (scores / counts.clamp(min=1))[:, :, :h, :w]
+
+
+_SHAPES = [(30, 41), (16, 16), (17, 50), (9, 12), (5, 40)]
+
+
+@pytest.mark.parametrize(
+    "patch_size, stride, batch_size", [(16, 8, 4), (16, 16, 1), (10, 3, 7), (8, 5, 64)],
+)
+def test_predict_sliding_window_matches_window_by_window(patch_size, stride, batch_size):
+    model = _model()
+    images = [torch.randn(2, h, w) for h, w in _SHAPES]
+
+    with torch.no_grad():
+        for image in images:
+            expected = _window_by_window(model, image, patch_size, stride)
+            scores = predict_sliding_window(model, image, patch_size, stride, batch_size, _NUM_CLASSES)
+            assert scores.shape == (1, _NUM_CLASSES) + image.shape[-2:]
+            np.testing.assert_allclose(scores.numpy(), expected.numpy(), rtol=1e-5, atol=1e-5)
+
+        # the whole stream at once, with the batches filled up across the images
+        scores = dict(predict_sliding_windows(model, enumerate(images), patch_size, stride, batch_size, _NUM_CLASSES))
+        assert sorted(scores) == list(range(len(images)))
+        for key, image in enumerate(images):
+            expected = _window_by_window(model, image, patch_size, stride)
+            np.testing.assert_allclose(scores[key].numpy(), expected.numpy(), rtol=1e-5, atol=1e-5)
+
+
+class _Recorder(torch.nn.Module):
+    # keeps the size of every batch the model is called with
+    def __init__(self, model):
+        super(_Recorder, self).__init__()
+        self.model = model
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(len(x))
+        return self.model(x)
+
+
+def _n_windows(shape, patch_size, stride):
+    pad = patch_size // 2 - 1
+    n_h, n_w = [max((n + pad - patch_size) // stride + 1, 0) for n in shape]
+    return n_h * n_w
+
+
+def test_predict_sliding_windows_fills_batches_across_images():
+    patch_size, stride, batch_size = 16, 8, 5
+    shapes = [(30, 41), (16, 16), (17, 50), (24, 24), (40, 17)]
+    model = _Recorder(_model())
+    pulled = []
+
+    def _images():
+        for key, shape in enumerate(shapes):
+            pulled.append(key)
+            yield key, torch.randn(2, *shape)
+
+    n_windows = [_n_windows(shape, patch_size, stride) for shape in shapes]
+    with torch.no_grad():
+        for key, _ in predict_sliding_windows(model, _images(), patch_size, stride, batch_size, _NUM_CLASSES):
+            # every image comes out right after the batch holding its last window, before the next images are read
+            assert len(model.batch_sizes) == -(-sum(n_windows[: key + 1]) // batch_size)
+            assert pulled[-1] <= key + 1
+
+    # every batch is full but the last one
+    assert sum(model.batch_sizes) == sum(n_windows)
+    assert model.batch_sizes[:-1] == [batch_size] * (len(model.batch_sizes) - 1)
+
+
+def test_predict_sliding_windows_yields_images_without_windows():
+    patch_size, stride, batch_size = 16, 8, 4
+    shapes = [(5, 40), (30, 41), (3, 3), (6, 6), (16, 16)]
+    model = _Recorder(_model())
+    images = [torch.randn(2, *shape) for shape in shapes]
+
+    with torch.no_grad():
+        scores = list(predict_sliding_windows(model, enumerate(images), patch_size, stride, batch_size, _NUM_CLASSES))
+
+    # in whatever order they complete, every image comes out once with its own shape
+    assert sorted(key for key, _ in scores) == list(range(len(shapes)))
+    for key, image_scores in scores:
+        assert image_scores.shape == (1, _NUM_CLASSES) + shapes[key]
+        if _n_windows(shapes[key], patch_size, stride) == 0:
+            assert not image_scores.any()
+    assert sum(model.batch_sizes) == sum(_n_windows(shape, patch_size, stride) for shape in shapes)
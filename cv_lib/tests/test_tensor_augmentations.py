@@ -0,0 +1,53 @@
+import albumentations
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from cv_lib.segmentation import tensor_augmentations
+
+_MEAN, _STD, _MAX = 0.0009997, 0.20977, 1
+
+
+def _pipelines(pad, height, width):
+    # the basic augmentations of the training scripts, per sample and for whole batches
+    per_sample = albumentations.Compose(
+        [
+            albumentations.Normalize(mean=(_MEAN,), std=(_STD,), max_pixel_value=_MAX),
+            albumentations.PadIfNeeded(
+                min_height=pad,
+                min_width=pad,
+                border_mode=cv2.BORDER_CONSTANT,
+                always_apply=True,
+                mask_value=255,
+                value=0,
+            ),
+            albumentations.Resize(height, width, always_apply=True),
+        ]
+    )
+    batched = tensor_augmentations.Compose(
+        [
+            tensor_augmentations.Normalize(mean=(_MEAN,), std=(_STD,), max_pixel_value=_MAX),
+            tensor_augmentations.PadIfNeeded(min_height=pad, min_width=pad, mask_value=255, value=0),
+            tensor_augmentations.Resize(height, width),
+        ]
+    )
+    return per_sample, batched
+
+
+@pytest.mark.parametrize(
+    "shape, pad, height, width",
+    [((12, 12), 12, 12, 12), ((7, 10), 12, 12, 12), ((7, 10), 12, 24, 24), ((12, 9), 16, 8, 8), ((5, 5), 8, 13, 17)],
+)
+def test_tensor_augmentations_match_albumentations(shape, pad, height, width):
+    random_state = np.random.RandomState(0)
+    images = random_state.randn(4, 1, *shape).astype(np.float32)
+    masks = random_state.randint(0, 6, (4, 1, *shape)).astype(np.uint8)
+    per_sample, batched = _pipelines(pad, height, width)
+
+    batch_images, batch_masks = batched(torch.from_numpy(images), torch.from_numpy(masks))
+    assert batch_images.shape == (4, 1, height, width) and batch_masks.shape == (4, 1, height, width)
+    for image, mask, batch_image, batch_mask in zip(images, masks, batch_images, batch_masks):
+        augmented = per_sample(image=image[0][..., None], mask=mask[0])
+        np.testing.assert_allclose(batch_image[0].numpy(), augmented["image"][..., 0], rtol=1e-4, atol=1e-4)
+        np.testing.assert_array_equal(batch_mask[0].numpy(), augmented["mask"])
@@ -1,15 +1,14 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import itertools
-
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.nn.functional as F
+from cv_lib.segmentation.sliding_window import predict_sliding_window
 from ignite.utils import convert_tensor
 from scipy.ndimage import zoom
-from toolz import compose, curry, itertoolz, pipe
+from toolz import compose, curry
 
 
 class runningScore(object):
@@ -69,71 +68,21 @@ def prepare_batch(batch, device=None, non_blocking=False):
     )
 
 
-def _transform_CHW_to_HWC(numpy_array):
-    return np.moveaxis(numpy_array, 0, -1)
-
-
-def _transform_HWC_to_CHW(numpy_array):
-    return np.moveaxis(numpy_array, -1, 0)
-
-
 @curry
-def _apply_augmentation3D(aug, numpy_array):
-    assert len(numpy_array.shape) == 3, "This method only accepts 3D arrays"
-    patch = _transform_CHW_to_HWC(numpy_array)
-    patch = aug(image=patch)["image"]
-    return _transform_HWC_to_CHW(patch)
-
-
-@curry
-def _apply_augmentation2D(aug, numpy_array):
-    assert len(numpy_array.shape) == 2, "This method only accepts 2D arrays"
-    return aug(image=numpy_array)["image"]
-
-
-_AUGMENTATION = {3: _apply_augmentation3D, 2: _apply_augmentation2D}
-
-
-@curry
-def _apply_augmentation(aug, image):
-    if isinstance(image, torch.Tensor):
-        image = image.numpy()
-
-    if aug is not None:
-        return _AUGMENTATION[len(image.shape)](aug, image)
-    else:
-        return image
-
+def _apply_augmentation(aug, images):
+    images, _ = aug(images, None)
+    return images
 
-def _add_depth(image):
-    if isinstance(image, torch.Tensor):
-        image = image.numpy()
-    return add_patch_depth_channels(image)
 
-
-def _to_torch(image):
-    if isinstance(image, torch.Tensor):
-        return image
-    else:
-        return torch.from_numpy(image).to(torch.float32)
-
-
-def _expand_dims_if_necessary(torch_tensor):
-    if len(torch_tensor.shape) == 2:
-        return torch_tensor.unsqueeze(dim=0)
-    else:
-        return torch_tensor
-
-
-@curry
-def _extract_patch(hdx, wdx, ps, patch_size, img_p):
-    if len(img_p.shape) == 2:  # 2D
-        return img_p[hdx + ps : hdx + ps + patch_size, wdx + ps : wdx + ps + patch_size]
-    else:  # 3D
-        return img_p[:, hdx + ps : hdx + ps + patch_size, wdx + ps : wdx + ps + patch_size]
+def _add_depth(images):
+    # the patch depth channels of a batch of N x 1 x H x W patches: the patch, a ramp from 0 to 1 down the patch
+    # and their product
+    depth = torch.linspace(0, 1, images.shape[2], device=images.device).view(1, 1, -1, 1).expand_as(images)
+    return torch.cat([images, depth, images * depth], dim=1)
 
 
 def compose_processing_pipeline(depth, aug=None):
+    """Pre-processing of whole batches of patches, aug is made of cv_lib.segmentation.tensor_augmentations"""
     steps = []
     if aug is not None:
         steps.append(_apply_augmentation(aug))
@@ -141,22 +90,12 @@ def compose_processing_pipeline(depth, aug=None):
     if depth == "patch":
         steps.append(_add_depth)
 
-    steps.append(_to_torch)
-    steps.append(_expand_dims_if_necessary)
     steps.reverse()
     return compose(*steps)
 
 
-def _generate_batches(h, w, ps, patch_size, stride, batch_size=64):
-    hdc_wdx_generator = itertools.product(range(0, h - patch_size + ps, stride), range(0, w - patch_size + ps, stride))
-
-    for batch_indexes in itertoolz.partition_all(batch_size, hdc_wdx_generator):
-        yield batch_indexes
-
-
 @curry
 def output_processing_pipeline(config, output):
-    output = output.unsqueeze(0)
     _, _, h, w = output.shape
     if config.TEST.POST_PROCESSING.SIZE != h or config.TEST.POST_PROCESSING.SIZE != w:
         output = F.interpolate(
@@ -171,36 +110,24 @@ def output_processing_pipeline(config, output):
             config.TEST.POST_PROCESSING.CROP_PIXELS : h - config.TEST.POST_PROCESSING.CROP_PIXELS,
             config.TEST.POST_PROCESSING.CROP_PIXELS : w - config.TEST.POST_PROCESSING.CROP_PIXELS,
         ]
-    return output.squeeze()
+    return output
 
 
 def patch_label_2d(
     model, img, pre_processing, output_processing, patch_size, stride, batch_size, device, num_classes,
 ):
-    """Processes a whole section"""
-    img = torch.squeeze(img)
-    h, w = img.shape[-2], img.shape[-1]  # height and width
-
-    # Pad image with patch_size/2:
-    ps = int(np.floor(patch_size / 2))  # pad size
-    img_p = F.pad(img, pad=(ps, ps, ps, ps), mode="constant", value=0)
-    output_p = torch.zeros([1, num_classes, h + 2 * ps, w + 2 * ps])
-
-    # generate output:
-    for batch_indexes in _generate_batches(h, w, ps, patch_size, stride, batch_size=batch_size):
-        batch = torch.stack(
-            [pipe(img_p, _extract_patch(hdx, wdx, ps, patch_size), pre_processing) for hdx, wdx in batch_indexes],
-            dim=0,
-        )
-
-        model_output = model(batch.to(device))
-        for (hdx, wdx), output in zip(batch_indexes, model_output.detach().cpu()):
-            output = output_processing(output)
-            output_p[:, :, hdx + ps : hdx + ps + patch_size, wdx + ps : wdx + ps + patch_size] += output
-
-    # crop the output_p in the middle
-    output = output_p[:, :, ps:-ps, ps:-ps]
-    return output
+    """Processes a whole section on device, returns the scores on the CPU"""
+    output = predict_sliding_window(
+        model,
+        torch.squeeze(img).to(device),
+        patch_size,
+        stride,
+        batch_size,
+        num_classes,
+        pre_processing=pre_processing,
+        output_processing=output_processing,
+    )
+    return output.cpu()
 
 
 def write_section_file(labels, section_file, config):
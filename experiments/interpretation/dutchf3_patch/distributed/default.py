@@ -33,6 +33,7 @@ _C.DATASET = CN()
 _C.DATASET.ROOT = ""
 _C.DATASET.NUM_CLASSES = 6
 _C.DATASET.CLASS_WEIGHTS = [0.7151, 0.8811, 0.5156, 0.9346, 0.9683, 0.9852]
+_C.DATASET.STORAGE = "float32"  # float32, float16 or int8, see scripts/prepare_dutchf3.py reduced_precision
 
 # common params for NETWORK
 _C.MODEL = CN()
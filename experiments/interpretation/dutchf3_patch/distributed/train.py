@@ -21,11 +21,9 @@ import logging.config
 import os
 from os import path
 
-import cv2
 import fire
 import numpy as np
 import torch
-from albumentations import Compose, HorizontalFlip, Normalize, Resize, PadIfNeeded
 from cv_lib.utils import load_log_configuration
 from cv_lib.event_handlers import (
     SnapshotHandler,
@@ -35,11 +33,13 @@ from cv_lib.event_handlers import (
 from cv_lib.event_handlers.logging_handlers import Evaluator
 from cv_lib.event_handlers.tensorboard_handlers import (
     create_image_writer,
+    create_segmentation_image_writer,
     create_summary_writer,
 )
 from cv_lib.segmentation import models
 from cv_lib.segmentation import extract_metric_from
-from deepseismic_interpretation.dutchf3.data import get_patch_loader, decode_segmap
+from cv_lib.segmentation.tensor_augmentations import Compose, HorizontalFlip, Normalize, PadIfNeeded, Resize
+from deepseismic_interpretation.dutchf3.data import get_batch_loader, get_patch_loader
 from cv_lib.segmentation.dutchf3.engine import (
     create_supervised_evaluator,
     create_supervised_trainer,
@@ -59,7 +59,6 @@ from cv_lib.segmentation.dutchf3.utils import (
     generate_path,
     git_branch,
     git_hash,
-    np_to_tb,
 )
 from default import _C as config
 from default import update_config
@@ -70,8 +69,7 @@ from ignite.contrib.handlers import (
 )
 from ignite.engine import Events
 from ignite.utils import convert_tensor
-from toolz import compose, curry
-from torch.utils import data
+from toolz import curry
 from toolz import take
 
 
@@ -84,8 +82,8 @@ def prepare_batch(batch, device=None, non_blocking=False):
 
 
 @curry
-def update_sampler_epoch(data_loader, engine):
-    data_loader.sampler.epoch = engine.state.epoch
+def update_sampler_epoch(sampler, engine):
+    sampler.epoch = engine.state.epoch
 
 
 def run(*options, cfg=None, local_rank=0, debug=False):
@@ -130,25 +128,19 @@ def run(*options, cfg=None, local_rank=0, debug=False):
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(config.SEED)
     np.random.seed(seed=config.SEED)
-    # Setup Augmentations
+    # Setup Augmentations, they work on whole batches of tensors
     basic_aug = Compose(
         [
             Normalize(mean=(config.TRAIN.MEAN,), std=(config.TRAIN.STD,), max_pixel_value=1),
             PadIfNeeded(
                 min_height=config.TRAIN.PATCH_SIZE,
                 min_width=config.TRAIN.PATCH_SIZE,
-                border_mode=cv2.BORDER_CONSTANT,
-                always_apply=True,
                 mask_value=255,
             ),
-            Resize(
-                config.TRAIN.AUGMENTATIONS.RESIZE.HEIGHT, config.TRAIN.AUGMENTATIONS.RESIZE.WIDTH, always_apply=True,
-            ),
+            Resize(config.TRAIN.AUGMENTATIONS.RESIZE.HEIGHT, config.TRAIN.AUGMENTATIONS.RESIZE.WIDTH),
             PadIfNeeded(
                 min_height=config.TRAIN.AUGMENTATIONS.PAD.HEIGHT,
                 min_width=config.TRAIN.AUGMENTATIONS.PAD.WIDTH,
-                border_mode=cv2.BORDER_CONSTANT,
-                always_apply=True,
                 mask_value=255,
             ),
         ]
@@ -167,7 +159,8 @@ def run(*options, cfg=None, local_rank=0, debug=False):
         is_transform=True,
         stride=config.TRAIN.STRIDE,
         patch_size=config.TRAIN.PATCH_SIZE,
-        augmentations=train_aug,
+        batch_augmentations=train_aug,
+        storage=config.DATASET.STORAGE,
     )
     logger.info(f"Training examples {len(train_set)}")
 
@@ -177,20 +170,21 @@ def run(*options, cfg=None, local_rank=0, debug=False):
         is_transform=True,
         stride=config.TRAIN.STRIDE,
         patch_size=config.TRAIN.PATCH_SIZE,
-        augmentations=val_aug,
+        batch_augmentations=val_aug,
+        storage=config.DATASET.STORAGE,
     )
     logger.info(f"Validation examples {len(val_set)}")
     n_classes = train_set.n_classes
 
     train_sampler = torch.utils.data.distributed.DistributedSampler(train_set, num_replicas=world_size, rank=local_rank)
 
-    train_loader = data.DataLoader(
+    train_loader = get_batch_loader(
         train_set, batch_size=config.TRAIN.BATCH_SIZE_PER_GPU, num_workers=config.WORKERS, sampler=train_sampler,
     )
 
     val_sampler = torch.utils.data.distributed.DistributedSampler(val_set, num_replicas=world_size, rank=local_rank)
 
-    val_loader = data.DataLoader(
+    val_loader = get_batch_loader(
         val_set, batch_size=config.VALIDATION.BATCH_SIZE_PER_GPU, num_workers=config.WORKERS, sampler=val_sampler,
     )
 
@@ -236,7 +230,7 @@ def run(*options, cfg=None, local_rank=0, debug=False):
     trainer.add_event_handler(Events.ITERATION_STARTED, scheduler)
     # Set to update the epoch parameter of our distributed data sampler so that we get
     # different shuffles
-    trainer.add_event_handler(Events.EPOCH_STARTED, update_sampler_epoch(train_loader))
+    trainer.add_event_handler(Events.EPOCH_STARTED, update_sampler_epoch(train_sampler))
 
     if silence_other_ranks & local_rank != 0:
         logging.getLogger("ignite.engine.engine.Engine").setLevel(logging.WARNING)
@@ -269,6 +263,9 @@ def run(*options, cfg=None, local_rank=0, debug=False):
         trainer.add_event_handler(
             Events.ITERATION_COMPLETED, logging_handlers.log_training_output(log_interval=config.PRINT_FREQ),
         )
+        trainer.add_event_handler(
+            Events.ITERATION_COMPLETED, logging_handlers.log_process_memory(log_interval=config.PRINT_FREQ),
+        )
         trainer.add_event_handler(Events.EPOCH_STARTED, logging_handlers.log_lr(optimizer))    
 
         try:
@@ -306,26 +303,16 @@ def run(*options, cfg=None, local_rank=0, debug=False):
             ),
         )
 
-        def _select_max(pred_tensor):
-            return pred_tensor.max(1)[1]
-
-        def _tensor_to_numpy(pred_tensor):
-            return pred_tensor.squeeze().cpu().numpy()
-
-        transform_func = compose(np_to_tb, decode_segmap(n_classes=n_classes), _tensor_to_numpy)
-
-        transform_pred = compose(transform_func, _select_max)
-
         evaluator.add_event_handler(
             Events.EPOCH_COMPLETED, create_image_writer(summary_writer, "Validation/Image", "image"),
         )
         evaluator.add_event_handler(
             Events.EPOCH_COMPLETED,
-            create_image_writer(summary_writer, "Validation/Mask", "mask", transform_func=transform_func),
+            create_segmentation_image_writer(summary_writer, "Validation/Mask", "mask", n_classes),
         )
         evaluator.add_event_handler(
             Events.EPOCH_COMPLETED,
-            create_image_writer(summary_writer, "Validation/Pred", "y_pred", transform_func=transform_pred,),
+            create_segmentation_image_writer(summary_writer, "Validation/Pred", "y_pred", n_classes, select_max=True),
         )
 
         def snapshot_function():
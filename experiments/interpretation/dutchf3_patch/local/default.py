@@ -33,6 +33,7 @@ _C.DATASET = CN()
 _C.DATASET.ROOT = ""
 _C.DATASET.NUM_CLASSES = 6
 _C.DATASET.CLASS_WEIGHTS = [0.7151, 0.8811, 0.5156, 0.9346, 0.9683, 0.9852]
+_C.DATASET.STORAGE = "float32"  # float32, float16 or int8, see scripts/prepare_dutchf3.py reduced_precision
 
 # common params for NETWORK
 _C.MODEL = CN()
@@ -54,6 +55,9 @@ _C.TRAIN.WEIGHT_DECAY = 0.0001
 _C.TRAIN.SNAPSHOTS = 5
 _C.TRAIN.MODEL_DIR = "models"  # This will be a subdirectory inside OUTPUT_DIR
 _C.TRAIN.AUGMENTATION = True
+_C.TRAIN.CLASS_BALANCED_SAMPLING = False  # needs the class histograms written by scripts/prepare_dutchf3.py
+_C.TRAIN.RANDOM_PATCHES = False  # sample the patch origins on the fly instead of reading the split
+_C.TRAIN.BATCHES_PER_EPOCH = 1000  # only used with RANDOM_PATCHES
 _C.TRAIN.STRIDE = 50
 _C.TRAIN.PATCH_SIZE = 99
 _C.TRAIN.MEAN = 0.0009997  # 0.0009996710808862074
@@ -81,6 +85,11 @@ _C.TEST.TEST_STRIDE = 10
 _C.TEST.SPLIT = "Both"  # Can be Both, Test1, Test2
 _C.TEST.INLINE = True
 _C.TEST.CROSSLINE = True
+_C.TEST.EXPORT_DIR = ""  # writes the predicted labels there, resuming where an interrupted run left off
+_C.TEST.CACHE = CN()  # scores of the sections kept on disk for runs with the same checkpoint and inputs
+_C.TEST.CACHE.DIR = ""  # no cache when empty
+_C.TEST.CACHE.MAX_GB = 10.0  # least recently used scores are removed past this size
+_C.TEST.PREFETCH = 2  # batches of patches prepared in the background while the model runs, 0 prepares them in line
 _C.TEST.POST_PROCESSING = CN()  # Model output postprocessing
 _C.TEST.POST_PROCESSING.SIZE = 128  # Size to interpolate to in pixels
 _C.TEST.POST_PROCESSING.CROP_PIXELS = 14  # Number of pixels to crop top, bottom, left and right
@@ -14,28 +14,32 @@ Runs only on single GPU
 Estimated time to run on single V100: 5 hours
 """
 
-import itertools
 import logging
 import logging.config
 import os
 from os import path
 
-import cv2
 import fire
 import numpy as np
 import torch
 import torch.nn.functional as F
-from albumentations import Compose, Normalize, PadIfNeeded, Resize
+from albumentations import Compose, Normalize
+from cv_lib.prefetch import Prefetcher
+from cv_lib.prediction_cache import PredictionCache, digest, file_digest
 from cv_lib.utils import load_log_configuration
-from cv_lib.segmentation import models
+from cv_lib.segmentation import models, tensor_augmentations
+from cv_lib.segmentation.sliding_window import predict_sliding_windows
 from deepseismic_interpretation.dutchf3.data import (
-    add_patch_depth_channels,
-    get_seismic_labels,
+    SectionPredictions,
+    decode_segmap,
     get_test_loader,
+    section_id,
+    storage_path,
+    write_split,
 )
 from default import _C as config
 from default import update_config
-from toolz import compose, curry, itertoolz, pipe
+from toolz import compose, curry
 from torch.utils import data
 from toolz import take
 
@@ -99,70 +103,17 @@ class runningScore(object):
         self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
 
 
-def _transform_CHW_to_HWC(numpy_array):
-    return np.moveaxis(numpy_array, 0, -1)
-
-
-def _transform_HWC_to_CHW(numpy_array):
-    return np.moveaxis(numpy_array, -1, 0)
-
-
-@curry
-def _apply_augmentation3D(aug, numpy_array):
-    assert len(numpy_array.shape) == 3, "This method only accepts 3D arrays"
-    patch = _transform_CHW_to_HWC(numpy_array)
-    patch = aug(image=patch)["image"]
-    return _transform_HWC_to_CHW(patch)
-
-
 @curry
-def _apply_augmentation2D(aug, numpy_array):
-    assert len(numpy_array.shape) == 2, "This method only accepts 2D arrays"
-    return aug(image=numpy_array)["image"]
-
-
-_AUGMENTATION = {3: _apply_augmentation3D, 2: _apply_augmentation2D}
-
-
-@curry
-def _apply_augmentation(aug, image):
-    if isinstance(image, torch.Tensor):
-        image = image.numpy()
-
-    if aug is not None:
-        return _AUGMENTATION[len(image.shape)](aug, image)
-    else:
-        return image
+def _apply_augmentation(aug, images):
+    images, _ = aug(images, None)
+    return images
 
 
-def _add_depth(image):
-    if isinstance(image, torch.Tensor):
-        image = image.numpy()
-    return add_patch_depth_channels(image)
-
-
-def _to_torch(image):
-    if isinstance(image, torch.Tensor):
-        return image
-    else:
-        return torch.from_numpy(image).to(torch.float32)
-
-
-def _expand_dims_if_necessary(torch_tensor):
-    if len(torch_tensor.shape) == 2:
-        return torch_tensor.unsqueeze(dim=0)
-    else:
-        return torch_tensor
-
-
-@curry
-def _extract_patch(hdx, wdx, ps, patch_size, img_p):
-    if len(img_p.shape) == 2:  # 2D
-        return img_p[hdx + ps : hdx + ps + patch_size, wdx + ps : wdx + ps + patch_size]
-    else:  # 3D
-        return img_p[
-            :, hdx + ps : hdx + ps + patch_size, wdx + ps : wdx + ps + patch_size,
-        ]
+def _add_depth(images):
+    # the patch depth channels of a batch of N x 1 x H x W patches: the patch, a ramp from 0 to 1 down the patch
+    # and their product
+    depth = torch.linspace(0, 1, images.shape[2], device=images.device).view(1, 1, -1, 1).expand_as(images)
+    return torch.cat([images, depth, images * depth], dim=1)
 
 
 def _compose_processing_pipeline(depth, aug=None):
@@ -173,21 +124,12 @@ def _compose_processing_pipeline(depth, aug=None):
     if depth == "patch":
         steps.append(_add_depth)
 
-    steps.append(_to_torch)
-    steps.append(_expand_dims_if_necessary)
     steps.reverse()
     return compose(*steps)
 
 
-def _generate_batches(h, w, ps, patch_size, stride, batch_size=64):
-    hdc_wdx_generator = itertools.product(range(0, h - patch_size + ps, stride), range(0, w - patch_size + ps, stride),)
-    for batch_indexes in itertoolz.partition_all(batch_size, hdc_wdx_generator):
-        yield batch_indexes
-
-
 @curry
 def _output_processing_pipeline(config, output):
-    output = output.unsqueeze(0)
     _, _, h, w = output.shape
     if config.TEST.POST_PROCESSING.SIZE != h or config.TEST.POST_PROCESSING.SIZE != w:
         output = F.interpolate(
@@ -202,98 +144,162 @@ def _output_processing_pipeline(config, output):
             config.TEST.POST_PROCESSING.CROP_PIXELS : h - config.TEST.POST_PROCESSING.CROP_PIXELS,
             config.TEST.POST_PROCESSING.CROP_PIXELS : w - config.TEST.POST_PROCESSING.CROP_PIXELS,
         ]
-    return output.squeeze()
+    return output
 
 
-def _patch_label_2d(
-    model, img, pre_processing, output_processing, patch_size, stride, batch_size, device, num_classes,
-):
-    """Processes a whole section
+@curry
+def to_image(label_mask, n_classes=6):
+    # NHWC colours in [0, 255]
+    return np.moveaxis(decode_segmap(label_mask, n_classes=n_classes, dtype=np.uint8), 1, -1)
+
+
+def _resume_export(test_set, predictions, running_metrics):
+    """Indices of the sections of the test set left to predict
+
+    The labels exported by an interrupted run are added to the running metrics instead of being predicted again.
     """
-    img = torch.squeeze(img)
-    h, w = img.shape[-2], img.shape[-1]  # height and width
-
-    # Pad image with patch_size/2:
-    ps = int(np.floor(patch_size / 2))  # pad size
-    img_p = F.pad(img, pad=(ps, ps, ps, ps), mode="constant", value=0)
-    output_p = torch.zeros([1, num_classes, h + 2 * ps, w + 2 * ps])
-
-    # generate output:
-    for batch_indexes in _generate_batches(h, w, ps, patch_size, stride, batch_size=batch_size):
-        batch = torch.stack(
-            [pipe(img_p, _extract_patch(hdx, wdx, ps, patch_size), pre_processing,) for hdx, wdx in batch_indexes],
-            dim=0,
-        )
+    indices = []
+    for index, section in enumerate(test_set.sections):
+        if not predictions.done(section):
+            indices.append(index)
+            continue
+        _, labels = test_set[index]
+        pred = predictions.read(section)[np.newaxis]
+        for metrics in running_metrics:
+            metrics.update(labels.numpy(), pred)
+    return indices
+
+
+def _seismic_identity(config, split):
+    # cached scores are only valid for the seismic they were computed from, regenerating it changes its mtime
+    seismic_path = storage_path(
+        path.join(config.DATASET.ROOT, "test_once", split + "_seismic.npy"), config.DATASET.STORAGE
+    )
+    stat = os.stat(seismic_path)
+    return digest(path.abspath(seismic_path), stat.st_size, stat.st_mtime_ns)[:16]
 
-        model_output = model(batch.to(device))
-        for (hdx, wdx), output in zip(batch_indexes, model_output.detach().cpu()):
-            output = output_processing(output)
-            output_p[:, :, hdx + ps : hdx + ps + patch_size, wdx + ps : wdx + ps + patch_size,] += output
 
-    # crop the output_p in the middle
-    output = output_p[:, :, ps:-ps, ps:-ps]
-    return output
+def _cache_key(split, seismic, section):
+    return f"{split}_{seismic}_{section_id(section)}"
 
 
-@curry
-def to_image(label_mask, n_classes=6):
-    label_colours = get_seismic_labels()
-    r = label_mask.copy()
-    g = label_mask.copy()
-    b = label_mask.copy()
-    for ll in range(0, n_classes):
-        r[label_mask == ll] = label_colours[ll, 0]
-        g[label_mask == ll] = label_colours[ll, 1]
-        b[label_mask == ll] = label_colours[ll, 2]
-    rgb = np.zeros((label_mask.shape[0], label_mask.shape[1], label_mask.shape[2], 3))
-    rgb[:, :, :, 0] = r
-    rgb[:, :, :, 1] = g
-    rgb[:, :, :, 2] = b
-    return rgb
+def _read_cache(test_set, indices, cache, split, seismic, record):
+    """Indices of the sections left to score, the sections whose scores are in the cache are recorded right away"""
+    misses = []
+    for index in indices:
+        scores = cache.get(_cache_key(split, seismic, test_set.sections[index]))
+        if scores is None:
+            misses.append(index)
+            continue
+        _, labels = test_set[index]
+        record(index, scores, labels.numpy())
+    return misses
 
 
 def _evaluate_split(
-    split, section_aug, model, pre_processing, output_processing, device, running_metrics_overall, config, debug=False
+    split,
+    section_aug,
+    model,
+    pre_processing,
+    output_processing,
+    device,
+    running_metrics_overall,
+    config,
+    debug=False,
+    cache=None,
+    scores_digest=None,
 ):
     logger = logging.getLogger(__name__)
 
     TestSectionLoader = get_test_loader(config)
-    test_set = TestSectionLoader(config.DATASET.ROOT, split=split, is_transform=True, augmentations=section_aug,)
+    test_set = TestSectionLoader(
+        config.DATASET.ROOT,
+        split=split,
+        is_transform=True,
+        augmentations=section_aug,
+        storage=config.DATASET.STORAGE,
+    )
 
     n_classes = test_set.n_classes
 
-    test_loader = data.DataLoader(test_set, batch_size=1, num_workers=config.WORKERS, shuffle=False)
+    running_metrics_split = runningScore(n_classes)
+
+    # the predicted labels are written section by section and the sections exported already are skipped
+    predictions = None
+    indices = list(range(len(test_set)))
+    if config.TEST.EXPORT_DIR or cache is not None:
+        seismic = _seismic_identity(config, split)
+    if config.TEST.EXPORT_DIR:
+        os.makedirs(config.TEST.EXPORT_DIR, exist_ok=True)
+        # only labels predicted with the same weights, config values and seismic are resumed
+        provenance = digest(scores_digest, seismic)
+        predictions = SectionPredictions(config.TEST.EXPORT_DIR, split, test_set.labels.shape, provenance=provenance)
+        indices = _resume_export(test_set, predictions, [running_metrics_split, running_metrics_overall])
+        logger.info(f"Exporting {split} to {config.TEST.EXPORT_DIR}, {len(test_set) - len(indices)} sections done")
+
+    def _record(index, scores, gt):
+        pred = scores.argmax(1)
+        running_metrics_split.update(gt, pred)
+        running_metrics_overall.update(gt, pred)
+        if predictions is not None:
+            predictions.write(test_set.sections[index], pred[0])
+
+    if cache is not None:
+        n_sections = len(indices)
+        indices = _read_cache(test_set, indices, cache, split, seismic, _record)
+        logger.info(f"Scores of {n_sections - len(indices)} of {n_sections} sections of {split} read from the cache")
+
+    test_loader = data.DataLoader(
+        data.Subset(test_set, indices),
+        batch_size=1,
+        num_workers=config.WORKERS,
+        shuffle=False,
+        pin_memory=device.type == "cuda",
+    )
 
     if debug:
         logger.info("Running in Debug/Test mode")
         test_loader = take(1, test_loader)
 
-    running_metrics_split = runningScore(n_classes)
+    # the labels of the sections whose windows are being scored
+    section_labels = {}
+
+    def _sections():
+        for index, (images, labels) in zip(indices, test_loader):
+            section_labels[index] = labels
+            yield index, torch.squeeze(images).to(device, non_blocking=True)
+
+    # loads the sections and cuts out and pre-processes their patches while the model runs
+    prefetcher = Prefetcher(config.TEST.PREFETCH) if config.TEST.PREFETCH > 0 else None
 
     # testing mode:
     with torch.no_grad():  # operations inside don't track history
         model.eval()
-        total_iteration = 0
-        for i, (images, labels) in enumerate(test_loader):
+        # patches of consecutive sections share batches, and the sections are scored as their last batch comes out
+        for i, outputs in predict_sliding_windows(
+            model,
+            _sections(),
+            config.TRAIN.PATCH_SIZE,
+            config.TEST.TEST_STRIDE,
+            config.VALIDATION.BATCH_SIZE_PER_GPU,
+            n_classes,
+            pre_processing=pre_processing,
+            output_processing=output_processing,
+            prefetcher=prefetcher,
+        ):
             logger.info(f"split: {split}, section: {i}")
-            total_iteration = total_iteration + 1
-
-            outputs = _patch_label_2d(
-                model,
-                images,
-                pre_processing,
-                output_processing,
-                config.TRAIN.PATCH_SIZE,
-                config.TEST.TEST_STRIDE,
-                config.VALIDATION.BATCH_SIZE_PER_GPU,
-                device,
-                n_classes,
-            )
-
-            pred = outputs.detach().max(1)[1].numpy()
-            gt = labels.numpy()
-            running_metrics_split.update(gt, pred)
-            running_metrics_overall.update(gt, pred)
+            scores = outputs.detach().cpu().numpy()
+            if cache is not None:
+                scores = cache.put(_cache_key(split, seismic, test_set.sections[i]), scores)
+            _record(i, scores, section_labels.pop(i).numpy())
+
+    if prefetcher is not None:
+        # waiting for batches means the model is input bound, waiting for room in the queue that it is compute bound
+        stats = prefetcher.stats()
+        logger.info(
+            f"Prefetched batches: {stats['items']}, mean queue depth: {stats['mean_queue_depth']:.2f}, "
+            f"input stalls: {stats['input_stall_time']:.1f}s, compute stalls: {stats['compute_stall_time']:.1f}s"
+        )
 
     # get scores
     score, class_iou = running_metrics_split.get_scores()
@@ -309,7 +315,7 @@ def _evaluate_split(
     running_metrics_split.reset()
 
 
-def _write_section_file(labels, section_file):
+def _write_section_file(labels, splits_path, split_name):
     # define indices of the array
     irange, xrange, depth = labels.shape
 
@@ -327,9 +333,24 @@ def _write_section_file(labels, section_file):
 
     list_test = i_list + x_list
 
-    file_object = open(section_file, "w")
-    file_object.write("\n".join(list_test))
-    file_object.close()
+    write_split(splits_path, split_name, list_test)
+
+
+def _scores_fingerprint(config):
+    # the config values the scores of the sections depend on, the post-processing is applied to every patch. The
+    # seismic files themselves go into the keys of the sections, see _seismic_identity
+    return digest(
+        config.MODEL.dump(),
+        config.DATASET.ROOT,
+        config.DATASET.STORAGE,
+        config.TRAIN.MEAN,
+        config.TRAIN.STD,
+        config.TRAIN.DEPTH,
+        config.TRAIN.PATCH_SIZE,
+        config.TRAIN.AUGMENTATIONS.dump(),
+        config.TEST.TEST_STRIDE,
+        config.TEST.POST_PROCESSING.dump(),
+    )
 
 
 def test(*options, cfg=None, debug=False):
@@ -349,19 +370,28 @@ def test(*options, cfg=None, debug=False):
 
     running_metrics_overall = runningScore(n_classes)
 
+    # the weights and the config values going into the scores, exported labels and cached scores are only reused by
+    # runs with the same ones
+    scores_digest = None
+    if config.TEST.EXPORT_DIR or config.TEST.CACHE.DIR:
+        scores_digest = digest(file_digest(config.TEST.MODEL_PATH), _scores_fingerprint(config))
+
+    cache = None
+    if config.TEST.CACHE.DIR:
+        cache = PredictionCache(config.TEST.CACHE.DIR, scores_digest, int(config.TEST.CACHE.MAX_GB * 2 ** 30))
+
     # Augmentation
     section_aug = Compose([Normalize(mean=(config.TRAIN.MEAN,), std=(config.TRAIN.STD,), max_pixel_value=1,)])
 
-    patch_aug = Compose(
+    # applied to whole batches of patches on the device
+    patch_aug = tensor_augmentations.Compose(
         [
-            Resize(
-                config.TRAIN.AUGMENTATIONS.RESIZE.HEIGHT, config.TRAIN.AUGMENTATIONS.RESIZE.WIDTH, always_apply=True,
+            tensor_augmentations.Resize(
+                config.TRAIN.AUGMENTATIONS.RESIZE.HEIGHT, config.TRAIN.AUGMENTATIONS.RESIZE.WIDTH
             ),
-            PadIfNeeded(
+            tensor_augmentations.PadIfNeeded(
                 min_height=config.TRAIN.AUGMENTATIONS.PAD.HEIGHT,
                 min_width=config.TRAIN.AUGMENTATIONS.PAD.WIDTH,
-                border_mode=cv2.BORDER_CONSTANT,
-                always_apply=True,
                 mask_value=255,
             ),
         ]
@@ -373,8 +403,7 @@ def test(*options, cfg=None, debug=False):
     splits = ["test1", "test2"] if "Both" in config.TEST.SPLIT else [config.TEST.SPLIT]
     for sdx, split in enumerate(splits):
         labels = np.load(path.join(config.DATASET.ROOT, "test_once", split + "_labels.npy"))
-        section_file = path.join(config.DATASET.ROOT, "splits", "section_" + split + ".txt")
-        _write_section_file(labels, section_file)
+        _write_section_file(labels, path.join(config.DATASET.ROOT, "splits"), "section_" + split)
         _evaluate_split(
             split,
             section_aug,
@@ -385,8 +414,13 @@ def test(*options, cfg=None, debug=False):
             running_metrics_overall,
             config,
             debug=debug,
+            cache=cache,
+            scores_digest=scores_digest,
         )
 
+    if cache is not None:
+        logger.info(f"Cache hits: {cache.hits}, misses: {cache.misses}, size: {cache.size() / 2 ** 30:.2f}GB")
+
     # FINAL TEST RESULTS:
     score, class_iou = running_metrics_overall.get_scores()
 
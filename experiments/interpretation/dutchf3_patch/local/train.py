@@ -17,19 +17,21 @@ import logging
 import logging.config
 from os import path
 
-import cv2
 import fire
 import numpy as np
 import torch
-from albumentations import Compose, HorizontalFlip, Normalize, PadIfNeeded, Resize
 from ignite.contrib.handlers import CosineAnnealingScheduler
 from ignite.engine import Events
 from ignite.metrics import Loss
 from ignite.utils import convert_tensor
-from toolz import compose
-from torch.utils import data
 
-from deepseismic_interpretation.dutchf3.data import get_patch_loader, decode_segmap
+from deepseismic_interpretation.dutchf3.data import (
+    ClassBalancedSampler,
+    RandomPatchLoader,
+    get_batch_loader,
+    get_patch_loader,
+    get_random_patch_loader,
+)
 from cv_lib.utils import load_log_configuration
 from cv_lib.event_handlers import (
     SnapshotHandler,
@@ -39,9 +41,11 @@ from cv_lib.event_handlers import (
 from cv_lib.event_handlers.logging_handlers import Evaluator
 from cv_lib.event_handlers.tensorboard_handlers import (
     create_image_writer,
+    create_segmentation_image_writer,
     create_summary_writer,
 )
 from cv_lib.segmentation import models, extract_metric_from
+from cv_lib.segmentation.tensor_augmentations import Compose, HorizontalFlip, Normalize, PadIfNeeded, Resize
 from cv_lib.segmentation.dutchf3.engine import (
     create_supervised_evaluator,
     create_supervised_trainer,
@@ -60,7 +64,6 @@ from cv_lib.segmentation.dutchf3.utils import (
     generate_path,
     git_branch,
     git_hash,
-    np_to_tb,
 )
 
 from default import _C as config
@@ -109,25 +112,19 @@ def run(*options, cfg=None, debug=False):
         torch.cuda.manual_seed_all(config.SEED)
     np.random.seed(seed=config.SEED)
 
-    # Setup Augmentations
+    # Setup Augmentations, they work on whole batches of tensors
     basic_aug = Compose(
         [
             Normalize(mean=(config.TRAIN.MEAN,), std=(config.TRAIN.STD,), max_pixel_value=1),
             PadIfNeeded(
                 min_height=config.TRAIN.PATCH_SIZE,
                 min_width=config.TRAIN.PATCH_SIZE,
-                border_mode=cv2.BORDER_CONSTANT,
-                always_apply=True,
                 mask_value=255,
             ),
-            Resize(
-                config.TRAIN.AUGMENTATIONS.RESIZE.HEIGHT, config.TRAIN.AUGMENTATIONS.RESIZE.WIDTH, always_apply=True,
-            ),
+            Resize(config.TRAIN.AUGMENTATIONS.RESIZE.HEIGHT, config.TRAIN.AUGMENTATIONS.RESIZE.WIDTH),
             PadIfNeeded(
                 min_height=config.TRAIN.AUGMENTATIONS.PAD.HEIGHT,
                 min_width=config.TRAIN.AUGMENTATIONS.PAD.WIDTH,
-                border_mode=cv2.BORDER_CONSTANT,
-                always_apply=True,
                 mask_value=255,
             ),
         ]
@@ -140,13 +137,15 @@ def run(*options, cfg=None, debug=False):
 
     TrainPatchLoader = get_patch_loader(config)
 
+    # random patches are drawn from the volume as they are needed, so they don't need the patch split
     train_set = TrainPatchLoader(
         config.DATASET.ROOT,
-        split="train",
+        split=None if config.TRAIN.RANDOM_PATCHES else "train",
         is_transform=True,
         stride=config.TRAIN.STRIDE,
         patch_size=config.TRAIN.PATCH_SIZE,
-        augmentations=train_aug,
+        batch_augmentations=train_aug,
+        storage=config.DATASET.STORAGE,
     )
     logger.info(train_set)
     val_set = TrainPatchLoader(
@@ -155,15 +154,35 @@ def run(*options, cfg=None, debug=False):
         is_transform=True,
         stride=config.TRAIN.STRIDE,
         patch_size=config.TRAIN.PATCH_SIZE,
-        augmentations=val_aug,
+        batch_augmentations=val_aug,
+        storage=config.DATASET.STORAGE,
     )
     logger.info(val_set)
     n_classes = train_set.n_classes
 
-    train_loader = data.DataLoader(
-        train_set, batch_size=config.TRAIN.BATCH_SIZE_PER_GPU, num_workers=config.WORKERS, shuffle=True,
-    )
-    val_loader = data.DataLoader(val_set, batch_size=config.VALIDATION.BATCH_SIZE_PER_GPU, num_workers=config.WORKERS,)
+    if config.TRAIN.RANDOM_PATCHES:
+        random_patches = RandomPatchLoader(
+            train_set,
+            config.TRAIN.BATCH_SIZE_PER_GPU,
+            split="train",
+            num_batches=config.TRAIN.BATCHES_PER_EPOCH,
+            class_balanced=config.TRAIN.CLASS_BALANCED_SAMPLING,
+        )
+        train_loader = get_random_patch_loader(random_patches, num_workers=config.WORKERS)
+    else:
+        # class balanced sampling draws the patches holding rare classes more often instead of shuffling
+        train_sampler = None
+        if config.TRAIN.CLASS_BALANCED_SAMPLING:
+            train_sampler = ClassBalancedSampler(train_set.class_histograms)
+
+        train_loader = get_batch_loader(
+            train_set,
+            batch_size=config.TRAIN.BATCH_SIZE_PER_GPU,
+            num_workers=config.WORKERS,
+            shuffle=True,
+            sampler=train_sampler,
+        )
+    val_loader = get_batch_loader(val_set, batch_size=config.VALIDATION.BATCH_SIZE_PER_GPU, num_workers=config.WORKERS,)
 
     model = getattr(models, config.MODEL.NAME).get_seg_model(config)
 
@@ -202,6 +221,9 @@ def run(*options, cfg=None, debug=False):
     trainer.add_event_handler(
         Events.ITERATION_COMPLETED, logging_handlers.log_training_output(log_interval=config.PRINT_FREQ),
     )
+    trainer.add_event_handler(
+        Events.ITERATION_COMPLETED, logging_handlers.log_process_memory(log_interval=config.PRINT_FREQ),
+    )
     trainer.add_event_handler(Events.EPOCH_STARTED, logging_handlers.log_lr(optimizer))
     trainer.add_event_handler(
         Events.EPOCH_STARTED, tensorboard_handlers.log_lr(summary_writer, optimizer, "epoch"),
@@ -262,26 +284,16 @@ def run(*options, cfg=None, debug=False):
         ),
     )
 
-    def _select_max(pred_tensor):
-        return pred_tensor.max(1)[1]
-
-    def _tensor_to_numpy(pred_tensor):
-        return pred_tensor.squeeze().cpu().numpy()
-
-    transform_func = compose(np_to_tb, decode_segmap(n_classes=n_classes), _tensor_to_numpy)
-
-    transform_pred = compose(transform_func, _select_max)
-
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED, create_image_writer(summary_writer, "Validation/Image", "image"),
     )
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED,
-        create_image_writer(summary_writer, "Validation/Mask", "mask", transform_func=transform_func),
+        create_segmentation_image_writer(summary_writer, "Validation/Mask", "mask", n_classes),
     )
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED,
-        create_image_writer(summary_writer, "Validation/Pred", "y_pred", transform_func=transform_pred),
+        create_segmentation_image_writer(summary_writer, "Validation/Pred", "y_pred", n_classes, select_max=True),
     )
 
     def snapshot_function():
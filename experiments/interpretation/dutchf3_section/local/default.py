@@ -33,6 +33,7 @@ _C.DATASET = CN()
 _C.DATASET.ROOT = "/mnt/dutchf3"
 _C.DATASET.NUM_CLASSES = 6
 _C.DATASET.CLASS_WEIGHTS = [0.7151, 0.8811, 0.5156, 0.9346, 0.9683, 0.9852]
+_C.DATASET.STORAGE = "float32"  # float32, float16 or int8, see scripts/prepare_dutchf3.py reduced_precision
 
 # common params for NETWORK
 _C.MODEL = CN()
@@ -53,6 +54,7 @@ _C.TRAIN.WEIGHT_DECAY = 0.0001
 _C.TRAIN.SNAPSHOTS = 5
 _C.TRAIN.MODEL_DIR = "models"  # This will be a subdirectory inside OUTPUT_DIR
 _C.TRAIN.AUGMENTATION = True
+_C.TRAIN.CLASS_BALANCED_SAMPLING = False  # needs the class histograms written by scripts/prepare_dutchf3.py
 _C.TRAIN.MEAN = 0.0009997  # 0.0009996710808862074
 _C.TRAIN.STD = 0.20977  # 0.20976548783479299
 _C.TRAIN.DEPTH = "none"  # Options are 'none', 'patch' and 'section'
@@ -71,6 +73,10 @@ _C.TEST.TEST_STRIDE = 10
 _C.TEST.SPLIT = "Both"  # Can be Both, Test1, Test2
 _C.TEST.INLINE = True
 _C.TEST.CROSSLINE = True
+_C.TEST.EXPORT_DIR = ""  # writes the predicted labels there, resuming where an interrupted run left off
+_C.TEST.CACHE = CN()  # scores of the sections kept on disk for runs with the same checkpoint and inputs
+_C.TEST.CACHE.DIR = ""  # no cache when empty
+_C.TEST.CACHE.MAX_GB = 10.0  # least recently used scores are removed past this size
 
 
 def update_config(cfg, options=None, config_file=None):
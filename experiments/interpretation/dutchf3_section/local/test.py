@@ -18,10 +18,17 @@ import fire
 import numpy as np
 import torch
 from albumentations import Compose, Normalize
+from cv_lib.prediction_cache import PredictionCache, digest, file_digest
 from cv_lib.utils import load_log_configuration
 from cv_lib.segmentation import models
 
-from deepseismic_interpretation.dutchf3.data import get_test_loader
+from deepseismic_interpretation.dutchf3.data import (
+    SectionPredictions,
+    get_test_loader,
+    section_id,
+    storage_path,
+    write_split,
+)
 from default import _C as config
 from default import update_config
 from torch.utils import data
@@ -87,37 +94,113 @@ class runningScore(object):
         self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
 
 
-def _evaluate_split(split, section_aug, model, device, running_metrics_overall, config, debug=False):
+def _resume_export(test_set, predictions, running_metrics):
+    """Indices of the sections of the test set left to predict
+
+    The labels exported by an interrupted run are added to the running metrics instead of being predicted again.
+    """
+    indices = []
+    for index, section in enumerate(test_set.sections):
+        if not predictions.done(section):
+            indices.append(index)
+            continue
+        _, labels = test_set[index]
+        pred = predictions.read(section)[np.newaxis]
+        for metrics in running_metrics:
+            metrics.update(labels.numpy(), pred)
+    return indices
+
+
+def _seismic_identity(config, split):
+    # cached scores are only valid for the seismic they were computed from, regenerating it changes its mtime
+    seismic_path = storage_path(
+        path.join(config.DATASET.ROOT, "test_once", split + "_seismic.npy"), config.DATASET.STORAGE
+    )
+    stat = os.stat(seismic_path)
+    return digest(path.abspath(seismic_path), stat.st_size, stat.st_mtime_ns)[:16]
+
+
+def _cache_key(split, seismic, section):
+    return f"{split}_{seismic}_{section_id(section)}"
+
+
+def _read_cache(test_set, indices, cache, split, seismic, record):
+    """Indices of the sections left to score, the sections whose scores are in the cache are recorded right away"""
+    misses = []
+    for index in indices:
+        scores = cache.get(_cache_key(split, seismic, test_set.sections[index]))
+        if scores is None:
+            misses.append(index)
+            continue
+        _, labels = test_set[index]
+        record(index, scores, labels.numpy())
+    return misses
+
+
+def _evaluate_split(
+    split, section_aug, model, device, running_metrics_overall, config, debug=False, cache=None, scores_digest=None,
+):
     logger = logging.getLogger(__name__)
 
     TestSectionLoader = get_test_loader(config)
     test_set = TestSectionLoader(
-        data_dir=config.DATASET.ROOT, split=split, is_transform=True, augmentations=section_aug,
+        data_dir=config.DATASET.ROOT,
+        split=split,
+        is_transform=True,
+        augmentations=section_aug,
+        storage=config.DATASET.STORAGE,
     )
 
     n_classes = test_set.n_classes
 
-    test_loader = data.DataLoader(test_set, batch_size=1, num_workers=config.WORKERS, shuffle=False)
+    running_metrics_split = runningScore(n_classes)
+
+    # the predicted labels are written section by section and the sections exported already are skipped
+    predictions = None
+    indices = list(range(len(test_set)))
+    if config.TEST.EXPORT_DIR or cache is not None:
+        seismic = _seismic_identity(config, split)
+    if config.TEST.EXPORT_DIR:
+        os.makedirs(config.TEST.EXPORT_DIR, exist_ok=True)
+        # only labels predicted with the same weights, config values and seismic are resumed
+        provenance = digest(scores_digest, seismic)
+        predictions = SectionPredictions(config.TEST.EXPORT_DIR, split, test_set.labels.shape, provenance=provenance)
+        indices = _resume_export(test_set, predictions, [running_metrics_split, running_metrics_overall])
+        logger.info(f"Exporting {split} to {config.TEST.EXPORT_DIR}, {len(test_set) - len(indices)} sections done")
+
+    def _record(index, scores, gt):
+        pred = scores.argmax(1)
+        running_metrics_split.update(gt, pred)
+        running_metrics_overall.update(gt, pred)
+        if predictions is not None:
+            predictions.write(test_set.sections[index], pred[0])
+
+    if cache is not None:
+        n_sections = len(indices)
+        indices = _read_cache(test_set, indices, cache, split, seismic, _record)
+        logger.info(f"Scores of {n_sections - len(indices)} of {n_sections} sections of {split} read from the cache")
+
+    test_loader = data.DataLoader(
+        data.Subset(test_set, indices), batch_size=1, num_workers=config.WORKERS, shuffle=False
+    )
     if debug:
         logger.info("Running in Debug/Test mode")
         test_loader = take(1, test_loader)
 
-    running_metrics_split = runningScore(n_classes)
-
     # testing mode:
     with torch.no_grad():  # operations inside don't track history
         model.eval()
         total_iteration = 0
-        for i, (images, labels) in enumerate(test_loader):
+        for i, (images, labels) in zip(indices, test_loader):
             logger.info(f"split: {split}, section: {i}")
             total_iteration = total_iteration + 1
 
             outputs = model(images.to(device))
 
-            pred = outputs.detach().max(1)[1].cpu().numpy()
-            gt = labels.numpy()
-            running_metrics_split.update(gt, pred)
-            running_metrics_overall.update(gt, pred)
+            scores = outputs.detach().cpu().numpy()
+            if cache is not None:
+                scores = cache.put(_cache_key(split, seismic, test_set.sections[i]), scores)
+            _record(i, scores, labels.numpy())
 
     # get scores
     score, class_iou = running_metrics_split.get_scores()
@@ -133,7 +216,7 @@ def _evaluate_split(split, section_aug, model, device, running_metrics_overall,
     running_metrics_split.reset()
 
 
-def _write_section_file(labels, section_file):
+def _write_section_file(labels, splits_path, split_name):
     # define indices of the array
     irange, xrange, depth = labels.shape
 
@@ -151,9 +234,20 @@ def _write_section_file(labels, section_file):
 
     list_test = i_list + x_list
 
-    file_object = open(section_file, "w")
-    file_object.write("\n".join(list_test))
-    file_object.close()
+    write_split(splits_path, split_name, list_test)
+
+
+def _scores_fingerprint(config):
+    # the config values the scores of the sections depend on, the seismic files themselves go into the keys of the
+    # sections, see _seismic_identity
+    return digest(
+        config.MODEL.dump(),
+        config.DATASET.ROOT,
+        config.DATASET.STORAGE,
+        config.TRAIN.MEAN,
+        config.TRAIN.STD,
+        config.TRAIN.DEPTH,
+    )
 
 
 def test(*options, cfg=None, debug=False):
@@ -173,6 +267,16 @@ def test(*options, cfg=None, debug=False):
 
     running_metrics_overall = runningScore(n_classes)
 
+    # the weights and the config values going into the scores, exported labels and cached scores are only reused by
+    # runs with the same ones
+    scores_digest = None
+    if config.TEST.EXPORT_DIR or config.TEST.CACHE.DIR:
+        scores_digest = digest(file_digest(config.TEST.MODEL_PATH), _scores_fingerprint(config))
+
+    cache = None
+    if config.TEST.CACHE.DIR:
+        cache = PredictionCache(config.TEST.CACHE.DIR, scores_digest, int(config.TEST.CACHE.MAX_GB * 2 ** 30))
+
     # Augmentation
     section_aug = Compose([Normalize(mean=(config.TRAIN.MEAN,), std=(config.TRAIN.STD,), max_pixel_value=1,)])
 
@@ -180,9 +284,21 @@ def test(*options, cfg=None, debug=False):
 
     for sdx, split in enumerate(splits):
         labels = np.load(path.join(config.DATASET.ROOT, "test_once", split + "_labels.npy"))
-        section_file = path.join(config.DATASET.ROOT, "splits", "section_" + split + ".txt")
-        _write_section_file(labels, section_file)
-        _evaluate_split(split, section_aug, model, device, running_metrics_overall, config, debug=debug)
+        _write_section_file(labels, path.join(config.DATASET.ROOT, "splits"), "section_" + split)
+        _evaluate_split(
+            split,
+            section_aug,
+            model,
+            device,
+            running_metrics_overall,
+            config,
+            debug=debug,
+            cache=cache,
+            scores_digest=scores_digest,
+        )
+
+    if cache is not None:
+        logger.info(f"Cache hits: {cache.hits}, misses: {cache.misses}, size: {cache.size() / 2 ** 30:.2f}GB")
 
     # FINAL TEST RESULTS:
     score, class_iou = running_metrics_overall.get_scores()
@@ -11,7 +11,7 @@ import numpy as np
 import torch
 from albumentations import Compose, HorizontalFlip, Normalize
 
-from deepseismic_interpretation.dutchf3.data import decode_segmap, get_section_loader
+from deepseismic_interpretation.dutchf3.data import ClassBalancedSampler, get_section_loader
 from cv_lib.utils import load_log_configuration
 from cv_lib.event_handlers import (
     SnapshotHandler,
@@ -21,6 +21,7 @@ from cv_lib.event_handlers import (
 from cv_lib.event_handlers.logging_handlers import Evaluator
 from cv_lib.event_handlers.tensorboard_handlers import (
     create_image_writer,
+    create_segmentation_image_writer,
     create_summary_writer,
 )
 from cv_lib.segmentation import models, extract_metric_from
@@ -40,7 +41,6 @@ from cv_lib.segmentation.dutchf3.utils import (
     generate_path,
     git_branch,
     git_hash,
-    np_to_tb,
 )
 from default import _C as config
 from default import update_config
@@ -48,7 +48,6 @@ from ignite.contrib.handlers import CosineAnnealingScheduler
 from ignite.engine import Events
 from ignite.utils import convert_tensor
 from ignite.metrics import Loss
-from toolz import compose
 from torch.utils import data
 from toolz import take
 
@@ -103,17 +102,31 @@ def run(*options, cfg=None, debug=False):
 
     TrainLoader = get_section_loader(config)
 
-    train_set = TrainLoader(data_dir=config.DATASET.ROOT, split="train", is_transform=True, augmentations=train_aug,)
+    train_set = TrainLoader(
+        data_dir=config.DATASET.ROOT,
+        split="train",
+        is_transform=True,
+        augmentations=train_aug,
+        storage=config.DATASET.STORAGE,
+    )
 
-    val_set = TrainLoader(data_dir=config.DATASET.ROOT, split="val", is_transform=True, augmentations=val_aug,)
+    val_set = TrainLoader(
+        data_dir=config.DATASET.ROOT,
+        split="val",
+        is_transform=True,
+        augmentations=val_aug,
+        storage=config.DATASET.STORAGE,
+    )
 
     class CustomSampler(torch.utils.data.Sampler):
         def __init__(self, data_source):
             self.data_source = data_source
+            # first column of the split index holds the direction, 0 for inlines and 1 for crosslines
+            self.direction_indices = [np.flatnonzero(data_source[:, 0] == direction) for direction in (0, 1)]
 
         def __iter__(self):
-            char = ["i" if np.random.randint(2) == 1 else "x"]
-            self.indices = [idx for (idx, name) in enumerate(self.data_source) if char[0] in name]
+            direction = 0 if np.random.randint(2) == 1 else 1
+            self.indices = self.direction_indices[direction]
             return (self.indices[i] for i in torch.randperm(len(self.indices)))
 
         def __len__(self):
@@ -124,10 +137,15 @@ def run(*options, cfg=None, debug=False):
     val_list = val_set.sections
     train_list = val_set.sections
 
+    train_sampler = CustomSampler(train_list)
+    if config.TRAIN.CLASS_BALANCED_SAMPLING:
+        # draws the sections holding rare classes more often, still from a single direction per epoch
+        train_sampler = ClassBalancedSampler(train_set.class_histograms, directions=train_set.sections[:, 0])
+
     train_loader = data.DataLoader(
         train_set,
         batch_size=config.TRAIN.BATCH_SIZE_PER_GPU,
-        sampler=CustomSampler(train_list),
+        sampler=train_sampler,
         num_workers=config.WORKERS,
         shuffle=False,
     )
@@ -178,6 +196,9 @@ def run(*options, cfg=None, debug=False):
     trainer.add_event_handler(
         Events.ITERATION_COMPLETED, logging_handlers.log_training_output(log_interval=config.PRINT_FREQ),
     )
+    trainer.add_event_handler(
+        Events.ITERATION_COMPLETED, logging_handlers.log_process_memory(log_interval=config.PRINT_FREQ),
+    )
 
     trainer.add_event_handler(Events.EPOCH_STARTED, logging_handlers.log_lr(optimizer))
 
@@ -246,28 +267,18 @@ def run(*options, cfg=None, debug=False):
         ),
     )
 
-    def _select_max(pred_tensor):
-        return pred_tensor.max(1)[1]
-
-    def _tensor_to_numpy(pred_tensor):
-        return pred_tensor.squeeze().cpu().numpy()
-
-    transform_func = compose(np_to_tb, decode_segmap(n_classes=n_classes), _tensor_to_numpy)
-
-    transform_pred = compose(transform_func, _select_max)
-
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED, create_image_writer(summary_writer, "Validation/Image", "image"),
     )
 
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED,
-        create_image_writer(summary_writer, "Validation/Mask", "mask", transform_func=transform_func),
+        create_segmentation_image_writer(summary_writer, "Validation/Mask", "mask", n_classes),
     )
 
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED,
-        create_image_writer(summary_writer, "Validation/Pred", "y_pred", transform_func=transform_pred),
+        create_segmentation_image_writer(summary_writer, "Validation/Pred", "y_pred", n_classes, select_max=True),
     )
 
     def snapshot_function():
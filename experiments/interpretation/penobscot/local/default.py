@@ -46,6 +46,7 @@ _C.DATASET.CLASS_WEIGHTS = [
 ]
 _C.DATASET.INLINE_HEIGHT = 1501
 _C.DATASET.INLINE_WIDTH = 481
+_C.DATASET.STORAGE = "float32"  # float32, float16 or int8, the data type the patches are held in memory as
 
 # common params for NETWORK
 _C.MODEL = CN()
@@ -28,6 +28,7 @@ from cv_lib.utils import load_log_configuration
 from cv_lib.event_handlers import logging_handlers, tensorboard_handlers
 from cv_lib.event_handlers.tensorboard_handlers import (
     create_image_writer,
+    create_segmentation_image_writer,
     create_summary_writer,
 )
 from cv_lib.segmentation import models
@@ -43,7 +44,6 @@ from cv_lib.segmentation.dutchf3.utils import (
     generate_path,
     git_branch,
     git_hash,
-    np_to_tb,
 )
 from cv_lib.segmentation.penobscot.engine import create_supervised_evaluator
 from deepseismic_interpretation.dutchf3.data import decode_segmap
@@ -168,6 +168,7 @@ def run(*options, cfg=None, debug=False):
         transforms=test_aug,
         n_channels=config.MODEL.IN_CHANNELS,
         complete_patches_only=config.TEST.COMPLETE_PATCHES_ONLY,
+        storage=config.DATASET.STORAGE,
     )
 
     logger.info(str(test_set))
@@ -258,27 +259,18 @@ def run(*options, cfg=None, debug=False):
         ),
     )
 
-    def _select_max(pred_tensor):
-        return pred_tensor.max(1)[1]
-
-    def _tensor_to_numpy(pred_tensor):
-        return pred_tensor.squeeze().cpu().numpy()
-
-    transform_func = compose(
-        np_to_tb, decode_segmap(n_classes=n_classes, label_colours=_SEG_COLOURS), _tensor_to_numpy,
-    )
-
-    transform_pred = compose(transform_func, _select_max)
-
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED, create_image_writer(summary_writer, "Test/Image", "image"),
     )
     evaluator.add_event_handler(
-        Events.EPOCH_COMPLETED, create_image_writer(summary_writer, "Test/Mask", "mask", transform_func=transform_func),
+        Events.EPOCH_COMPLETED,
+        create_segmentation_image_writer(summary_writer, "Test/Mask", "mask", n_classes, label_colours=_SEG_COLOURS),
     )
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED,
-        create_image_writer(summary_writer, "Test/Pred", "y_pred", transform_func=transform_pred),
+        create_segmentation_image_writer(
+            summary_writer, "Test/Pred", "y_pred", n_classes, label_colours=_SEG_COLOURS, select_max=True
+        ),
     )
 
     logger.info("Starting training")
@@ -295,7 +287,7 @@ def run(*options, cfg=None, debug=False):
     bottomk = (
         (inline_mean_iou.predictions[key], inline_mean_iou.masks[key]) for key, iou in tail(_BOTTOM_K, sorted_ious)
     )
-    stack_and_decode = compose(transform_func, torch.stack)
+    stack_and_decode = compose(decode_segmap(n_classes=n_classes, label_colours=_SEG_COLOURS), torch.stack)
     predictions, masks = unzip(chain(topk, bottomk))
     predictions_tensor = stack_and_decode(list(predictions))
     masks_tensor = stack_and_decode(list(masks))
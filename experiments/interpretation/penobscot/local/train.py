@@ -17,19 +17,16 @@ import logging
 import logging.config
 from os import path
 
-import cv2
 import fire
 import numpy as np
 import torch
-from albumentations import Compose, HorizontalFlip, Normalize, PadIfNeeded, Resize
 from ignite.contrib.handlers import CosineAnnealingScheduler
 from ignite.engine import Events
 from ignite.metrics import Loss
 from ignite.utils import convert_tensor
-from toolz import compose
+from toolz import curry
 from torch.utils import data
 
-from deepseismic_interpretation.dutchf3.data import decode_segmap
 from deepseismic_interpretation.penobscot.data import get_patch_dataset
 from cv_lib.utils import load_log_configuration
 from cv_lib.event_handlers import (
@@ -40,9 +37,11 @@ from cv_lib.event_handlers import (
 from cv_lib.event_handlers.logging_handlers import Evaluator
 from cv_lib.event_handlers.tensorboard_handlers import (
     create_image_writer,
+    create_segmentation_image_writer,
     create_summary_writer,
 )
 from cv_lib.segmentation import models, extract_metric_from
+from cv_lib.segmentation.tensor_augmentations import Compose, HorizontalFlip, Normalize, PadIfNeeded, Resize
 from cv_lib.segmentation.penobscot.engine import (
     create_supervised_evaluator,
     create_supervised_trainer,
@@ -59,7 +58,6 @@ from cv_lib.segmentation.dutchf3.utils import (
     generate_path,
     git_branch,
     git_hash,
-    np_to_tb,
 )
 
 from default import _C as config
@@ -73,14 +71,15 @@ _SEG_COLOURS = np.asarray(
 )
 
 
-def _prepare_batch(batch, device=None, non_blocking=False):
+@curry
+def _prepare_batch(augmentations, batch, device=None, non_blocking=False):
+    # the augmentations run on the whole batch once it is on the device
     x, y, ids, patch_locations = batch
-    return (
+    x, y = augmentations(
         convert_tensor(x, device=device, non_blocking=non_blocking),
         convert_tensor(y, device=device, non_blocking=non_blocking),
-        ids,
-        patch_locations,
     )
+    return x, y, ids, patch_locations
 
 
 def run(*options, cfg=None, debug=False):
@@ -120,26 +119,14 @@ def run(*options, cfg=None, debug=False):
     if torch.cuda.is_available():
         device = "cuda"
 
-    # Setup Augmentations
+    # Setup Augmentations, they work on whole batches of tensors
     basic_aug = Compose(
         [
             Normalize(mean=(config.TRAIN.MEAN,), std=(config.TRAIN.STD,), max_pixel_value=config.TRAIN.MAX,),
-            PadIfNeeded(
-                min_height=config.TRAIN.PATCH_SIZE,
-                min_width=config.TRAIN.PATCH_SIZE,
-                border_mode=cv2.BORDER_CONSTANT,
-                always_apply=True,
-                mask_value=mask_value,
-                value=0,
-            ),
-            Resize(
-                config.TRAIN.AUGMENTATIONS.RESIZE.HEIGHT, config.TRAIN.AUGMENTATIONS.RESIZE.WIDTH, always_apply=True,
-            ),
+            Resize(config.TRAIN.AUGMENTATIONS.RESIZE.HEIGHT, config.TRAIN.AUGMENTATIONS.RESIZE.WIDTH),
             PadIfNeeded(
                 min_height=config.TRAIN.AUGMENTATIONS.PAD.HEIGHT,
                 min_width=config.TRAIN.AUGMENTATIONS.PAD.WIDTH,
-                border_mode=cv2.BORDER_CONSTANT,
-                always_apply=True,
                 mask_value=mask_value,
                 value=0,
             ),
@@ -152,15 +139,18 @@ def run(*options, cfg=None, debug=False):
         train_aug = val_aug = basic_aug
 
     PenobscotDataset = get_patch_dataset(config)
+    # incomplete patches are padded in the dataset, before Normalize, with the value Normalize takes to 0
+    pad_value = config.TRAIN.MEAN * config.TRAIN.MAX
 
     train_set = PenobscotDataset(
         config.DATASET.ROOT,
         config.TRAIN.PATCH_SIZE,
         config.TRAIN.STRIDE,
         split="train",
-        transforms=train_aug,
         n_channels=config.MODEL.IN_CHANNELS,
         complete_patches_only=config.TRAIN.COMPLETE_PATCHES_ONLY,
+        storage=config.DATASET.STORAGE,
+        pad_value=pad_value,
     )
 
     val_set = PenobscotDataset(
@@ -168,9 +158,10 @@ def run(*options, cfg=None, debug=False):
         config.TRAIN.PATCH_SIZE,
         config.TRAIN.STRIDE,
         split="val",
-        transforms=val_aug,
         n_channels=config.MODEL.IN_CHANNELS,
         complete_patches_only=config.VALIDATION.COMPLETE_PATCHES_ONLY,
+        storage=config.DATASET.STORAGE,
+        pad_value=pad_value,
     )
     logger.info(train_set)
     logger.info(val_set)
@@ -208,7 +199,7 @@ def run(*options, cfg=None, debug=False):
 
     criterion = torch.nn.CrossEntropyLoss(weight=class_weights, ignore_index=mask_value, reduction="mean")
 
-    trainer = create_supervised_trainer(model, optimizer, criterion, _prepare_batch, device=device)
+    trainer = create_supervised_trainer(model, optimizer, criterion, _prepare_batch(train_aug), device=device)
 
     trainer.add_event_handler(Events.ITERATION_STARTED, scheduler)
 
@@ -228,7 +219,7 @@ def run(*options, cfg=None, debug=False):
 
     evaluator = create_supervised_evaluator(
         model,
-        _prepare_batch,
+        _prepare_batch(val_aug),
         metrics={
             "pixacc": pixelwise_accuracy(n_classes, output_transform=_select_pred_and_mask),
             "nll": Loss(criterion, output_transform=_select_pred_and_mask),
@@ -273,28 +264,20 @@ def run(*options, cfg=None, debug=False):
         ),
     )
 
-    def _select_max(pred_tensor):
-        return pred_tensor.max(1)[1]
-
-    def _tensor_to_numpy(pred_tensor):
-        return pred_tensor.squeeze().cpu().numpy()
-
-    transform_func = compose(
-        np_to_tb, decode_segmap(n_classes=n_classes, label_colours=_SEG_COLOURS), _tensor_to_numpy,
-    )
-
-    transform_pred = compose(transform_func, _select_max)
-
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED, create_image_writer(summary_writer, "Validation/Image", "image"),
     )
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED,
-        create_image_writer(summary_writer, "Validation/Mask", "mask", transform_func=transform_func),
+        create_segmentation_image_writer(
+            summary_writer, "Validation/Mask", "mask", n_classes, label_colours=_SEG_COLOURS
+        ),
     )
     evaluator.add_event_handler(
         Events.EPOCH_COMPLETED,
-        create_image_writer(summary_writer, "Validation/Pred", "y_pred", transform_func=transform_pred),
+        create_segmentation_image_writer(
+            summary_writer, "Validation/Pred", "y_pred", n_classes, label_colours=_SEG_COLOURS, select_max=True
+        ),
     )
 
     def snapshot_function():
@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import functools
 import itertools
 import warnings
 import segyio
@@ -13,16 +14,15 @@ import numpy as np
 import torch
 from toolz import curry
 from torch.utils import data
+from cv_lib.utils import peak_memory
 import logging
 from deepseismic_interpretation.dutchf3.utils.batch import (
     interpolate_to_fit_data,
     parse_labels_in_image,
     get_coordinates_for_slice,
-    get_grid,
-    augment_flip,
-    augment_rot_xy,
-    augment_rot_z,
-    augment_stretch,
+    affine_grids,
+    augmentation_matrix,
+    interpolation_backend,
     rand_int,
     trilinear_interpolation,
 )
@@ -52,13 +52,452 @@ def _test2_labels_for(data_dir):
     return path.join(data_dir, "test_once", "test2_labels.npy")
 
 
-def readSEGY(filename):
+# Direction codes stored in the first column of the binary split index
+_DIRECTION_CODES = {"i": 0, "x": 1}
+_IN_INLINE_DIRECTION, _IN_CROSSLINE_DIRECTION = _DIRECTION_CODES["i"], _DIRECTION_CODES["x"]
+_DIRECTION_NAMES = {_IN_INLINE_DIRECTION: "inline", _IN_CROSSLINE_DIRECTION: "crossline"}
+
+
+def _splits_path_for(data_dir):
+    return path.join(data_dir, "splits")
+
+
+def parse_split_ids(ids):
+    """Convert section or patch ids to the binary split index
+
+    Sections are named direction_number (e.g. i_12) and patches direction_inline_crossline_depth (e.g. x_0_34_56),
+    both become one row of [direction, inline, crossline, depth offset] where direction is 0 for inlines and
+    1 for crosslines.
+
+    Args:
+        ids (iterable[str]): section or patch ids
+
+    Returns:
+        numpy.ndarray: Nx4 int32 index
+    """
+    rows = []
+    for id_ in ids:
+        direction, *offsets = id_.strip().split("_")
+        offsets = [int(offset) for offset in offsets]
+        if len(offsets) == 1:  # sections only store the inline or the crossline
+            offsets = [offsets[0], 0, 0] if direction == "i" else [0, offsets[0], 0]
+        rows.append([_DIRECTION_CODES[direction]] + offsets)
+    return np.array(rows, dtype=np.int32).reshape(-1, 4)
+
+
+def section_id(section):
+    """Name of a section from its row of the split index, e.g. i_12 for inline 12, the way parse_split_ids reads it
+
+    Args:
+        section (numpy.ndarray): [direction, inline, crossline, depth offset] row of the split index
+
+    Returns:
+        str: direction_number id of the section
+    """
+    direction, inline, crossline, _ = (int(offset) for offset in section)
+    return f"i_{inline}" if direction == _IN_INLINE_DIRECTION else f"x_{crossline}"
+
+
+def write_split(splits_path, name, ids, labels=None, patch_size=None):
+    """Write a split as the human readable text file as well as the binary index the loaders read
+
+    Args:
+        splits_path (str): directory to write to
+        name (str): name of the split, e.g. patch_train
+        ids (list[str]): section or patch ids
+        labels (numpy.ndarray, optional): label volume. When given the class histogram of every section or
+            patch is written next to the index for ClassBalancedSampler. Defaults to None.
+        patch_size (int, optional): height and width of the patches, None for sections. Defaults to None.
+    """
+    with open(path.join(splits_path, name + ".txt"), "w") as f:
+        f.write("\n".join(ids))
+    index = parse_split_ids(ids)
+    np.save(path.join(splits_path, name + ".npy"), index)
+    if labels is not None:
+        np.save(_histograms_path_for(splits_path, name), class_histograms(labels, index, patch_size=patch_size))
+
+
+def load_split(splits_path, name, mmap=True):
+    """Load the binary index of a split
+
+    Falls back to parsing the text file for splits that were generated before the binary index existed.
+
+    Args:
+        splits_path (str): directory holding the splits
+        name (str): name of the split, e.g. patch_train
+        mmap (bool, optional): memory-map the index read-only. Defaults to True.
+
+    Returns:
+        numpy.ndarray: Nx4 int32 index of [direction, inline, crossline, depth offset]
+    """
+    index_path = path.join(splits_path, name + ".npy")
+    if path.exists(index_path):
+        return load_volume(index_path, mmap=mmap)
+
+    logger = logging.getLogger(__name__)
+    logger.warning(f"No binary index found for {name}, parsing the text file. Regenerate the splits to create it")
+    with open(path.join(splits_path, name + ".txt"), "r") as f:
+        return parse_split_ids(line for line in f if line.strip())
+
+
+def _histograms_path_for(splits_path, name):
+    return path.join(splits_path, name + "_histograms.npy")
+
+
+def class_histograms(labels, index, patch_size=None, n_classes=6, chunk_size=1024, xline_labels=None):
+    """Count the pixels of every class in each section or patch of a split
+
+    Labels outside of [0, n_classes), e.g. the padding of patches running off the volume, are not counted.
+
+    Args:
+        labels (numpy.ndarray): inline x crossline x depth label volume
+        index (numpy.ndarray): Nx4 split index, see parse_split_ids
+        patch_size (int, optional): height and width of the patches, None for sections. Defaults to None.
+        n_classes (int, optional): number of classes. Defaults to 6.
+        chunk_size (int, optional): number of patches gathered at once. Defaults to 1024.
+        xline_labels (numpy.ndarray, optional): crossline-major copy of labels to read the crossline patches
+            from. Defaults to None.
+
+    Returns:
+        numpy.ndarray: N x n_classes int64 pixel counts
+    """
+    histograms = np.zeros((len(index), n_classes), dtype=np.int64)
+    if patch_size is None:
+        for row, (direction, inline, crossline, _) in enumerate(index):
+            section = labels[inline] if direction == _IN_INLINE_DIRECTION else labels[:, crossline]
+            section = section[(section >= 0) & (section < n_classes)].astype(np.intp)
+            histograms[row] = np.bincount(section, minlength=n_classes)
+        return histograms
+
+    for start in range(0, len(index), chunk_size):
+        patches = np.asarray(index[start : start + chunk_size])
+        lbl, inside = _gather_patches(labels, patches, patch_size, xline_volume=xline_labels)
+        valid = inside & (lbl >= 0) & (lbl < n_classes)
+        # offset the labels of every patch so that one bincount fills all their histograms
+        rows = np.broadcast_to(np.arange(len(patches))[:, np.newaxis, np.newaxis], lbl.shape)
+        counts = np.bincount((rows * n_classes + lbl.astype(np.intp))[valid], minlength=len(patches) * n_classes)
+        histograms[start : start + len(patches)] = counts.reshape(len(patches), n_classes)
+    return histograms
+
+
+def load_class_histograms(splits_path, name, mmap=True):
+    """Load the class histograms written by write_split
+
+    Args:
+        splits_path (str): directory holding the splits
+        name (str): name of the split, e.g. patch_train
+        mmap (bool, optional): memory-map the histograms read-only. Defaults to True.
+
+    Returns:
+        numpy.ndarray: N x n_classes pixel counts or None when the split was written without them
+    """
+    histograms_path = _histograms_path_for(splits_path, name)
+    return load_volume(histograms_path, mmap=mmap) if path.exists(histograms_path) else None
+
+
+def _class_balanced_weights(class_histograms, class_frequencies=None):
+    # mean inverse class frequency over the labelled pixels of every section or patch
+    histograms = np.asarray(class_histograms, dtype=np.float64)
+    if class_frequencies is None:
+        class_frequencies = histograms.sum(axis=0) / max(histograms.sum(), 1)
+    inverse_frequencies = np.divide(
+        1.0, class_frequencies, out=np.zeros_like(class_frequencies), where=class_frequencies > 0
+    )
+    pixels = histograms.sum(axis=1)
+    return np.divide(histograms @ inverse_frequencies, pixels, out=np.zeros_like(pixels), where=pixels > 0)
+
+
+class ClassBalancedSampler(data.Sampler):
+    """Draw sections or patches with replacement, weighted by how rare the classes they contain are
+
+    The weight of a section or patch is the mean over its pixels of the inverse frequency of their class in the
+    whole split, so patches holding rare classes like the zechstein or the scruff are drawn more often.
+
+    Args:
+        class_histograms (numpy.ndarray): N x n_classes pixel counts, see load_class_histograms
+        num_samples (int, optional): samples drawn per epoch. Defaults to N.
+        directions (numpy.ndarray, optional): direction column of the split index. When given all samples of
+            an epoch are drawn from one randomly chosen direction, for sections whose shapes differ between
+            inlines and crosslines. Defaults to None.
+    """
+
+    def __init__(self, class_histograms, num_samples=None, directions=None):
+        if class_histograms is None:
+            raise ValueError("No class histograms found for the split, regenerate it with scripts/prepare_dutchf3.py")
+
+        weights = _class_balanced_weights(class_histograms)
+        self.weights = torch.as_tensor(weights)
+        self.num_samples = len(weights) if num_samples is None else num_samples
+        self.directions = None if directions is None else torch.as_tensor(np.asarray(directions))
+
+    def __iter__(self):
+        weights = self.weights
+        if self.directions is not None:
+            direction = self.directions[torch.randint(len(self.directions), (1,))]
+            weights = torch.where(self.directions == direction, weights, torch.zeros_like(weights))
+        return iter(torch.multinomial(weights, self.num_samples, replacement=True).tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def load_volume(filename, mmap=True):
+    """Load a seismic or label volume that was saved with np.save
+
+    Memory-mapped volumes are read-only views onto the OS page cache. The train and val loaders as well as
+    every DataLoader worker that open the same file therefore share a single copy of the cube in RAM
+    instead of each holding a private one.
+
+    Args:
+        filename (str): location of the .npy file
+        mmap (bool, optional): memory-map the file read-only instead of reading it into memory.
+            Defaults to True.
+
+    Returns:
+        numpy.ndarray: the volume, a read-only numpy.memmap when mmap is True
+    """
+    return np.load(filename, mmap_mode="r" if mmap else None)
+
+
+# Data types the seismic volumes can be stored as. int8 volumes are scaled by a per-volume factor
+STORAGE_TYPES = ("float32", "float16", "int8")
+
+
+def storage_path(filename, storage):
+    """Location of the copy of a float32 volume stored as the given data type"""
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage {storage}. Valid values: {', '.join(STORAGE_TYPES)}")
+    if storage == "float32":
+        return filename
+    root, ext = path.splitext(filename)
+    return root + "_" + storage + ext
+
+
+def _scale_for(filename):
+    root, _ = path.splitext(filename)
+    return root + "_scale.npy"
+
+
+def write_reduced_precision_volume(filename, storage):
+    """Write a float16 or int8 copy of a float32 volume next to it
+
+    int8 volumes are scaled symmetrically by the largest absolute amplitude so that nothing is clipped,
+    the scale is saved alongside the copy.
+
+    Args:
+        filename (str): location of the float32 .npy file
+        storage (str): float16 or int8
+
+    Returns:
+        str: location of the copy
+    """
+    volume = load_volume(filename)
+    storage_filename = storage_path(filename, storage)
+    stored = np.lib.format.open_memmap(storage_filename, mode="w+", dtype=np.dtype(storage), shape=volume.shape)
+    scale = 1.0
+    if storage == "int8":
+        scale = max(float(np.abs(inline).max()) for inline in volume) / np.iinfo(np.int8).max or 1.0
+        np.save(_scale_for(storage_filename), np.float32(scale))
+    for inline in range(volume.shape[0]):  # keeps memory bounded by a single inline section
+        stored[inline] = np.rint(volume[inline] / scale) if storage == "int8" else volume[inline]
+    stored.flush()
+    return storage_filename
+
+
+def load_volume_scale(filename):
+    """Load the factor the stored values of a volume have to be multiplied by
+
+    Args:
+        filename (str): location of the .npy file
+
+    Returns:
+        float: the scale of int8 volumes and 1 for all others
+    """
+    scale_filename = _scale_for(filename)
+    return float(np.load(scale_filename)) if path.exists(scale_filename) else 1.0
+
+
+def _dequantise(image_array, scale):
+    # float32 slices are passed on untouched so they stay lazy views of the memory map
+    if image_array.dtype == np.float32:
+        return image_array
+    return np.multiply(image_array, np.float32(scale), dtype=np.float32)
+
+
+def _xline_for(filename):
+    root, ext = path.splitext(filename)
+    return root + "_xline" + ext
+
+
+def write_xline_volume(filename):
+    """Write a crossline-major copy of an inline x crossline x depth volume next to it
+
+    Crosslines are strided reads of the inline-major volume, in the copy they are contiguous. The loaders
+    pick the copy up automatically and read crossline sections and patches from it.
+
+    Args:
+        filename (str): location of the .npy file
+
+    Returns:
+        str: location of the crossline-major copy
+    """
+    volume = load_volume(filename)
+    xline_filename = _xline_for(filename)
+    xline_volume = np.lib.format.open_memmap(
+        xline_filename, mode="w+", dtype=volume.dtype, shape=(volume.shape[1], volume.shape[0]) + volume.shape[2:],
+    )
+    for inline in range(volume.shape[0]):  # keeps memory bounded by a single inline section
+        xline_volume[:, inline] = volume[inline]
+    xline_volume.flush()
+    return xline_filename
+
+
+def load_xline_volume(filename, mmap=True):
+    """Load the crossline-major copy of a volume written by write_xline_volume
+
+    A copy that does not have the transposed shape of the volume, or is older than the volume, e.g. left over
+    from before the volume or its float16 or int8 copy was rewritten, is ignored with a warning so that the
+    loaders fall back to strided reads of the volume itself.
+
+    Args:
+        filename (str): location of the inline-major .npy file
+        mmap (bool, optional): memory-map the file read-only. Defaults to True.
+
+    Returns:
+        numpy.ndarray: crossline x inline x depth volume or None if there is no usable copy
+    """
+    xline_filename = _xline_for(filename)
+    if not path.exists(xline_filename):
+        return None
+    shape = load_volume(filename).shape
+    xline_volume = load_volume(xline_filename, mmap=mmap)
+    if xline_volume.shape != (shape[1], shape[0]) + shape[2:]:
+        warnings.warn(
+            f"Ignoring {xline_filename}, its shape {xline_volume.shape} is not the crossline-major shape of "
+            f"{filename} {shape}, write it again with write_xline_volume"
+        )
+        return None
+    if path.getmtime(xline_filename) < path.getmtime(filename):
+        warnings.warn(f"Ignoring {xline_filename}, it is older than {filename}, write it again with write_xline_volume")
+        return None
+    return xline_volume
+
+
+def _crossline_section(volume, xline_volume, crossline):
+    # inline x depth section, read from the crossline-major copy when there is one
+    return volume[:, crossline, :] if xline_volume is None else xline_volume[crossline]
+
+
+class SectionPredictions(object):
+    """Labels predicted section by section, written into uint8 volumes memory-mapped from .npy files
+
+    Inline and crossline sections go into separate inline x crossline x depth volumes, {name}_inline.npy and
+    {name}_crossline.npy, next to a manifest per direction, {name}_inline_manifest.npy and
+    {name}_crossline_manifest.npy, flagging the sections written so far. A section is flushed to disk before it
+    is flagged, so when a run is interrupted the sections flagged are complete and opening the same files again
+    picks up where it left off.
+
+    The provenance, e.g. a digest of the checkpoint, the config and the seismic the labels are predicted from, is
+    written to {name}_provenance.txt along with the volumes. Opening files written with another provenance, or
+    with none, raises, so that the labels of different runs are never mixed up.
+
+    Args:
+        export_dir (str): directory to write to
+        name (str): prefix of the files, e.g. the name of the split
+        shape (tuple): inline x crossline x depth shape of the volume the sections are cut out of
+        provenance (str, optional): what the labels are predicted from. Defaults to None, which doesn't check it.
+    """
+
+    def __init__(self, export_dir, name, shape, provenance=None):
+        self.shape = tuple(int(n) for n in shape)
+        if provenance is not None:
+            self._check_provenance(path.join(export_dir, name), str(provenance))
+        self.volumes, self.manifests = {}, {}
+        for direction, n_sections in ((_IN_INLINE_DIRECTION, self.shape[0]), (_IN_CROSSLINE_DIRECTION, self.shape[1])):
+            filename = path.join(export_dir, f"{name}_{_DIRECTION_NAMES[direction]}")
+            self.volumes[direction] = self._open(filename + ".npy", np.uint8, self.shape)
+            self.manifests[direction] = self._open(filename + "_manifest.npy", bool, (n_sections,))
+
+    @staticmethod
+    def _check_provenance(prefix, provenance):
+        filename = prefix + "_provenance.txt"
+        if path.exists(filename):
+            with open(filename, "r") as f:
+                written = f.read().strip()
+            if written != provenance:
+                raise ValueError(
+                    f"The labels in {prefix}_* are predicted from {written} instead of {provenance}, delete them or"
+                    f" export to another directory to start over"
+                )
+            return
+        if any(path.exists(f"{prefix}_{direction}.npy") for direction in _DIRECTION_NAMES.values()):
+            raise ValueError(
+                f"The labels in {prefix}_* were written without their provenance, delete them or export to another"
+                f" directory to start over"
+            )
+        # written before any section, so that flagged sections always have their provenance next to them
+        with open(filename, "w") as f:
+            f.write(provenance)
+
+    @staticmethod
+    def _open(filename, dtype, shape):
+        if not path.exists(filename):
+            return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+        array = np.load(filename, mmap_mode="r+")
+        if array.dtype != dtype or array.shape != shape:
+            raise ValueError(
+                f"{filename} holds a {array.dtype} array of shape {array.shape} instead of {np.dtype(dtype)} of shape"
+                f" {shape}, delete it to start over"
+            )
+        return array
+
+    def _locate(self, section):
+        # direction, number and the part of the volume of a [direction, inline, crossline, depth] index row
+        direction, inline, crossline, _ = (int(offset) for offset in section)
+        if direction == _IN_INLINE_DIRECTION:
+            return direction, inline, (inline, slice(None))
+        return direction, crossline, (slice(None), crossline)
+
+    def done(self, section):
+        """Whether the labels of a section of the split index were written"""
+        direction, number, _ = self._locate(section)
+        return bool(self.manifests[direction][number])
+
+    def write(self, section, labels):
+        """Write the depth x width labels of a section of the split index and flag it as done"""
+        direction, number, where = self._locate(section)
+        self.volumes[direction][where] = np.asarray(labels).T
+        self.volumes[direction].flush()
+        self.manifests[direction][number] = True
+        self.manifests[direction].flush()
+
+    def read(self, section):
+        """Depth x width labels written for a section of the split index"""
+        direction, _, where = self._locate(section)
+        return np.array(self.volumes[direction][where].T)
+
+    def progress(self):
+        """Number of sections written and number of sections for each direction, by direction name"""
+        return {
+            _DIRECTION_NAMES[direction]: (int(manifest.sum()), len(manifest))
+            for direction, manifest in self.manifests.items()
+        }
+
+
+def readSEGY(filename, out_filename=None):
     """[summary]
     Read the segy file and return the data as a numpy array and a dictionary describing what has been read in.
 
+    The traces are streamed one line at a time straight into a preallocated array with the temporal axis first,
+    so reading a cube takes about as much memory as the cube itself. With out_filename the cube is streamed into
+    a .npy file instead and returned memory-mapped, it then never has to fit into memory at all.
+
     Arguments:
         filename {str} -- .segy file location.
-    
+
+    Keyword Arguments:
+        out_filename {str} -- .npy file to write the cube to, None to keep it in memory (default: {None})
+
     Returns:
         [type] -- 3D segy data as numy array and a dictionary with metadata information
     """
@@ -66,28 +505,45 @@ def readSEGY(filename):
     # TODO: we really need to add logging to this repo
     print("Loading data cube from", filename, "with:")
 
-    # Read full data cube
-    data = segyio.tools.cube(filename)
-
-    # Put temporal axis first
-    data = np.moveaxis(data, -1, 0)
+    with segyio.open(filename, "r") as segyfile:
+        if len(segyfile.offsets) != 1:
+            raise ValueError(f"Only post-stack segy files are supported, {filename} has several offsets")
 
-    # Make data cube fast to acess
-    data = np.ascontiguousarray(data, "float32")
+        # traces are stored line by line along the fast dimension, like segyio.tools.cube lays them out
+        if segyfile.sorting == segyio.TraceSortingFormat.INLINE_SORTING:
+            n_fast, n_slow = len(segyfile.ilines), len(segyfile.xlines)
+        else:
+            n_fast, n_slow = len(segyfile.xlines), len(segyfile.ilines)
+        shape = (len(segyfile.samples), n_fast, n_slow)
 
-    # Read meta data
-    segyfile = segyio.open(filename, "r")
-    print("  Crosslines: ", segyfile.xlines[0], ":", segyfile.xlines[-1])
-    print("  Inlines:    ", segyfile.ilines[0], ":", segyfile.ilines[-1])
-    print("  Timeslices: ", "1", ":", data.shape[0])
+        print("  Crosslines: ", segyfile.xlines[0], ":", segyfile.xlines[-1])
+        print("  Inlines:    ", segyfile.ilines[0], ":", segyfile.ilines[-1])
+        print("  Timeslices: ", "1", ":", shape[0])
 
-    # Make dict with cube-info
-    data_info = {}
-    data_info["crossline_start"] = segyfile.xlines[0]
-    data_info["inline_start"] = segyfile.ilines[0]
-    data_info["timeslice_start"] = 1  # Todo: read this from segy
-    data_info["shape"] = data.shape
-    # Read dt and other params needed to do create a new
+        # Put temporal axis first
+        if out_filename is None:
+            data = np.empty(shape, dtype=np.float32)
+        else:
+            data = np.lib.format.open_memmap(out_filename, mode="w+", dtype=np.float32, shape=shape)
+        progress_step = max(int(np.ceil(n_fast / 10)), 1)
+        for line in range(n_fast):
+            data[:, line, :] = segyfile.trace.raw[line * n_slow : (line + 1) * n_slow].T
+            if (line + 1) % progress_step == 0 or line + 1 == n_fast:
+                print(f"  Read {line + 1} of {n_fast} lines")
+
+        # Make dict with cube-info
+        data_info = {}
+        data_info["crossline_start"] = segyfile.xlines[0]
+        data_info["inline_start"] = segyfile.ilines[0]
+        data_info["timeslice_start"] = 1  # Todo: read this from segy
+        data_info["shape"] = data.shape
+        # Read dt and other params needed to do create a new
+
+    if out_filename is not None:
+        data.flush()
+    memory = peak_memory()
+    if memory is not None:
+        print(f"  Peak memory: {memory / 2 ** 30:.2f} GB")
 
     return data, data_info
 
@@ -139,17 +595,17 @@ def read_labels(fname, data_info):
     # Get coordinates for slice
     coords = get_coordinates_for_slice(slice_type, slice_no, data_info)
 
-    # Loop through labels in label_img and append to label_coordinates
-    for cls in np.unique(label_img):
-        if cls > -1:
-            if str(cls) not in label_coordinates.keys():
-                label_coordinates[str(cls)] = np.array(np.zeros([3, 0]))
-            inds_with_cls = label_img == cls
-            cords_with_cls = coords[:, inds_with_cls.ravel()]
-            label_coordinates[str(cls)] = np.concatenate((label_coordinates[str(cls)], cords_with_cls), 1)
-            print(" ", str(np.sum(inds_with_cls)), "labels for class", str(cls))
-    if len(np.unique(label_img)) == 1:
-        print(" ", 0, "labels", str(cls))
+    # Group the coordinates of the labelled pixels by class in one pass, in the order of the pixels
+    labels = label_img.ravel()
+    labelled = labels > -1
+    order = np.argsort(labels[labelled], kind="stable")
+    classes, counts = np.unique(labels[labelled], return_counts=True)
+    cords_by_cls = np.split(coords[:, labelled][:, order], np.cumsum(counts)[:-1], axis=1)
+    for cls, count, cords_with_cls in zip(classes, counts, cords_by_cls):
+        label_coordinates[str(cls)] = cords_with_cls
+        print(" ", str(count), "labels for class", str(cls))
+    if len(classes) == 0:
+        print(" ", 0, "labels")
 
     # Add label_img to output
     label_imgs.append([label_img, slice_type, slice_no])
@@ -210,30 +666,16 @@ def get_random_batch(
     # figure out which class to sample for this datapoint
     class_ind = index // samples_per_class
 
-    # Start by getting a grid centered around (0,0,0)
-    grid = get_grid(im_size)
-
-    # Apply random flip
-    if random_flip:
-        grid = augment_flip(grid)
-
-    # Apply random rotations
-    if random_rot_xy:
-        grid = augment_rot_xy(grid, random_rot_xy)
-    if random_rot_z:
-        grid = augment_rot_z(grid, random_rot_z)
-
-    # Apply random stretch
-    if random_stretch:
-        grid = augment_stretch(grid, random_stretch)
+    # Random flip, rotations and stretch of a grid centered around (0,0,0) as a single matrix
+    matrix = augmentation_matrix(random_flip, random_stretch, random_rot_xy, random_rot_z)
 
     # Pick random location from the label_coordinates for this class:
     coords_for_class = label_coordinates[class_keys[class_ind]]
     random_index = rand_int(0, coords_for_class.shape[1])
     coord = coords_for_class[:, random_index : random_index + 1]
 
-    # Move grid to be centered around this location
-    grid += coord
+    # Transform the grid and center it around this location
+    grid = affine_grids(im_size, matrix[np.newaxis], coord.T)[0]
 
     # Interpolate samples at grid from the data:
     sample = trilinear_interpolation(data_cube, grid)
@@ -245,29 +687,91 @@ def get_random_batch(
     return batch, ret_labels
 
 
+def get_balanced_batch(
+    data_cube,
+    label_coordinates,
+    im_size,
+    batch_size,
+    random_flip=False,
+    random_stretch=None,
+    random_rot_xy=None,
+    random_rot_z=None,
+    interpolation="numpy",
+):
+    """
+    Returns a whole class balanced batch of augmented samples, the batched counterpart of get_random_batch
+
+    The augmentations of every sample are combined into one matrix, applied to the grids of the whole batch at
+    once with affine_grids, and the grids are interpolated with the numpy or torch interpolation backend.
+
+    Args:
+        data_cube: 3D numpy array with floating point velocity values
+        label_coordinates: 3D coordinates of the labeled training slice
+        im_size: size of the 3D voxel which we're cutting out around each label_coordinate
+        batch_size: size of the batch, split equally between the classes with any remainder going to the last one
+        random_flip: bool to perform random voxel flip
+        random_stretch: bool to enable random stretch
+        random_rot_xy: bool to enable random rotation of the voxel around dim-0 and dim-1
+        random_rot_z: bool to enable random rotation around dim-2
+        interpolation: interpolation backend, numpy or torch (grid_sample)
+
+    Returns:
+        a tuple of the float32 batch with dimension (batch, 1, im_size[0], im_size[1], im_size[2]) and the
+        associated labels as an int64 array of size (batch).
+    """
+    interpolate = interpolation_backend(interpolation)
+    if isinstance(im_size, int):
+        im_size = [im_size, im_size, im_size]
+
+    class_keys = list(label_coordinates)
+    n_classes = len(class_keys)
+    labels = np.minimum(np.arange(batch_size) // max(batch_size // n_classes, 1), n_classes - 1)
+
+    matrices = np.stack(
+        [augmentation_matrix(random_flip, random_stretch, random_rot_xy, random_rot_z) for _ in range(batch_size)]
+    )
+
+    # Center every grid around a random location of its class
+    offsets = np.empty((batch_size, 3))
+    for class_ind in range(n_classes):
+        in_class = labels == class_ind
+        coords_for_class = label_coordinates[class_keys[class_ind]]
+        random_indices = np.random.randint(0, coords_for_class.shape[1], size=in_class.sum())
+        offsets[in_class] = coords_for_class[:, random_indices].T
+
+    # Interpolate samples at the grids from the data:
+    samples = interpolate(data_cube, affine_grids(im_size, matrices, offsets))
+    return samples.reshape([batch_size, 1] + list(im_size)), labels.astype(np.int64)
+
+
 class SectionLoader(data.Dataset):
-    def __init__(self, data_dir, split="train", is_transform=True, augmentations=None):
+    def __init__(self, data_dir, split="train", is_transform=True, augmentations=None, mmap=True, storage="float32"):
         self.split = split
         self.data_dir = data_dir
         self.is_transform = is_transform
         self.augmentations = augmentations
+        self.mmap = mmap
+        self.storage = storage
+        self.scale = 1.0
         self.n_classes = 6
         self.sections = list()
+        self.class_histograms = None
+        self.seismic_xline = self.labels_xline = None
 
     def __len__(self):
         return len(self.sections)
 
     def __getitem__(self, index):
 
-        section_name = self.sections[index]
-        direction, number = section_name.split(sep="_")
+        direction, inline, crossline, _ = self.sections[index]
 
-        if direction == "i":
-            im = self.seismic[int(number), :, :]
-            lbl = self.labels[int(number), :, :]
-        elif direction == "x":
-            im = self.seismic[:, int(number), :]
-            lbl = self.labels[:, int(number), :]
+        if direction == _IN_INLINE_DIRECTION:
+            im = self.seismic[inline, :, :]
+            lbl = self.labels[inline, :, :]
+        elif direction == _IN_CROSSLINE_DIRECTION:
+            im = _crossline_section(self.seismic, self.seismic_xline, crossline)
+            lbl = _crossline_section(self.labels, self.labels_xline, crossline)
+        im = _dequantise(im, self.scale)
 
         im, lbl = _transform_WH_to_HW(im), _transform_WH_to_HW(lbl)
 
@@ -285,7 +789,54 @@ class SectionLoader(data.Dataset):
         lbl = np.expand_dims(lbl, 0)
         if len(img.shape) == 2:
             img = np.expand_dims(img, 0)
-        return torch.from_numpy(img).float(), torch.from_numpy(lbl).long()
+        # copy so that we never hand out views of a read-only memory-mapped volume
+        return torch.from_numpy(np.array(img, dtype=np.float32)), torch.from_numpy(np.array(lbl, dtype=np.int64))
+
+
+class VoxelCoordinates(object):
+    """Centres of the voxels at least window away from the sides of a cube, worked out from a flat index
+
+    Indexes like the list(itertools.product(x_list, y_list, z_list)) of the centres did, in the same order, but
+    nothing is stored: memory is constant and creating it is instant whatever the size of the cube.
+
+    Args:
+        shape: shape of the cube
+        window: distance of the centres from the sides of the cube
+        start (int, optional): first flat index covered. Defaults to 0.
+        stop (int, optional): flat index after the last one covered. Defaults to covering all of them.
+    """
+
+    def __init__(self, shape, window, start=0, stop=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.window = window
+        self.extents = tuple(max(n - 2 * window, 0) for n in self.shape)
+        n_voxels = self.extents[0] * self.extents[1] * self.extents[2]
+        self.start = start
+        self.stop = n_voxels if stop is None else min(stop, n_voxels)
+
+    def __len__(self):
+        return max(self.stop - self.start, 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Only contiguous ranges of voxel coordinates are supported")
+            return VoxelCoordinates(self.shape, self.window, self.start + start, self.start + max(start, stop))
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Voxel index {index} out of range for {len(self)} voxels")
+        x, yz = divmod(self.start + int(index), self.extents[1] * self.extents[2])
+        y, z = divmod(yz, self.extents[2])
+        return x + self.window, y + self.window, z + self.window
+
+    def shard(self, rank, world_size):
+        """Contiguous part of the coordinates for one of world_size processes, split like np.array_split"""
+        size, remainder = divmod(len(self), world_size)
+        start = rank * size + min(rank, remainder)
+        return self[start : start + size + (1 if rank < remainder else 0)]
 
 
 class VoxelLoader(data.Dataset):
@@ -315,23 +866,14 @@ class VoxelLoader(data.Dataset):
         self.labels = None
 
         if gen_coord_list:
-            # generate a list of coordinates to index the entire voxel
-            # memory footprint of this isn't large yet, so not need to wrap as a generator
-            nx, ny, nz = self.data.shape
-            x_list = range(self.window_size, nx - self.window_size)
-            y_list = range(self.window_size, ny - self.window_size)
-            z_list = range(self.window_size, nz - self.window_size)
-
-            print("-- generating coord list --")
-            # TODO: is there any way to use a generator with pyTorch data loader?
-            self.coord_list = list(itertools.product(x_list, y_list, z_list))
+            # coordinates to index the entire voxel, computed on the fly from the index
+            self.coord_list = VoxelCoordinates(self.data.shape, self.window_size)
 
     def __len__(self):
         return self.len
 
     def __getitem__(self, index):
 
-        # TODO: can we specify a pixel mathematically by index?
         pixel = self.coord_list[index]
         x, y, z = pixel
         # TODO: current bottleneck - can we slice out voxels any faster
@@ -355,41 +897,43 @@ class VoxelLoader(data.Dataset):
 
 
 class TrainSectionLoader(SectionLoader):
-    def __init__(self, data_dir, split="train", is_transform=True, augmentations=None):
+    def __init__(self, data_dir, split="train", is_transform=True, augmentations=None, mmap=True, storage="float32"):
         super(TrainSectionLoader, self).__init__(
-            data_dir, split=split, is_transform=is_transform, augmentations=augmentations,
+            data_dir, split=split, is_transform=is_transform, augmentations=augmentations, mmap=mmap, storage=storage,
         )
 
-        self.seismic = np.load(_train_data_for(self.data_dir))
-        self.labels = np.load(_train_labels_for(self.data_dir))
+        seismic_path = storage_path(_train_data_for(self.data_dir), self.storage)
+        self.seismic = load_volume(seismic_path, mmap=self.mmap)
+        self.scale = load_volume_scale(seismic_path)
+        self.labels = load_volume(_train_labels_for(self.data_dir), mmap=self.mmap)
+        self.seismic_xline = load_xline_volume(seismic_path, mmap=self.mmap)
+        self.labels_xline = load_xline_volume(_train_labels_for(self.data_dir), mmap=self.mmap)
 
-        # reading the file names for split
-        txt_path = path.join(self.data_dir, "splits", "section_" + split + ".txt")
-        file_list = tuple(open(txt_path, "r"))
-        file_list = [id_.rstrip() for id_ in file_list]
-        self.sections = file_list
+        # reading the index of the split
+        self.sections = load_split(_splits_path_for(self.data_dir), "section_" + split, mmap=self.mmap)
+        self.class_histograms = load_class_histograms(_splits_path_for(self.data_dir), "section_" + split)
 
 
 class TrainSectionLoaderWithDepth(TrainSectionLoader):
-    def __init__(self, data_dir, split="train", is_transform=True, augmentations=None):
+    def __init__(self, data_dir, split="train", is_transform=True, augmentations=None, mmap=True, storage="float32"):
         super(TrainSectionLoaderWithDepth, self).__init__(
-            data_dir, split=split, is_transform=is_transform, augmentations=augmentations,
+            data_dir, split=split, is_transform=is_transform, augmentations=augmentations, mmap=mmap, storage=storage,
         )
-        self.seismic = add_section_depth_channels(self.seismic)  # NCWH
 
     def __getitem__(self, index):
 
-        section_name = self.sections[index]
-        direction, number = section_name.split(sep="_")
+        direction, inline, crossline, _ = self.sections[index]
 
-        if direction == "i":
-            im = self.seismic[int(number), :, :, :]
-            lbl = self.labels[int(number), :, :]
-        elif direction == "x":
-            im = self.seismic[:, :, int(number), :]
-            lbl = self.labels[:, int(number), :]
+        if direction == _IN_INLINE_DIRECTION:
+            im = self.seismic[inline, :, :]
+            lbl = self.labels[inline, :, :]
+        elif direction == _IN_CROSSLINE_DIRECTION:
+            im = _crossline_section(self.seismic, self.seismic_xline, crossline)
+            lbl = _crossline_section(self.labels, self.labels_xline, crossline)
+        im = _dequantise(im, self.scale)
 
-            im = np.swapaxes(im, 0, 1)  # From WCH to CWH
+        # depth channels are built per section rather than for the whole volume up front
+        im = _add_section_depth(im, _depth_ramp(self.seismic.shape[-1]))  # CWH
 
         im, lbl = _transform_WH_to_HW(im), _transform_WH_to_HW(lbl)
 
@@ -407,7 +951,7 @@ class TrainSectionLoaderWithDepth(TrainSectionLoader):
 
 class TrainVoxelWaldelandLoader(VoxelLoader):
     def __init__(
-        self, root_path, filename, split="train", window_size=65, batch_size=None, len=None,
+        self, root_path, filename, split="train", window_size=65, batch_size=None, len=None, interpolation="numpy",
     ):
         super(TrainVoxelWaldelandLoader, self).__init__(
             root_path, filename, split=split, window_size=window_size, len=len
@@ -424,19 +968,20 @@ class TrainVoxelWaldelandLoader(VoxelLoader):
         self.class_imgs, self.coordinates = read_labels(label_fname, self.data_info)
 
         self.batch_size = batch_size if batch_size else 1
+        self.interpolation = interpolation
 
     def __getitem__(self, index):
-        # print(index)
-        batch, labels = get_random_batch(
+        # every item is a whole class balanced batch, len counts batches
+        batch, labels = get_balanced_batch(
             self.data,
             self.coordinates,
             self.window_size,
             self.batch_size,
-            index,
             random_flip=True,
             random_stretch=0.2,
             random_rot_xy=180,
             random_rot_z=15,
+            interpolation=self.interpolation,
         )
 
         return batch, labels
@@ -447,46 +992,51 @@ TrainVoxelLoaderWithDepth = TrainVoxelWaldelandLoader
 
 
 class TestSectionLoader(SectionLoader):
-    def __init__(self, data_dir, split="test1", is_transform=True, augmentations=None):
+    def __init__(self, data_dir, split="test1", is_transform=True, augmentations=None, mmap=True, storage="float32"):
         super(TestSectionLoader, self).__init__(
-            data_dir, split=split, is_transform=is_transform, augmentations=augmentations,
+            data_dir, split=split, is_transform=is_transform, augmentations=augmentations, mmap=mmap, storage=storage,
         )
 
         if "test1" in self.split:
-            self.seismic = np.load(_test1_data_for(self.data_dir))
-            self.labels = np.load(_test1_labels_for(self.data_dir))
+            seismic_path = storage_path(_test1_data_for(self.data_dir), self.storage)
+            self.seismic = load_volume(seismic_path, mmap=self.mmap)
+            self.scale = load_volume_scale(seismic_path)
+            self.labels = load_volume(_test1_labels_for(self.data_dir), mmap=self.mmap)
+            self.seismic_xline = load_xline_volume(seismic_path, mmap=self.mmap)
+            self.labels_xline = load_xline_volume(_test1_labels_for(self.data_dir), mmap=self.mmap)
         elif "test2" in self.split:
-            self.seismic = np.load(_test2_data_for(self.data_dir))
-            self.labels = np.load(_test2_labels_for(self.data_dir))
+            seismic_path = storage_path(_test2_data_for(self.data_dir), self.storage)
+            self.seismic = load_volume(seismic_path, mmap=self.mmap)
+            self.scale = load_volume_scale(seismic_path)
+            self.labels = load_volume(_test2_labels_for(self.data_dir), mmap=self.mmap)
+            self.seismic_xline = load_xline_volume(seismic_path, mmap=self.mmap)
+            self.labels_xline = load_xline_volume(_test2_labels_for(self.data_dir), mmap=self.mmap)
 
         # We are in test mode. Only read the given split. The other one might not
         # be available.
-        txt_path = path.join(self.data_dir, "splits", "section_" + split + ".txt")
-        file_list = tuple(open(txt_path, "r"))
-        file_list = [id_.rstrip() for id_ in file_list]
-        self.sections = file_list
+        self.sections = load_split(_splits_path_for(self.data_dir), "section_" + split, mmap=self.mmap)
 
 
 class TestSectionLoaderWithDepth(TestSectionLoader):
-    def __init__(self, data_dir, split="test1", is_transform=True, augmentations=None):
+    def __init__(self, data_dir, split="test1", is_transform=True, augmentations=None, mmap=True, storage="float32"):
         super(TestSectionLoaderWithDepth, self).__init__(
-            data_dir, split=split, is_transform=is_transform, augmentations=augmentations,
+            data_dir, split=split, is_transform=is_transform, augmentations=augmentations, mmap=mmap, storage=storage,
         )
-        self.seismic = add_section_depth_channels(self.seismic)  # NCWH
 
     def __getitem__(self, index):
 
-        section_name = self.sections[index]
-        direction, number = section_name.split(sep="_")
+        direction, inline, crossline, _ = self.sections[index]
 
-        if direction == "i":
-            im = self.seismic[int(number), :, :, :]
-            lbl = self.labels[int(number), :, :]
-        elif direction == "x":
-            im = self.seismic[:, :, int(number), :]
-            lbl = self.labels[:, int(number), :]
+        if direction == _IN_INLINE_DIRECTION:
+            im = self.seismic[inline, :, :]
+            lbl = self.labels[inline, :, :]
+        elif direction == _IN_CROSSLINE_DIRECTION:
+            im = _crossline_section(self.seismic, self.seismic_xline, crossline)
+            lbl = _crossline_section(self.labels, self.labels_xline, crossline)
+        im = _dequantise(im, self.scale)
 
-            im = np.swapaxes(im, 0, 1)  # From WCH to CWH
+        # depth channels are built per section rather than for the whole volume up front
+        im = _add_section_depth(im, _depth_ramp(self.seismic.shape[-1]))  # CWH
 
         im, lbl = _transform_WH_to_HW(im), _transform_WH_to_HW(lbl)
 
@@ -516,17 +1066,90 @@ def _transform_WH_to_HW(numpy_array):
     return np.swapaxes(numpy_array, -2, -1)
 
 
+def _is_batch_index(index):
+    return isinstance(index, (list, tuple, np.ndarray, torch.Tensor))
+
+
+def _centred_offsets(start, extent, size):
+    """Coordinates of a patch window along one axis, centring windows that run off the end of the volume the
+    way PadIfNeeded does
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): coordinates clipped to the volume and a mask of the ones inside it
+    """
+    length = np.minimum(size, extent - start)
+    positions = np.arange(size) - (size - length) // 2
+    valid = (positions >= 0) & (positions < length)
+    return start + np.clip(positions, 0, length - 1), valid
+
+
+def _gather_patches(volume, patches, patch_size, xline_volume=None):
+    """Read a batch of inline and crossline patches with a single fancy-indexing call
+
+    Args:
+        volume (numpy.ndarray): inline x crossline x depth volume
+        patches (numpy.ndarray): Nx4 rows of the split index
+        patch_size (int): height and width of the patches
+        xline_volume (numpy.ndarray, optional): crossline-major copy of volume. When given the crossline
+            patches are read from it. Defaults to None.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): NxHxW patches and the mask of the pixels inside the volume
+    """
+    if xline_volume is not None:
+        in_crossline = patches[:, 0] == _IN_CROSSLINE_DIRECTION
+        # crossline patches are inline patches of the crossline-major copy
+        swapped = patches[in_crossline][:, [0, 2, 1, 3]]
+        swapped[:, 0] = _IN_INLINE_DIRECTION
+
+        im = np.empty((len(patches), patch_size, patch_size), dtype=volume.dtype)
+        inside = np.empty(im.shape, dtype=bool)
+        im[~in_crossline], inside[~in_crossline] = _gather_patches(volume, patches[~in_crossline], patch_size)
+        im[in_crossline], inside[in_crossline] = _gather_patches(xline_volume, swapped, patch_size)
+        return im, inside
+
+    direction, inline, crossline, depth = (patches[:, column, np.newaxis] for column in range(4))
+    in_crossline = direction == _IN_CROSSLINE_DIRECTION
+    # the width runs along the crosslines for inline patches and along the inlines for crossline patches
+    width, width_valid = _centred_offsets(
+        np.where(in_crossline, inline, crossline), np.where(in_crossline, volume.shape[0], volume.shape[1]), patch_size,
+    )
+    height, height_valid = _centred_offsets(depth, volume.shape[2], patch_size)
+
+    width, in_crossline = width[:, np.newaxis, :], in_crossline[:, np.newaxis]
+    inlines = np.where(in_crossline, width, inline[:, np.newaxis])
+    crosslines = np.where(in_crossline, crossline[:, np.newaxis], width)
+    inside = height_valid[:, :, np.newaxis] & width_valid[:, np.newaxis, :]
+    return volume[inlines, crosslines, height[:, :, np.newaxis]], inside
+
+
 class PatchLoader(data.Dataset):
     """
         Data loader for the patch-based deconvnet
     """
 
-    def __init__(self, data_dir, stride=30, patch_size=99, is_transform=True, augmentations=None):
+    def __init__(
+        self,
+        data_dir,
+        stride=30,
+        patch_size=99,
+        is_transform=True,
+        augmentations=None,
+        mmap=True,
+        storage="float32",
+        batch_augmentations=None,
+    ):
         self.data_dir = data_dir
         self.is_transform = is_transform
         self.augmentations = augmentations
+        self.batch_augmentations = batch_augmentations
+        self.mmap = mmap
+        self.storage = storage
+        self.scale = 1.0
         self.n_classes = 6
         self.patches = list()
+        self.class_histograms = None
+        self.seismic_xline = self.labels_xline = None
         self.patch_size = patch_size
         self.stride = stride
 
@@ -540,9 +1163,10 @@ class PatchLoader(data.Dataset):
         return len(self.patches)
 
     def __getitem__(self, index):
+        if _is_batch_index(index):
+            return self.get_batch(index)
 
-        patch_name = self.patches[index]
-        direction, idx, xdx, ddx = patch_name.split(sep="_")
+        direction, idx, xdx, ddx = self.patches[index]
 
         # Shift offsets the padding that is added in training
         # shift = self.patch_size if "test" not in self.split else 0
@@ -550,12 +1174,15 @@ class PatchLoader(data.Dataset):
         shift = 0
         idx, xdx, ddx = int(idx) + shift, int(xdx) + shift, int(ddx) + shift
 
-        if direction == "i":
+        if direction == _IN_INLINE_DIRECTION:
             im = self.seismic[idx, xdx : xdx + self.patch_size, ddx : ddx + self.patch_size]
             lbl = self.labels[idx, xdx : xdx + self.patch_size, ddx : ddx + self.patch_size]
-        elif direction == "x":
-            im = self.seismic[idx : idx + self.patch_size, xdx, ddx : ddx + self.patch_size]
-            lbl = self.labels[idx : idx + self.patch_size, xdx, ddx : ddx + self.patch_size]
+        elif direction == _IN_CROSSLINE_DIRECTION:
+            im = _crossline_section(self.seismic, self.seismic_xline, xdx)
+            lbl = _crossline_section(self.labels, self.labels_xline, xdx)
+            im = im[idx : idx + self.patch_size, ddx : ddx + self.patch_size]
+            lbl = lbl[idx : idx + self.patch_size, ddx : ddx + self.patch_size]
+        im = _dequantise(im, self.scale)
 
         im, lbl = _transform_WH_to_HW(im), _transform_WH_to_HW(lbl)
 
@@ -567,18 +1194,152 @@ class PatchLoader(data.Dataset):
             im, lbl = self.transform(im, lbl)
         return im, lbl
 
+    def get_batch(self, indices):
+        """Fetch a whole batch of patches at once
+
+        All patches are gathered from the volume with one fancy-indexing call into a contiguous array instead of
+        being sliced, transposed and collated one by one. Patches running off the end of the volume are handed to
+        the augmentations cut down to the part inside the volume, like single patches are, so that their
+        PadIfNeeded pads them after the normalisation. Without augmentations they are padded with 0 for the image
+        and 255 for the mask. batch_augmentations, e.g. cv_lib.segmentation.tensor_augmentations, are only applied
+        here since they work on the whole batch at once.
+
+        Args:
+            indices (list[int]): indices of the patches in the batch
+
+        Returns:
+            (torch.Tensor, torch.Tensor): BxCxHxW images and Bx1xHxW labels when is_transform is set,
+                numpy arrays otherwise
+        """
+        return self.get_patches(self.patches[np.asarray(indices)])
+
+    def get_patches(self, patches):
+        """Fetch a batch of patches given by their rows of the split index, see get_batch
+
+        Args:
+            patches (numpy.ndarray): Nx4 rows of [direction, inline, crossline, depth offset]
+
+        Returns:
+            (torch.Tensor, torch.Tensor): BxCxHxW images and Bx1xHxW labels when is_transform is set,
+                numpy arrays otherwise
+        """
+        im, lbl, inside = self._gather_batch(patches)
+
+        if self.augmentations is not None or self.batch_augmentations is not None:
+            im, lbl = self._augment_batch(im, lbl, inside)
+
+        if self.is_transform:
+            im, lbl = self.transform_batch(im, lbl)
+        return im, lbl
+
+    def _gather_batch(self, patches):
+        im, inside = _gather_patches(self.seismic, patches, self.patch_size, xline_volume=self.seismic_xline)
+        lbl, _ = _gather_patches(self.labels, patches, self.patch_size, xline_volume=self.labels_xline)
+        im = _dequantise(im, self.scale)
+        im[~inside] = 0
+        lbl[~inside] = 255
+        return im, lbl, inside
+
+    def _augment_batch(self, images, masks, inside):
+        """Applies the augmentations to every patch of a gathered batch
+
+        Patches that run off the end of the volume are cut down to the part inside of it, the way they are sliced
+        out for single patches, and augmented together with the other patches of the same extent.
+        """
+        if inside.all():
+            return self._augment_patches(images, masks)
+
+        # the rows and columns inside the volume are contiguous, see _centred_offsets
+        rows, columns = inside.any(axis=2), inside.any(axis=1)
+        extents = np.stack([rows.argmax(axis=1), rows.sum(axis=1), columns.argmax(axis=1), columns.sum(axis=1)], 1)
+        extents, groups = np.unique(extents, axis=0, return_inverse=True)
+        images_out, masks_out = None, None
+        for group, (top, height, left, width) in enumerate(extents):
+            members = np.flatnonzero(groups.ravel() == group)
+            im, lbl = self._augment_patches(
+                np.ascontiguousarray(images[members][..., top : top + height, left : left + width]),
+                np.ascontiguousarray(masks[members][..., top : top + height, left : left + width]),
+            )
+            if images_out is None:
+                images_out = np.empty((len(images),) + im.shape[1:], dtype=im.dtype)
+                masks_out = np.empty((len(masks),) + lbl.shape[1:], dtype=lbl.dtype)
+            if im.shape[1:] != images_out.shape[1:]:
+                raise ValueError(
+                    f"Augmented patches of shape {im.shape[1:]} and {images_out.shape[1:]} can't be batched, pad "
+                    "the patches that run off the volume to patch_size with PadIfNeeded"
+                )
+            images_out[members], masks_out[members] = im, lbl
+        return images_out, masks_out
+
+    def _augment_patches(self, images, masks):
+        """Applies the augmentations to patches of the same size
+
+        Images with channels are passed in as BxCxHxW. batch_augmentations get the whole batch as BxCxHxW
+        and Bx1xHxW tensors, otherwise every image is handed to the augmentations as HWC
+        """
+        if self.batch_augmentations is not None:
+            has_channels = images.ndim == 4
+            images, masks = self.batch_augmentations(
+                torch.from_numpy(images if has_channels else images[:, np.newaxis]),
+                torch.from_numpy(masks[:, np.newaxis]),
+            )
+            images, masks = images.numpy(), masks.numpy()
+            return (images if has_channels else images[:, 0]), masks[:, 0]
+
+        images_out, masks_out = None, None
+        for i, (im, lbl) in enumerate(zip(images, masks)):
+            if im.ndim == 3:
+                im = _transform_CHW_to_HWC(im)
+            augmented_dict = self.augmentations(image=im, mask=lbl)
+            im, lbl = augmented_dict["image"], augmented_dict["mask"]
+            if im.ndim == 3:
+                im = _transform_HWC_to_CHW(im)
+            if images_out is None:
+                images_out = np.empty((len(images),) + im.shape, dtype=np.float32)
+                masks_out = np.empty((len(masks),) + lbl.shape, dtype=masks.dtype)
+            images_out[i], masks_out[i] = im, lbl
+        return images_out, masks_out
+
     def transform(self, img, lbl):
         # to be in the BxCxHxW that PyTorch uses:
         lbl = np.expand_dims(lbl, 0)
         if len(img.shape) == 2:
             img = np.expand_dims(img, 0)
-        return torch.from_numpy(img).float(), torch.from_numpy(lbl).long()
+        # copy so that we never hand out views of a read-only memory-mapped volume
+        return torch.from_numpy(np.array(img, dtype=np.float32)), torch.from_numpy(np.array(lbl, dtype=np.int64))
+
+    def transform_batch(self, img, lbl):
+        # gathered batches are never views of the volume so only cast when needed
+        lbl = np.expand_dims(lbl, 1)
+        if len(img.shape) == 3:
+            img = np.expand_dims(img, 1)
+        return (
+            torch.from_numpy(np.asarray(img, dtype=np.float32)),
+            torch.from_numpy(np.asarray(lbl, dtype=np.int64)),
+        )
 
 
 class TestPatchLoader(PatchLoader):
-    def __init__(self, data_dir, stride=30, patch_size=99, is_transform=True, augmentations=None):
+    def __init__(
+        self,
+        data_dir,
+        stride=30,
+        patch_size=99,
+        is_transform=True,
+        augmentations=None,
+        mmap=True,
+        storage="float32",
+        batch_augmentations=None,
+    ):
         super(TestPatchLoader, self).__init__(
-            data_dir, stride=stride, patch_size=patch_size, is_transform=is_transform, augmentations=augmentations,
+            data_dir,
+            stride=stride,
+            patch_size=patch_size,
+            is_transform=is_transform,
+            augmentations=augmentations,
+            mmap=mmap,
+            storage=storage,
+            batch_augmentations=batch_augmentations,
         )
         ## Warning: this is not used or tested
         raise NotImplementedError("This class is not correctly implemented.")
@@ -588,46 +1349,80 @@ class TestPatchLoader(PatchLoader):
         # We are in test mode. Only read the given split. The other one might not
         # be available.
         self.split = "test1"  # TODO: Fix this can also be test2
-        txt_path = path.join(self.data_dir, "splits", "patch_" + self.split + ".txt")
-        patch_list = tuple(open(txt_path, "r"))
-        patch_list = [id_.rstrip() for id_ in patch_list]
-        self.patches = patch_list
+        self.patches = load_split(_splits_path_for(self.data_dir), "patch_" + self.split, mmap=self.mmap)
 
 
 class TrainPatchLoader(PatchLoader):
     def __init__(
-        self, data_dir, split="train", stride=30, patch_size=99, is_transform=True, augmentations=None,
+        self,
+        data_dir,
+        split="train",
+        stride=30,
+        patch_size=99,
+        is_transform=True,
+        augmentations=None,
+        mmap=True,
+        storage="float32",
+        batch_augmentations=None,
     ):
         super(TrainPatchLoader, self).__init__(
-            data_dir, stride=stride, patch_size=patch_size, is_transform=is_transform, augmentations=augmentations,
+            data_dir,
+            stride=stride,
+            patch_size=patch_size,
+            is_transform=is_transform,
+            augmentations=augmentations,
+            mmap=mmap,
+            storage=storage,
+            batch_augmentations=batch_augmentations,
         )
         # self.seismic = self.pad_volume(np.load(seismic_path))
         # self.labels = self.pad_volume(np.load(labels_path))
         warnings.warn("This no longer pads the volume")
-        self.seismic = np.load(_train_data_for(self.data_dir))
-        self.labels = np.load(_train_labels_for(self.data_dir))
+        seismic_path = storage_path(_train_data_for(self.data_dir), self.storage)
+        self.seismic = load_volume(seismic_path, mmap=self.mmap)
+        self.scale = load_volume_scale(seismic_path)
+        self.labels = load_volume(_train_labels_for(self.data_dir), mmap=self.mmap)
+        self.seismic_xline = load_xline_volume(seismic_path, mmap=self.mmap)
+        self.labels_xline = load_xline_volume(_train_labels_for(self.data_dir), mmap=self.mmap)
         # We are in train/val mode. Most likely the test splits are not saved yet,
         # so don't attempt to load them.
         self.split = split
-        # reading the file names for split
-        txt_path = path.join(self.data_dir, "splits", "patch_" + split + ".txt")
-        patch_list = tuple(open(txt_path, "r"))
-        patch_list = [id_.rstrip() for id_ in patch_list]
-        self.patches = patch_list
+        # reading the index of the split, without a split the patches are only read through get_patches
+        if split is not None:
+            self.patches = load_split(_splits_path_for(self.data_dir), "patch_" + split, mmap=self.mmap)
+            self.class_histograms = load_class_histograms(_splits_path_for(self.data_dir), "patch_" + split)
 
 
 class TrainPatchLoaderWithDepth(TrainPatchLoader):
     def __init__(
-        self, data_dir, split="train", stride=30, patch_size=99, is_transform=True, augmentations=None,
+        self,
+        data_dir,
+        split="train",
+        stride=30,
+        patch_size=99,
+        is_transform=True,
+        augmentations=None,
+        mmap=True,
+        storage="float32",
+        batch_augmentations=None,
     ):
         super(TrainPatchLoaderWithDepth, self).__init__(
-            data_dir, stride=stride, patch_size=patch_size, is_transform=is_transform, augmentations=augmentations,
+            data_dir,
+            split=split,
+            stride=stride,
+            patch_size=patch_size,
+            is_transform=is_transform,
+            augmentations=augmentations,
+            mmap=mmap,
+            storage=storage,
+            batch_augmentations=batch_augmentations,
         )
 
     def __getitem__(self, index):
+        if _is_batch_index(index):
+            return self.get_batch(index)
 
-        patch_name = self.patches[index]
-        direction, idx, xdx, ddx = patch_name.split(sep="_")
+        direction, idx, xdx, ddx = self.patches[index]
 
         # Shift offsets the padding that is added in training
         # shift = self.patch_size if "test" not in self.split else 0
@@ -635,12 +1430,15 @@ class TrainPatchLoaderWithDepth(TrainPatchLoader):
         shift = 0
         idx, xdx, ddx = int(idx) + shift, int(xdx) + shift, int(ddx) + shift
 
-        if direction == "i":
+        if direction == _IN_INLINE_DIRECTION:
             im = self.seismic[idx, xdx : xdx + self.patch_size, ddx : ddx + self.patch_size]
             lbl = self.labels[idx, xdx : xdx + self.patch_size, ddx : ddx + self.patch_size]
-        elif direction == "x":
-            im = self.seismic[idx : idx + self.patch_size, xdx, ddx : ddx + self.patch_size]
-            lbl = self.labels[idx : idx + self.patch_size, xdx, ddx : ddx + self.patch_size]
+        elif direction == _IN_CROSSLINE_DIRECTION:
+            im = _crossline_section(self.seismic, self.seismic_xline, xdx)
+            lbl = _crossline_section(self.labels, self.labels_xline, xdx)
+            im = im[idx : idx + self.patch_size, ddx : ddx + self.patch_size]
+            lbl = lbl[idx : idx + self.patch_size, ddx : ddx + self.patch_size]
+        im = _dequantise(im, self.scale)
         im, lbl = _transform_WH_to_HW(im), _transform_WH_to_HW(lbl)
 
         # TODO: Add check for rotation augmentations and raise warning if found
@@ -654,6 +1452,22 @@ class TrainPatchLoaderWithDepth(TrainPatchLoader):
             im, lbl = self.transform(im, lbl)
         return im, lbl
 
+    def get_patches(self, patches):
+        im, lbl, inside = self._gather_batch(patches)
+
+        if self.augmentations is not None or self.batch_augmentations is not None:
+            im, lbl = self._augment_batch(im, lbl, inside)
+
+        # depth channels are added after the augmentations, as for single patches
+        depth = _depth_ramp(im.shape[-2])[:, np.newaxis]
+        channels = np.empty((im.shape[0], 3) + im.shape[1:], dtype=np.float32)
+        _stack_depth_channels(im, depth, out=np.swapaxes(channels, 0, 1))
+        im = channels
+
+        if self.is_transform:
+            im, lbl = self.transform_batch(im, lbl)
+        return im, lbl
+
 
 def _transform_CHW_to_HWC(numpy_array):
     return np.moveaxis(numpy_array, 0, -1)
@@ -665,7 +1479,16 @@ def _transform_HWC_to_CHW(numpy_array):
 
 class TrainPatchLoaderWithSectionDepth(TrainPatchLoader):
     def __init__(
-        self, data_dir, split="train", stride=30, patch_size=99, is_transform=True, augmentations=None,
+        self,
+        data_dir,
+        split="train",
+        stride=30,
+        patch_size=99,
+        is_transform=True,
+        augmentations=None,
+        mmap=True,
+        storage="float32",
+        batch_augmentations=None,
     ):
         super(TrainPatchLoaderWithSectionDepth, self).__init__(
             data_dir,
@@ -674,26 +1497,35 @@ class TrainPatchLoaderWithSectionDepth(TrainPatchLoader):
             patch_size=patch_size,
             is_transform=is_transform,
             augmentations=augmentations,
+            mmap=mmap,
+            storage=storage,
+            batch_augmentations=batch_augmentations,
         )
-        self.seismic = add_section_depth_channels(self.seismic)
 
     def __getitem__(self, index):
+        if _is_batch_index(index):
+            return self.get_batch(index)
 
-        patch_name = self.patches[index]
-        direction, idx, xdx, ddx = patch_name.split(sep="_")
+        direction, idx, xdx, ddx = self.patches[index]
 
         # Shift offsets the padding that is added in training
         # shift = self.patch_size if "test" not in self.split else 0
         # TODO: Remember we are cancelling the shift since we no longer pad
         shift = 0
         idx, xdx, ddx = int(idx) + shift, int(xdx) + shift, int(ddx) + shift
-        if direction == "i":
-            im = self.seismic[idx, :, xdx : xdx + self.patch_size, ddx : ddx + self.patch_size]
+        if direction == _IN_INLINE_DIRECTION:
+            im = self.seismic[idx, xdx : xdx + self.patch_size, ddx : ddx + self.patch_size]
             lbl = self.labels[idx, xdx : xdx + self.patch_size, ddx : ddx + self.patch_size]
-        elif direction == "x":
-            im = self.seismic[idx : idx + self.patch_size, :, xdx, ddx : ddx + self.patch_size]
-            lbl = self.labels[idx : idx + self.patch_size, xdx, ddx : ddx + self.patch_size]
-            im = np.swapaxes(im, 0, 1)  # From WCH to CWH
+        elif direction == _IN_CROSSLINE_DIRECTION:
+            im = _crossline_section(self.seismic, self.seismic_xline, xdx)
+            lbl = _crossline_section(self.labels, self.labels_xline, xdx)
+            im = im[idx : idx + self.patch_size, ddx : ddx + self.patch_size]
+            lbl = lbl[idx : idx + self.patch_size, ddx : ddx + self.patch_size]
+        im = _dequantise(im, self.scale)
+
+        # the depth of the patch relative to the whole section
+        depth_ramp = _depth_ramp(self.seismic.shape[-1])[ddx : ddx + im.shape[-1]]
+        im = _add_section_depth(im, depth_ramp)  # CWH
 
         im, lbl = _transform_WH_to_HW(im), _transform_WH_to_HW(lbl)
 
@@ -706,13 +1538,150 @@ class TrainPatchLoaderWithSectionDepth(TrainPatchLoader):
         if self.is_transform:
             im, lbl = self.transform(im, lbl)
         return im, lbl
-    
+
+    def get_patches(self, patches):
+        section, inside = _gather_patches(self.seismic, patches, self.patch_size, xline_volume=self.seismic_xline)
+        section = _dequantise(section, self.scale)
+        lbl, _ = _gather_patches(self.labels, patches, self.patch_size, xline_volume=self.labels_xline)
+        lbl[~inside] = 255
+
+        # the depth of every row of the patches relative to the whole section
+        rows, _ = _centred_offsets(patches[:, 3, np.newaxis], self.seismic.shape[-1], self.patch_size)
+        depth = _depth_ramp(self.seismic.shape[-1])[rows][:, :, np.newaxis]
+        im = np.empty((len(patches), 3) + section.shape[1:], dtype=np.float32)
+        _stack_depth_channels(section, depth, out=np.swapaxes(im, 0, 1))
+        im[np.broadcast_to(~inside[:, np.newaxis], im.shape)] = 0
+
+        if self.augmentations is not None or self.batch_augmentations is not None:
+            im, lbl = self._augment_batch(im, lbl, inside)
+
+        if self.is_transform:
+            im, lbl = self.transform_batch(im, lbl)
+        return im, lbl
+
     def __repr__(self):
         unique, counts = np.unique(self.labels, return_counts=True)
         ratio = counts/np.sum(counts)
         return "\n".join(f"{lbl}: {cnt} [{rat}]"for lbl, cnt, rat in zip(unique, counts, ratio))
 
 
+def _split_sections(n_sections, split, per_val=0.2):
+    # the inlines or crosslines that scripts/prepare_dutchf3.py split_train_val assigns to the split
+    n_val = int(n_sections * per_val / 2)
+    sections = np.arange(n_sections)
+    if split == "train":
+        return sections[n_val : n_sections - n_val]
+    if split == "val":
+        return np.concatenate([sections[:n_val], sections[n_sections - n_val :]])
+    return sections
+
+
+def _class_frequencies(labels, n_classes):
+    counts = np.zeros(n_classes, dtype=np.int64)
+    for inline in labels:
+        inline = inline[(inline >= 0) & (inline < n_classes)].astype(np.intp)
+        counts += np.bincount(inline, minlength=n_classes)
+    return counts / max(counts.sum(), 1)
+
+
+class RandomPatchLoader(data.IterableDataset):
+    """Stream batches of patches from random positions of the volume instead of the fixed grid of a split file
+
+    The inline and crossline patches are drawn from the sections that split_train_val assigns to the split, with
+    their origins uniformly distributed over the section, so the patch size can change without regenerating any
+    split. With class_balanced, oversampling times as many candidate patches are drawn for every batch and
+    resampled by the mean inverse frequency of their classes like in ClassBalancedSampler. Every DataLoader
+    worker draws from its own random stream, seeded from the torch generator that torch seeds per worker.
+
+    Args:
+        patch_loader (PatchLoader): loader of the volume, e.g. TrainPatchLoader created with split=None
+        batch_size (int): number of patches per batch
+        split (str, optional): train, val or train_val. Defaults to "train".
+        per_val (float, optional): the fraction of the volume used for validation. Defaults to 0.2.
+        num_batches (int, optional): batches per epoch, shared between the workers. None streams batches
+            forever. Defaults to None.
+        class_balanced (bool, optional): draw patches holding rare classes more often. Defaults to False.
+        oversampling (int, optional): candidate patches per patch when class_balanced. Defaults to 4.
+    """
+
+    def __init__(
+        self,
+        patch_loader,
+        batch_size,
+        split="train",
+        per_val=0.2,
+        num_batches=None,
+        class_balanced=False,
+        oversampling=4,
+    ):
+        self.patch_loader = patch_loader
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.class_balanced = class_balanced
+        self.oversampling = oversampling
+        self.n_classes = patch_loader.n_classes
+
+        n_inlines, n_crosslines, depth = patch_loader.labels.shape
+        self.inlines = _split_sections(n_inlines, split, per_val=per_val)
+        self.crosslines = _split_sections(n_crosslines, split, per_val=per_val)
+        # number of origins that keep the patches inside the volume along the inlines, crosslines and depth
+        self.origins = [max(extent - patch_loader.patch_size, 0) + 1 for extent in (n_inlines, n_crosslines, depth)]
+        # pick the direction in proportion to the number of distinct patches along it
+        crossline_patches = len(self.crosslines) * self.origins[0]
+        self.crossline_fraction = crossline_patches / (crossline_patches + len(self.inlines) * self.origins[1])
+        self.class_frequencies = None
+        if class_balanced:
+            self.class_frequencies = _class_frequencies(patch_loader.labels, self.n_classes)
+
+    def _random_patches(self, random_state, n):
+        in_crossline = random_state.random_sample(n) < self.crossline_fraction
+        patches = np.empty((n, 4), dtype=np.int32)
+        patches[:, 0] = np.where(in_crossline, _IN_CROSSLINE_DIRECTION, _IN_INLINE_DIRECTION)
+        patches[:, 1] = np.where(
+            in_crossline, random_state.randint(self.origins[0], size=n), random_state.choice(self.inlines, n)
+        )
+        patches[:, 2] = np.where(
+            in_crossline, random_state.choice(self.crosslines, n), random_state.randint(self.origins[1], size=n)
+        )
+        patches[:, 3] = random_state.randint(self.origins[2], size=n)
+        return patches
+
+    def _class_balanced_patches(self, random_state):
+        candidates = self._random_patches(random_state, self.batch_size * self.oversampling)
+        histograms = class_histograms(
+            self.patch_loader.labels,
+            candidates,
+            patch_size=self.patch_loader.patch_size,
+            n_classes=self.n_classes,
+            xline_labels=self.patch_loader.labels_xline,
+        )
+        weights = _class_balanced_weights(histograms, self.class_frequencies)
+        p = weights / weights.sum() if weights.sum() > 0 else None
+        return candidates[random_state.choice(len(candidates), self.batch_size, p=p)]
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        # torch seeds every worker differently and every epoch anew
+        random_state = np.random.RandomState(int(torch.randint(2 ** 31 - 1, (1,))))
+        if self.num_batches is None:
+            batches = itertools.count()
+        else:
+            batches = range(worker_id, self.num_batches, num_workers)
+
+        for _ in batches:
+            if self.class_balanced:
+                patches = self._class_balanced_patches(random_state)
+            else:
+                patches = self._random_patches(random_state, self.batch_size)
+            yield self.patch_loader.get_patches(patches)
+
+    def __len__(self):
+        if self.num_batches is None:
+            raise TypeError("RandomPatchLoader streams batches forever, set num_batches to give it a length")
+        return self.num_batches
+
+
 _TRAIN_PATCH_LOADERS = {
     "section": TrainPatchLoaderWithSectionDepth,
     "patch": TrainPatchLoaderWithDepth,
@@ -733,6 +1702,43 @@ def get_patch_loader(cfg):
     return _TRAIN_PATCH_LOADERS.get(cfg.TRAIN.DEPTH, TrainPatchLoader)
 
 
+def get_random_patch_loader(dataset, **kwargs):
+    """Create a DataLoader for a RandomPatchLoader, which already yields whole batches
+
+    Args:
+        dataset (RandomPatchLoader): dataset to stream from
+        **kwargs: passed on to DataLoader, e.g. num_workers
+
+    Returns:
+        DataLoader: loader yielding BxCxHxW images and Bx1xHxW labels
+    """
+    return data.DataLoader(dataset, batch_size=None, **kwargs)
+
+
+def get_batch_loader(dataset, batch_size, shuffle=False, sampler=None, drop_last=False, **kwargs):
+    """Create a DataLoader that fetches whole batches through the get_batch method of the patch loaders
+
+    The indices of a batch are handed to the dataset in one go and automatic collation is turned off, so
+    the batch comes out of the dataset ready to use.
+
+    Args:
+        dataset (PatchLoader): dataset to load from
+        batch_size (int): number of patches per batch
+        shuffle (bool, optional): reshuffle the patches every epoch. Defaults to False.
+        sampler (Sampler, optional): sampler of the patch indices, e.g. a DistributedSampler or a
+            ClassBalancedSampler. Overrides shuffle. Defaults to None.
+        drop_last (bool, optional): drop the last incomplete batch. Defaults to False.
+        **kwargs: passed on to DataLoader, e.g. num_workers
+
+    Returns:
+        DataLoader: loader yielding BxCxHxW images and Bx1xHxW labels
+    """
+    if sampler is None:
+        sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+    batch_sampler = data.BatchSampler(sampler, batch_size, drop_last)
+    return data.DataLoader(dataset, batch_size=None, sampler=batch_sampler, **kwargs)
+
+
 def get_section_loader(cfg):
     assert cfg.TRAIN.DEPTH in [
         "section",
@@ -760,44 +1766,84 @@ def get_test_loader(cfg):
     return _TEST_LOADERS.get(cfg.TRAIN.DEPTH, TestSectionLoader)
 
 
-def add_patch_depth_channels(image_array):
+@functools.lru_cache(maxsize=None)
+def _depth_ramp(height):
+    """Linear sequence from 0 to 1 over height samples, cached per height and shared read-only
+    """
+    ramp = np.linspace(0, 1, height, dtype=np.float32)
+    ramp.flags.writeable = False
+    return ramp
+
+
+def _stack_depth_channels(image_array, depth, out=None):
+    """Stack the image, the depth and their product along a new leading channel axis
+
+    Args:
+        image_array (np.array): amplitudes
+        depth (np.array): depth values that broadcast against image_array
+        out (np.array, optional): float32 array with a leading axis of 3 to write into. Defaults to None.
+
+    Returns:
+        [np.array]: float32 array with 3 channels in front of the shape of image_array
+    """
+    if out is None:
+        out = np.empty((3,) + image_array.shape, dtype=np.float32)
+    out[0] = image_array
+    out[1] = depth
+    np.multiply(out[0], out[1], out=out[2])
+    return out
+
+
+def _add_section_depth(image_array, depth_ramp, out=None):
+    """Add the section depth channels to a single section or patch on the fly
+
+    Builds the same channels as add_section_depth_channels but only for the sample being fetched,
+    so the memory used stays constant instead of growing with the volume.
+
+    Args:
+        image_array (np.array): 2D array (WH) with depth along the last axis
+        depth_ramp (np.array): 1D depth values for the rows of image_array
+        out (np.array, optional): 3xWxH float32 array to write into. Defaults to None.
+
+    Returns:
+        [np.array]: 3D float32 array (CWH)
+    """
+    return _stack_depth_channels(image_array, depth_ramp, out=out)
+
+
+def add_patch_depth_channels(image_array, out=None):
     """Add 2 extra channels to a 1 channel numpy array
     One channel is a linear sequence from 0 to 1 starting from the top of the image to the bottom
     The second channel is the product of the input channel and the 'depth' channel
     
     Args:
-        image_array (np.array): 1D Numpy array
+        image_array (np.array): 2D Numpy array (HW)
+        out (np.array, optional): 3xHxW float32 array to write into, e.g. a slot of a batch. Defaults to None.
     
     Returns:
-        [np.array]: 3D numpy array
+        [np.array]: 3D float32 numpy array
     """
-    h, w = image_array.shape
-    image = np.zeros([3, h, w])
-    image[0] = image_array
-    for row, const in enumerate(np.linspace(0, 1, h)):
-        image[1, row, :] = const
-    image[2] = image[0] * image[1]
-    return image
+    h, _ = image_array.shape
+    return _stack_depth_channels(image_array, _depth_ramp(h)[:, np.newaxis], out=out)
 
 
-def add_section_depth_channels(sections_numpy):
+def add_section_depth_channels(sections_numpy, out=None):
     """Add 2 extra channels to a 1 channel section
     One channel is a linear sequence from 0 to 1 starting from the top of the section to the bottom
     The second channel is the product of the input channel and the 'depth' channel
     
     Args:
         sections_numpy (numpy array): 3D Matrix (NWH)Image tensor
+        out (numpy array, optional): Nx3xWxH float32 array to write into. Defaults to None.
     
     Returns:
-        [pytorch tensor]: 3D image tensor
+        [numpy array]: 4D float32 array (NCWH)
     """
     n, w, h = sections_numpy.shape
-    image = np.zeros([3, n, w, h])
-    image[0] = sections_numpy
-    for row, const in enumerate(np.linspace(0, 1, h)):
-        image[1, :, :, row] = const
-    image[2] = image[0] * image[1]
-    return np.swapaxes(image, 0, 1)
+    if out is None:
+        out = np.empty((n, 3, w, h), dtype=np.float32)
+    _stack_depth_channels(sections_numpy, _depth_ramp(h), out=np.swapaxes(out, 0, 1))
+    return out
 
 
 def get_seismic_labels():
@@ -806,24 +1852,29 @@ def get_seismic_labels():
     )
 
 
+def _colour_lut(n_classes, label_colours, dtype):
+    # labels without a colour keep their value as grey level, so the ignore label 255 shows up white
+    lut = np.repeat(np.arange(256, dtype=np.uint8)[:, np.newaxis], 3, axis=1)
+    lut[:n_classes] = np.asarray(label_colours)[:n_classes]
+    return lut if dtype == np.uint8 else lut.astype(dtype) / 255
+
+
 @curry
-def decode_segmap(label_mask, n_classes=6, label_colours=get_seismic_labels()):
-    """Decode segmentation class labels into a colour image
+def decode_segmap(label_mask, n_classes=6, label_colours=get_seismic_labels(), dtype=np.float32):
+    """Decode segmentation class labels into a colour image with a single lookup table indexing
     Args:
-        label_mask (np.ndarray): an (N,H,W) array of integer values denoting
-            the class label at each spatial location.
+        label_mask (np.ndarray or torch.Tensor): an (N,H,W) array of integer values denoting
+            the class label at each spatial location. Tensors are decoded on their device.
+        n_classes (int, optional): number of classes. Defaults to 6.
+        label_colours (np.ndarray, optional): RGB colour of every class. Defaults to get_seismic_labels().
+        dtype (np.dtype, optional): np.uint8 for colours in [0, 255], a float type for colours in [0, 1].
+            Defaults to np.float32.
     Returns:
-        (np.ndarray): the resulting decoded color image (NCHW).
-    """
-    r = label_mask.copy()
-    g = label_mask.copy()
-    b = label_mask.copy()
-    for ll in range(0, n_classes):
-        r[label_mask == ll] = label_colours[ll, 0]
-        g[label_mask == ll] = label_colours[ll, 1]
-        b[label_mask == ll] = label_colours[ll, 2]
-    rgb = np.zeros((label_mask.shape[0], label_mask.shape[1], label_mask.shape[2], 3))
-    rgb[:, :, :, 0] = r / 255.0
-    rgb[:, :, :, 1] = g / 255.0
-    rgb[:, :, :, 2] = b / 255.0
+        (np.ndarray or torch.Tensor): the resulting decoded color image (NCHW), of the same type as label_mask.
+    """
+    lut = _colour_lut(n_classes, label_colours, dtype)
+    if torch.is_tensor(label_mask):
+        lut = torch.from_numpy(lut).to(label_mask.device)
+        return lut[label_mask.long().clamp(0, 255)].permute(0, 3, 1, 2)
+    rgb = np.take(lut, label_mask.astype(np.intp, copy=False), axis=0, mode="clip")
     return np.transpose(rgb, (0, 3, 1, 2))
@@ -1,8 +1,12 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+from functools import lru_cache
+
 import numpy as np
 import scipy
+import torch
+import torch.nn.functional as F
 
 
 def get_coordinates_for_slice(slice_type, slice_no, data_info):
@@ -21,39 +25,19 @@ def get_coordinates_for_slice(slice_type, slice_no, data_info):
     """
     ds = data_info["shape"]
 
-    # Coordinates for cube
-    x0, x1, x2 = np.meshgrid(
-        np.linspace(0, ds[0] - 1, ds[0]),
-        np.linspace(0, ds[1] - 1, ds[1]),
-        np.linspace(0, ds[2] - 1, ds[2]),
-        indexing="ij",
-    )
-    if slice_type == "inline":
-        start = data_info["inline_start"]
-        slice_no = slice_no - start
+    # Coordinates along every axis of the cube
+    axes = [np.arange(n, dtype=np.float64) for n in ds]
 
-        x0 = x0[:, slice_no, :]
-        x1 = x1[:, slice_no, :]
-        x2 = x2[:, slice_no, :]
+    # Fix the axis of the slice so that only the plane of the slice is built, not the whole cube
+    if slice_type == "inline":
+        axes[1] = axes[1][[slice_no - data_info["inline_start"]]]
     elif slice_type == "crossline":
-        start = data_info["crossline_start"]
-        slice_no = slice_no - start
-        x0 = x0[:, :, slice_no]
-        x1 = x1[:, :, slice_no]
-        x2 = x2[:, :, slice_no]
-
+        axes[2] = axes[2][[slice_no - data_info["crossline_start"]]]
     elif slice_type == "timeslice":
-        start = data_info["timeslice_start"]
-        slice_no = slice_no - start
-        x0 = x0[slice_no, :, :]
-        x1 = x1[slice_no, :, :]
-        x2 = x2[slice_no, :, :]
+        axes[0] = axes[0][[slice_no - data_info["timeslice_start"]]]
 
     # Collect indexes
-    x0 = np.expand_dims(x0.ravel(), 0)
-    x1 = np.expand_dims(x1.ravel(), 0)
-    x2 = np.expand_dims(x2.ravel(), 0)
-    coords = np.concatenate((x0, x1, x2), axis=0)
+    coords = np.stack([x.ravel() for x in np.meshgrid(*axes, indexing="ij")])
 
     return coords
 
@@ -239,6 +223,66 @@ def augment_rot_z(grid, random_rot_z):
     return grid
 
 
+@lru_cache(maxsize=8)
+def _base_grid(im_size):
+    # read only, so that the cached grid can't be augmented in place by mistake
+    grid = get_grid(im_size)
+    grid.flags.writeable = False
+    return grid
+
+
+def augmentation_matrix(random_flip=False, random_stretch=None, random_rot_xy=None, random_rot_z=None):
+    """
+    Random flip, rotations and stretch combined into a single 3x3 matrix
+
+    The random numbers are drawn in the same order as applying augment_flip, augment_rot_xy, augment_rot_z and
+    augment_stretch one after the other, so the matrix reproduces the grid those functions would produce.
+
+    Args:
+        random_flip: bool to perform random voxel flip
+        random_stretch: maximum relative stretch, None or 0 for no stretch
+        random_rot_xy: maximum rotation in degrees around dim-0, None or 0 for no rotation
+        random_rot_z: maximum tilt in degrees around dim-2, None or 0 for no tilt
+
+    Returns:
+        3x3 numpy array
+    """
+    matrix = np.eye(3)
+    if random_flip:
+        # same draws as augment_flip
+        flip_x, flip_y = rand_bool(), rand_bool()
+        matrix = np.diag([1.0, -1.0 if flip_x else 1.0, -1.0 if flip_y else 1.0])
+    if random_rot_xy:
+        theta = np.deg2rad(rand_float(-random_rot_xy, random_rot_xy))
+        cos, sin = np.cos(theta), np.sin(theta)
+        matrix = np.array([[1, 0, 0], [0, -sin, cos], [0, cos, sin]]) @ matrix
+    if random_rot_z:
+        theta = np.deg2rad(rand_float(-random_rot_z, random_rot_z))
+        cos, sin = np.cos(theta), np.sin(theta)
+        matrix = np.array([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]]) @ matrix
+    if random_stretch:
+        matrix = matrix * (1 + rand_float(-random_stretch, random_stretch))
+    return matrix
+
+
+def affine_grids(im_size, matrices, offsets):
+    """
+    Grids of get_grid transformed by one matrix and moved by one offset each, in a single pass over the voxels
+
+    The untransformed grid is cached per im_size instead of being rebuilt for every sample.
+
+    Args:
+        im_size: size of window
+        matrices: batch x 3 x 3 transforms, for example from augmentation_matrix
+        offsets: batch x 3 centres of the grids
+
+    Returns:
+        numpy array with size: batch x 3 x im_size**3
+    """
+    grid = _base_grid(tuple(im_size))
+    return np.matmul(matrices, grid) + np.asarray(offsets)[:, :, np.newaxis]
+
+
 def trilinear_interpolation(input_array, indices):
     """
     Linear interpolation
@@ -257,9 +301,9 @@ def trilinear_interpolation(input_array, indices):
 
     n0, n1, n2 = input_array.shape
 
-    x0 = x_indices.astype(np.integer)
-    y0 = y_indices.astype(np.integer)
-    z0 = z_indices.astype(np.integer)
+    x0 = x_indices.astype(np.intp)
+    y0 = y_indices.astype(np.intp)
+    z0 = z_indices.astype(np.intp)
     x1 = x0 + 1
     y1 = y0 + 1
     z1 = z0 + 1
@@ -305,6 +349,93 @@ def trilinear_interpolation(input_array, indices):
     return output
 
 
+def trilinear_interpolation_batch(input_array, grids):
+    """
+    Linear interpolation of a batch of grids, the same as trilinear_interpolation on every grid
+
+    The eight corners of every coordinate are gathered from the flattened input array and blended in float32.
+    The grids are interpolated one after the other so that the temporaries stay in the CPU caches, which
+    measured about twice as fast as gathering the whole batch at once.
+
+    Args:
+        input_array: 3D data array
+        grids: batch x 3 x N grid coordinates
+
+    Returns:
+        batch x N float32 array of interpolated values, 0 outside of input_array
+    """
+    n0, n1, n2 = input_array.shape
+    flat_array = input_array.reshape(-1)
+    # offsets of the corners in the flattened array
+    dx, dy, dz = n1 * n2, n2, 1
+
+    output = np.empty(grids.shape[::2], dtype=np.float32)
+    for grid, out in zip(grids, output):
+        x0, y0, z0 = (grid[axis].astype(np.intp) for axis in range(3))
+        inds_out_of_range = (x0 < 0) | (y0 < 0) | (z0 < 0) | (x0 >= n0 - 1) | (y0 >= n1 - 1) | (z0 >= n2 - 1)
+        x, y, z = ((grid[axis] - corner).astype(np.float32) for axis, corner in enumerate((x0, y0, z0)))
+
+        base = (x0 * n1 + y0) * n2 + z0
+        base[inds_out_of_range] = 0
+
+        def _lerp_x(offset):
+            low = flat_array.take(base + offset)
+            return low + (flat_array.take(base + offset + dx) - low) * x
+
+        c00, c10, c01, c11 = _lerp_x(0), _lerp_x(dy), _lerp_x(dz), _lerp_x(dy + dz)
+        c0 = c00 + (c10 - c00) * y
+        c1 = c01 + (c11 - c01) * y
+        out[:] = c0 + (c1 - c0) * z
+        out[inds_out_of_range] = 0
+    return output
+
+
+def trilinear_interpolation_torch(input_array, grids):
+    """
+    Linear interpolation of a batch of grids with torch grid_sample, a drop in for trilinear_interpolation_batch
+
+    The data is expanded along the batch without being copied, so that grid_sample interpolates the grids on
+    all the torch threads. Coordinates are normalised to [-1, 1] in float32, which costs about 1e-5 of precision
+    against the numpy versions. Those extrapolate coordinates between -1 and 0 from the first two voxels, here
+    everything outside of input_array is 0.
+
+    Args:
+        input_array: 3D float32 data array
+        grids: batch x 3 x N grid coordinates
+
+    Returns:
+        batch x N float32 array of interpolated values, 0 outside of input_array
+    """
+    cube = torch.as_tensor(input_array, dtype=torch.float32)
+    grids = torch.as_tensor(grids)
+    batch_size = grids.shape[0]
+
+    sizes = grids.new_tensor(cube.shape).view(1, 3, 1)
+    out_of_range = ((grids < 0) | (grids >= sizes - 1)).any(dim=1)
+
+    # grid_sample takes the coordinates starting from the last dimension of the data, scaled to [-1, 1]
+    normalised = (grids * (2 / (sizes - 1)) - 1).flip(1).transpose(1, 2).float()
+    output = F.grid_sample(
+        cube[None, None].expand(batch_size, -1, -1, -1, -1),
+        normalised[:, :, None, None],
+        mode="bilinear",
+        padding_mode="zeros",
+        align_corners=True,
+    ).view(batch_size, -1)
+    output[out_of_range] = 0
+    return output.numpy()
+
+
+INTERPOLATION_BACKENDS = {"numpy": trilinear_interpolation_batch, "torch": trilinear_interpolation_torch}
+
+
+def interpolation_backend(name):
+    """Batch interpolation function of the given backend, numpy or torch"""
+    if name not in INTERPOLATION_BACKENDS:
+        raise ValueError(f"Unknown interpolation {name}. Valid values: {', '.join(INTERPOLATION_BACKENDS)}")
+    return INTERPOLATION_BACKENDS[name]
+
+
 def rand_float(low, high):
     """
     Generate random floating point number between two limits
@@ -418,9 +549,9 @@ def trilinear_interpolation(input_array, indices):
 
     n0, n1, n2 = input_array.shape
 
-    x0 = x_indices.astype(np.integer)
-    y0 = y_indices.astype(np.integer)
-    z0 = z_indices.astype(np.integer)
+    x0 = x_indices.astype(np.intp)
+    y0 = y_indices.astype(np.intp)
+    z0 = z_indices.astype(np.intp)
     x1 = x0 + 1
     y1 = y0 + 1
     z1 = z0 + 1
@@ -3,35 +3,155 @@
 
 # code modified from https://github.com/waldeland/CNN-for-ASI
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 from torch import nn
 
+
+def _conv_layers(net):
+    # every convolution together with the per voxel layers (batch norm, ReLU) that follow it
+    layers = []
+    for module in net:
+        if isinstance(module, nn.Conv3d):
+            layers.append((module, []))
+        else:
+            layers[-1][1].append(module)
+    return layers
+
+
+def _check_dense_window(layers, window):
+    """
+    Checks that the network can be run densely for windows of the given size
+
+    Inside a window only the first position of every layer reads the zero padding on its left and no position
+    that reaches the centre output reads the padding on its right. Only then is a window equivalent to running
+    the network over the whole cube with the first position of every layer (the edge) computed without the
+    taps that fall on the left padding.
+    """
+    sizes = [window]
+    for conv, _ in layers:
+        k, s, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+        sizes.append((sizes[-1] + 2 * p - k) // s + 1)
+
+    used = {sizes[-1] // 2}
+    if used != {0}:
+        raise ValueError(f"Dense scoring needs a single output per window, got {sizes[-1]} for window {window}")
+    for layer, (conv, _) in reversed(list(enumerate(layers))):
+        k, s, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+        reads = set()
+        for i in used:
+            positions = [i * s - p + t for t in range(k)]
+            # interior positions must only read interior positions, the input has no edge
+            first_interior = 0 if layer == 0 else 1
+            if i > 0 and min(positions) < first_interior or max(positions) >= sizes[layer]:
+                raise ValueError(f"Dense scoring doesn't support windows of size {window} for this network")
+            reads.update(t for t in positions if t >= 0)
+        used = reads
+
+
+def _crop(x, starts, sizes):
+    # window of the last two dimensions of x, padded with zeros where it falls outside of x
+    slices, pads = [slice(None)] * (x.dim() - 2), []
+    for start, size, n in zip(starts, sizes, x.shape[-2:]):
+        low = min(max(start, 0), n)
+        high = min(max(start + size, low), n)
+        before = min(max(low - start, 0), size)
+        slices.append(slice(low, high))
+        pads.append((before, size - before - (high - low)))
+    # F.pad takes the last dimension first
+    return F.pad(x[tuple(slices)], pads[1] + pads[0])
+
+
+def _variant_taps(edges, source, k, p, first):
+    """
+    Taps along each dense axis with which variant edges of a layer reads variant source of the previous layer
+
+    Variant e (bit d set when the map is the edge along dense axis d) drops the taps on the left of the centre
+    along the axes in e. Its centre taps read the edge variant of the previous layer and the taps on the right
+    the interior one. The first layer reads the input, which has no variants.
+
+    Returns:
+        list of (start, stop) taps per dense axis, None when edges doesn't read source
+    """
+    if source & edges != source or first and source:
+        return None
+    taps = []
+    for axis in range(2):
+        if first:
+            taps.append((p, k) if edges >> axis & 1 else (0, k))
+        elif source >> axis & 1:
+            taps.append((p, p + 1))
+        elif edges >> axis & 1:
+            taps.append((p + 1, k))
+        else:
+            taps.append((0, k))
+    return None if any(start >= stop for start, stop in taps) else taps
+
+
+def _dense_layer(maps, conv, weight, post, spacing, size, first, variants):
+    """
+    Runs one layer over the dense axes (the last two) for the given edge variants
+
+    All the sources of a variant are read with kernels of the same shape, so they are stacked along the channels
+    and convolved at once. weight is the weight of conv with its kernel dimensions in the order of the maps.
+    """
+    k, s, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+    outputs = {}
+    for edges in variants:
+        inputs, kernels = [], []
+        for source in range(4):
+            taps = _variant_taps(edges, source, k, p, first)
+            if taps is None:
+                continue
+            kernels.append(weight[:, :, :, taps[0][0] : taps[0][1], taps[1][0] : taps[1][1]])
+            inputs.append(
+                _crop(
+                    maps[source],
+                    [(start - p) * spacing for start, _ in taps],
+                    [size + (stop - start - 1) * spacing for start, stop in taps],
+                )
+            )
+        output = F.conv3d(
+            torch.cat(inputs, 1) if len(inputs) > 1 else inputs[0],
+            torch.cat(kernels, 1),
+            bias=conv.bias,
+            stride=(s, 1, 1),
+            padding=(p, 0, 0),
+            dilation=(1, spacing, spacing),
+        )
+        for module in post:
+            output = module(output)
+        outputs[edges] = output
+    return outputs
+
+
 # TODO; set chanels from yaml config file
 class TextureNet(nn.Module):
-    def __init__(self, n_classes=2):
+    def __init__(self, n_classes=2, n_filters=50):
         super(TextureNet, self).__init__()
 
         # Network definition
         # Parameters  #in_channels, #out_channels, filter_size, stride (downsampling factor)
         self.net = nn.Sequential(
-            nn.Conv3d(1, 50, 5, 4, padding=2),
-            nn.BatchNorm3d(50),
+            nn.Conv3d(1, n_filters, 5, 4, padding=2),
+            nn.BatchNorm3d(n_filters),
             # nn.Dropout3d() #Droput can be added like this ...
             nn.ReLU(),
-            nn.Conv3d(50, 50, 3, 2, padding=1, bias=False),
-            nn.BatchNorm3d(50),
+            nn.Conv3d(n_filters, n_filters, 3, 2, padding=1, bias=False),
+            nn.BatchNorm3d(n_filters),
             nn.ReLU(),
-            nn.Conv3d(50, 50, 3, 2, padding=1, bias=False),
-            nn.BatchNorm3d(50),
+            nn.Conv3d(n_filters, n_filters, 3, 2, padding=1, bias=False),
+            nn.BatchNorm3d(n_filters),
             nn.ReLU(),
-            nn.Conv3d(50, 50, 3, 2, padding=1, bias=False),
-            nn.BatchNorm3d(50),
+            nn.Conv3d(n_filters, n_filters, 3, 2, padding=1, bias=False),
+            nn.BatchNorm3d(n_filters),
             nn.ReLU(),
-            nn.Conv3d(50, 50, 3, 3, padding=1, bias=False),
-            nn.BatchNorm3d(50),
+            nn.Conv3d(n_filters, n_filters, 3, 3, padding=1, bias=False),
+            nn.BatchNorm3d(n_filters),
             nn.ReLU(),
             nn.Conv3d(
-                50, n_classes, 1, 1
+                n_filters, n_classes, 1, 1
             ),  # This is the equivalent of a fully connected layer since input has width/height/depth = 1
             nn.ReLU(),
         )
@@ -65,6 +185,82 @@ class TextureNet(nn.Module):
         _, class_no = torch.max(x, 1, keepdim=True)
         return class_no
 
+    def dense_scores(self, data, axis=0, index=None, window=65, tile_size=128):
+        """
+        Network output for the window around every voxel of a cube or of one of its slices
+
+        Gives the same scores as running the network on every window^3 mini-cube, but the network is evaluated
+        convolutionally over tiles of tile_size x tile_size windows of a slice at a time. Along the slice the
+        strided layers are dilated instead so that every voxel gets a score, the window is only cut out across it.
+
+        Args:
+            data: 3D numpy array
+            axis: axis across the slices. Defaults to 0.
+            index: slice to score, None to score all of them. Defaults to None.
+            window: size of the mini-cubes the network was trained on. Defaults to 65.
+            tile_size: number of windows along each side of a tile, bounds the memory (about 2GB for 128 with
+                the default 50 filters). Defaults to 128.
+
+        Returns:
+            n_classes x data.shape array of scores, the size along axis is 1 when scoring one slice. Voxels too close
+            to the sides of the cube for their window to fit are 0.
+        """
+        layers = _conv_layers(self.net)
+        _check_dense_window(layers, window)
+        w = window // 2
+
+        # distance between the positions of every layer and how far right its output reaches into the input
+        spacings = np.cumprod([1] + [conv.stride[0] for conv, _ in layers[:-1]])
+        reaches = [(conv.kernel_size[0] - 1 - conv.padding[0]) * d for (conv, _), d in zip(layers, spacings)]
+        sizes = [tile_size + sum(reaches[i + 1 :]) for i in range(len(layers))]
+
+        # variants every layer has to compute for the output, the edge along both dense axes
+        variants = [[3]]
+        for layer, (conv, _) in reversed(list(enumerate(layers[1:], 1))):
+            k, p = conv.kernel_size[0], conv.padding[0]
+            sources = {
+                source for edges in variants[0] for source in range(4) if _variant_taps(edges, source, k, p, False)
+            }
+            variants.insert(0, sorted(sources))
+
+        device = next(self.parameters()).device
+        slices = np.moveaxis(data, axis, 0)
+        # kernels with their dimensions in the order of the slices
+        kernel_dims = [2 + axis] + [2 + d for d in range(3) if d != axis]
+        weights = [conv.weight.permute(0, 1, *kernel_dims) for conv, _ in layers]
+        n_slices, n0, n1 = slices.shape
+        indexes = range(n_slices) if index is None else [index]
+        scores = np.zeros([layers[-1][0].out_channels, len(indexes), n0, n1], dtype=np.float32)
+        extent = tile_size + sum(reaches)
+
+        with torch.no_grad():
+            for i, slice_index in enumerate(indexes):
+                if not w <= slice_index < n_slices - w:
+                    continue
+                for start0 in range(0, n0 - 2 * w, tile_size):
+                    for start1 in range(0, n1 - 2 * w, tile_size):
+                        # data the windows starting in the tile reach, padded with zeros past the sides of the cube
+                        tile = np.zeros([window, extent, extent], dtype=np.float32)
+                        part = slices[
+                            slice_index - w : slice_index + w + 1, start0 : start0 + extent, start1 : start1 + extent
+                        ]
+                        tile[:, : part.shape[1], : part.shape[2]] = part
+                        maps = {0: torch.as_tensor(tile[np.newaxis, np.newaxis], device=device)}
+                        for layer, ((conv, post), weight, spacing, size, needed) in enumerate(
+                            zip(layers, weights, spacings, sizes, variants)
+                        ):
+                            maps = _dense_layer(maps, conv, weight, post, spacing, size, layer == 0, needed)
+                        out = maps[3][0, :, maps[3].shape[2] // 2].cpu().numpy()
+
+                        # centres of the windows in the tile
+                        stop0 = min(start0 + tile_size, n0 - 2 * w)
+                        stop1 = min(start1 + tile_size, n1 - 2 * w)
+                        scores[:, i, start0 + w : stop0 + w, start1 + w : stop1 + w] = out[
+                            :, : stop0 - start0, : stop1 - start1
+                        ]
+
+        return np.moveaxis(scores, 1, axis + 1)
+
     # Functions to get output from intermediate feature layers
     def f1(self, x):
         """
@@ -113,6 +113,19 @@ def _extract_patches(patch_size, stride, complete_patches_only, img_array, mask_
     return image_patch_generator, mask_patch_generator, patch_locations
 
 
+def _pad_patch(patch_size, image, mask, value=0, mask_value=255):
+    """Pad an incomplete CxHxW image patch and its HxW mask to patch_size, splitting the padding evenly between
+    both sides like PadIfNeeded
+    """
+    pad_h, pad_w = max(patch_size - image.shape[-2], 0), max(patch_size - image.shape[-1], 0)
+    if pad_h == 0 and pad_w == 0:
+        return image, mask
+    padding = ((pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2))
+    image = np.pad(image, ((0, 0),) + padding, mode="constant", constant_values=value)
+    mask = np.pad(mask, padding, mode="constant", constant_values=mask_value)
+    return image, mask
+
+
 def _generate_patches_for(numpy_array, patch_locations, patch_size):
     if _is_2D(numpy_array):
         generate = _generate_patches_from_2D
@@ -176,6 +189,24 @@ def _rescale(numpy_array):
     return numpy_array / 10000
 
 
+# The inlines are 16 bit images rescaled by _rescale, int8 storage is scaled so their full range fits
+_STORAGE_SCALES = {
+    "float32": 1.0,
+    "float16": 1.0,
+    "int8": np.iinfo(np.int16).max / 10000 / np.iinfo(np.int8).max,
+}
+
+
+def _to_storage(image_array, storage):
+    if storage == "int8":
+        return np.rint(image_array / _STORAGE_SCALES[storage]).astype(np.int8)
+    return image_array.astype(storage)
+
+
+def _from_storage(image_array, storage):
+    return np.multiply(image_array, np.float32(_STORAGE_SCALES[storage]), dtype=np.float32)
+
+
 class PenobscotInlinePatchDataset(VisionDataset):
     """Dataset that returns patches from Penobscot dataset
 
@@ -194,6 +225,8 @@ class PenobscotInlinePatchDataset(VisionDataset):
         max_inlines=None,
         n_channels=1,
         complete_patches_only=True,
+        storage="float32",
+        pad_value=0,
     ):
         """Initialise Penobscot Dataset
 
@@ -206,7 +239,9 @@ class PenobscotInlinePatchDataset(VisionDataset):
            exclude_files (list[str], optional): list of files to exclude. Defaults to None
            max_inlines (int, optional): maximum number of inlines to load. Defaults to None
            n_channels (int, optional): number of channels that the output should contain. Defaults to 3
-           complete_patches_only (bool, optional): whether to load incomplete patches that are padded to patch_size. Defaults to True
+           complete_patches_only (bool, optional): whether to leave out the incomplete patches at the edges of the inlines, otherwise they are padded to patch_size. Defaults to True
+           storage (str, optional): data type the patches are held in memory as, float32, float16 or int8. Defaults to float32
+           pad_value (float, optional): value the images of incomplete patches are padded with, e.g. mean * max_pixel_value of a Normalize applied to the batches afterwards so that the padding is normalised to 0. Defaults to 0
         """
 
         super(PenobscotInlinePatchDataset, self).__init__(root, transforms=transforms)
@@ -217,6 +252,8 @@ class PenobscotInlinePatchDataset(VisionDataset):
         self._max_inlines = max_inlines
         self._n_channels = n_channels
         self._complete_patches_only = complete_patches_only
+        self._storage = storage
+        self._pad_value = pad_value
         self._patch_size = patch_size
         self._stride = stride
         self._image_array = []
@@ -228,6 +265,7 @@ class PenobscotInlinePatchDataset(VisionDataset):
         msg = "Unknown value '{}' for argument split. " "Valid values are {{{}}}."
         msg = msg.format(split, iterable_to_str(valid_modes))
         verify_str_arg(split, "split", valid_modes, msg)
+        verify_str_arg(storage, "storage", tuple(_STORAGE_SCALES))
 
         if not os.path.exists(self._image_dir):
             raise DataNotSplitException(
@@ -254,7 +292,7 @@ class PenobscotInlinePatchDataset(VisionDataset):
             image_generator, mask_generator, patch_locations = _extract_patches_from(img_array, mask_array)
             self._patch_locations.extend(patch_locations)
 
-            self._image_array.extend(image_generator)
+            self._image_array.extend(_to_storage(image, self._storage) for image in image_generator)
 
             self._mask_array.extend(mask_generator)
 
@@ -300,7 +338,7 @@ class PenobscotInlinePatchDataset(VisionDataset):
             self._patch_locations[index],
         )
 
-        image = self._add_extra_channels(image)
+        image = self._add_extra_channels(_from_storage(image, self._storage))
         if _is_2D(image):
             image = np.expand_dims(image, 0)
 
@@ -310,6 +348,8 @@ class PenobscotInlinePatchDataset(VisionDataset):
             image, target = augmented_dict["image"], augmented_dict["mask"]
             image = _transform_HWC_to_CHW(image)
 
+        # incomplete patches at the edges of the inlines are padded so that every patch of a batch has the same size
+        image, target = _pad_patch(self._patch_size, image, target, value=self._pad_value)
         target = np.expand_dims(target, 0)
 
         return (
@@ -321,7 +361,7 @@ class PenobscotInlinePatchDataset(VisionDataset):
 
     @property
     def statistics(self):
-        flat_image_array = np.concatenate([i.flatten() for i in self._image_array])
+        flat_image_array = np.concatenate([_from_storage(i, self._storage).flatten() for i in self._image_array])
         stats = {stat: statfunc(flat_image_array) for stat, statfunc in _STATS_FUNCS.items()}
         return "Mean: {mean} Std: {std} Max: {max}".format(**stats)
 
@@ -338,6 +378,7 @@ class PenobscotInlinePatchDataset(VisionDataset):
             f"Num classes: {self.n_classes}",
             f"Class proportions: {self.class_proportions}",
             "Complete patches only: {_complete_patches_only}",
+            "Storage: {_storage}",
             f"Dataset statistics: {self.statistics}",
         ]
         return "\n".join(lines).format(**self.__dict__)
@@ -382,6 +423,8 @@ class PenobscotInlinePatchSectionDepthDataset(PenobscotInlinePatchDataset):
         max_inlines=None,
         n_channels=3,
         complete_patches_only=True,
+        storage="float32",
+        pad_value=0,
     ):
         """Initialise Penobscot Dataset
 
@@ -396,8 +439,15 @@ class PenobscotInlinePatchSectionDepthDataset(PenobscotInlinePatchDataset):
            exclude_files (list[str], optional): list of files to exclude. Defaults to None
            max_inlines (int, optional): maximum number of inlines to load. Defaults to None
            n_channels (int, optional): number of channels that the output should contain. Defaults to 3
-           complete_patches_only (bool, optional): whether to load incomplete patches
-                                                   that are padded to patch_size. Defaults to True
+           complete_patches_only (bool, optional): whether to leave out the incomplete patches at
+                                                   the edges of the inlines, otherwise they are
+                                                   padded to patch_size. Defaults to True
+           storage (str, optional): data type the patches are held in memory as, float32, float16
+                                    or int8. Defaults to float32
+           pad_value (float, optional): value the images of incomplete patches are padded with,
+                                        e.g. mean * max_pixel_value of a Normalize applied to the
+                                        batches afterwards so that the padding is normalised to 0.
+                                        Defaults to 0
         """
 
         assert n_channels == 3, (
@@ -414,6 +464,8 @@ class PenobscotInlinePatchSectionDepthDataset(PenobscotInlinePatchDataset):
             max_inlines=max_inlines,
             n_channels=n_channels,
             complete_patches_only=complete_patches_only,
+            storage=storage,
+            pad_value=pad_value,
         )
 
         def _open_image(self, image_path):
@@ -442,6 +494,8 @@ class PenobscotInlinePatchDepthDataset(PenobscotInlinePatchDataset):
         max_inlines=None,
         n_channels=3,
         complete_patches_only=True,
+        storage="float32",
+        pad_value=0,
     ):
         """Initialise Penobscot Dataset
 
@@ -456,8 +510,15 @@ class PenobscotInlinePatchDepthDataset(PenobscotInlinePatchDataset):
            exclude_files (list[str], optional): list of files to exclude. Defaults to None
            max_inlines (int, optional): maximum number of inlines to load. Defaults to None
            n_channels (int, optional): number of channels that the output should contain. Defaults to 3
-           complete_patches_only (bool, optional): whether to load incomplete patches that are
+           complete_patches_only (bool, optional): whether to leave out the incomplete patches at
+                                                   the edges of the inlines, otherwise they are
                                                    padded to patch_size. Defaults to True
+           storage (str, optional): data type the patches are held in memory as, float32, float16
+                                    or int8. Defaults to float32
+           pad_value (float, optional): value the images of incomplete patches are padded with,
+                                        e.g. mean * max_pixel_value of a Normalize applied to the
+                                        batches afterwards so that the padding is normalised to 0.
+                                        Defaults to 0
         """
         assert (
             n_channels == 3
@@ -472,6 +533,8 @@ class PenobscotInlinePatchDepthDataset(PenobscotInlinePatchDataset):
             max_inlines=max_inlines,
             n_channels=n_channels,
             complete_patches_only=complete_patches_only,
+            storage=storage,
+            pad_value=pad_value,
         )
 
     def _open_image(self, image_path):
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from deepseismic_interpretation.dutchf3.utils.batch import (
+    affine_grids,
+    augment_flip,
+    augment_rot_xy,
+    augment_rot_z,
+    augment_stretch,
+    augmentation_matrix,
+    get_grid,
+    interpolation_backend,
+    trilinear_interpolation,
+    trilinear_interpolation_batch,
+    trilinear_interpolation_torch,
+)
+
+_IM_SIZE = [9, 7, 5]
+
+
+def _sequential_grid(im_size, random_flip, random_stretch, random_rot_xy, random_rot_z):
+    # the augmentations in the order get_random_batch used to apply them
+    grid = get_grid(im_size)
+    if random_flip:
+        grid = augment_flip(grid)
+    if random_rot_xy:
+        grid = augment_rot_xy(grid, random_rot_xy)
+    if random_rot_z:
+        grid = augment_rot_z(grid, random_rot_z)
+    if random_stretch:
+        grid = augment_stretch(grid, random_stretch)
+    return grid
+
+
+@pytest.mark.parametrize(
+    "augmentations",
+    [
+        (False, None, None, None),
+        (True, None, None, None),
+        (False, 0.2, None, None),
+        (False, None, 180, None),
+        (False, None, None, 15),
+        (True, 0.2, 180, 15),
+    ],
+)
+@pytest.mark.parametrize("seed", range(5))
+def test_affine_grid_matches_sequential_augmentations(augmentations, seed):
+    np.random.seed(seed)
+    expected = _sequential_grid(_IM_SIZE, *augmentations)
+    expected_next = np.random.random_sample()
+
+    np.random.seed(seed)
+    matrix = augmentation_matrix(*augmentations)
+    grid = affine_grids(_IM_SIZE, matrix[np.newaxis], np.zeros((1, 3)))[0]
+
+    # same random numbers drawn, same coordinates up to the rounding of the combined matrix
+    assert np.random.random_sample() == expected_next
+    assert grid.shape == expected.shape
+    np.testing.assert_allclose(grid, expected, rtol=0, atol=1e-12)
+
+
+def test_affine_grids_offsets_and_cache():
+    matrices = np.stack([np.eye(3), -np.eye(3)])
+    offsets = np.array([[1.0, 2.0, 3.0], [10.0, 20.0, 30.0]])
+    grids = affine_grids(_IM_SIZE, matrices, offsets)
+
+    grid = get_grid(_IM_SIZE)
+    np.testing.assert_array_equal(grids[0], grid + offsets[0][:, np.newaxis])
+    np.testing.assert_array_equal(grids[1], -grid + offsets[1][:, np.newaxis])
+
+    # changing the returned grids leaves the cached grid alone
+    grids += 1
+    np.testing.assert_array_equal(affine_grids(_IM_SIZE, matrices[:1], np.zeros((1, 3)))[0], grid)
+
+
+def test_trilinear_interpolation_batch_matches_trilinear_interpolation():
+    random_state = np.random.RandomState(0)
+    cube = random_state.randn(20, 30, 40).astype(np.float32)
+    # some of the coordinates fall outside of the cube
+    grids = random_state.uniform(-5, 45, size=(3, 3, 500))
+
+    expected = np.stack([trilinear_interpolation(cube, grid) for grid in grids])
+    np.testing.assert_allclose(trilinear_interpolation_batch(cube, grids), expected, rtol=0, atol=1e-5)
+
+
+def test_trilinear_interpolation_torch_matches_numpy():
+    random_state = np.random.RandomState(0)
+    cube = random_state.randn(20, 30, 40).astype(np.float32)
+    grids = random_state.uniform(-5, 45, size=(4, 3, 2000))
+    # the numpy versions extrapolate between -1 and 0 instead of returning 0
+    grids[(grids > -1) & (grids < 0)] -= 1
+
+    expected = trilinear_interpolation_batch(cube, grids)
+    result = trilinear_interpolation_torch(cube, grids)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-4)
+
+
+def test_interpolation_backend():
+    assert interpolation_backend("numpy") is trilinear_interpolation_batch
+    assert interpolation_backend("torch") is trilinear_interpolation_torch
+    with pytest.raises(ValueError):
+        interpolation_backend("scipy")
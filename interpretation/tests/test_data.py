@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from torch.utils import data
+
+from deepseismic_interpretation.dutchf3.data import (
+    _IN_CROSSLINE_DIRECTION,
+    _IN_INLINE_DIRECTION,
+    ClassBalancedSampler,
+    RandomPatchLoader,
+    TrainPatchLoader,
+    TrainPatchLoaderWithDepth,
+    TrainPatchLoaderWithSectionDepth,
+    _class_balanced_weights,
+    _split_sections,
+    class_histograms,
+    load_xline_volume,
+    parse_split_ids,
+    write_split,
+    write_xline_volume,
+)
+
+_PATCH_SIZE = 16
+
+
+def _normalize_and_pad(image, mask, mean=0.1, std=2.0):
+    # Normalize followed by PadIfNeeded(_PATCH_SIZE) with a constant border, as in the training scripts
+    image = (image - mean) / std
+    pad_h, pad_w = max(_PATCH_SIZE - mask.shape[0], 0), max(_PATCH_SIZE - mask.shape[1], 0)
+    padding = ((pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2))
+    image = np.pad(image, padding + ((0, 0),) * (image.ndim - 2), mode="constant", constant_values=0)
+    mask = np.pad(mask, padding, mode="constant", constant_values=255)
+    return {"image": image.astype(np.float32), "mask": mask}
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    random_state = np.random.RandomState(0)
+    os.makedirs(str(tmpdir.join("train")))
+    os.makedirs(str(tmpdir.join("splits")))
+    np.save(str(tmpdir.join("train", "train_seismic.npy")), random_state.randn(6, 30, 40).astype(np.float32))
+    np.save(str(tmpdir.join("train", "train_labels.npy")), random_state.randint(0, 6, (6, 30, 40)).astype(np.uint8))
+    # patches inside the volume as well as patches running off its end along either axis
+    ids = ["i_0_0_0", "i_2_20_30", "i_5_14_0", "x_0_3_10", "x_0_25_33", "x_0_29_39", "i_3_20_30", "x_0_7_38"]
+    write_split(str(tmpdir.join("splits")), "patch_train", ids)
+    return str(tmpdir)
+
+
+@pytest.mark.parametrize("loader", [TrainPatchLoader, TrainPatchLoaderWithDepth, TrainPatchLoaderWithSectionDepth])
+def test_get_batch_matches_getitem(data_dir, loader):
+    dataset = loader(data_dir, split="train", patch_size=_PATCH_SIZE, augmentations=_normalize_and_pad)
+    indices = list(range(len(dataset)))
+
+    images, labels = dataset.get_batch(indices)
+    for index in indices:
+        image, label = dataset[index]
+        np.testing.assert_allclose(images[index].numpy(), image.numpy(), rtol=0, atol=1e-6)
+        np.testing.assert_array_equal(labels[index].numpy(), label.numpy())
+
+
+def test_stale_xline_copies_fall_back_to_the_volume(data_dir):
+    seismic = os.path.join(data_dir, "train", "train_seismic.npy")
+    labels = os.path.join(data_dir, "train", "train_labels.npy")
+    expected = TrainPatchLoader(data_dir, split="train", patch_size=_PATCH_SIZE, augmentations=_normalize_and_pad)
+    expected = [expected[index] for index in range(len(expected))]
+
+    # a copy of a different volume and a copy older than its volume
+    np.save(seismic.replace(".npy", "_xline.npy"), np.zeros((60, 40, 70), dtype=np.float32))
+    write_xline_volume(labels)
+    os.utime(labels.replace(".npy", "_xline.npy"), (0, 0))
+    with pytest.warns(UserWarning):
+        assert load_xline_volume(seismic) is None
+    with pytest.warns(UserWarning):
+        assert load_xline_volume(labels) is None
+
+    with pytest.warns(UserWarning):
+        dataset = TrainPatchLoader(data_dir, split="train", patch_size=_PATCH_SIZE, augmentations=_normalize_and_pad)
+    assert dataset.seismic_xline is None and dataset.labels_xline is None
+    for index, (image, label) in enumerate(expected):
+        np.testing.assert_array_equal(dataset[index][0].numpy(), image.numpy())
+        np.testing.assert_array_equal(dataset[index][1].numpy(), label.numpy())
+
+    write_xline_volume(seismic)
+    assert load_xline_volume(seismic).shape == (30, 6, 40)
+
+
+def _labels_of(labels, patch, patch_size):
+    direction, inline, crossline, depth = patch
+    if direction == _IN_INLINE_DIRECTION:
+        return labels[inline, crossline : crossline + patch_size, depth : depth + patch_size]
+    return labels[inline : inline + patch_size, crossline, depth : depth + patch_size]
+
+
+def test_class_histograms_match_bincount():
+    labels = np.random.RandomState(0).randint(0, 7, (6, 30, 40)).astype(np.uint8)
+    labels[labels == 6] = 255
+    index = parse_split_ids(["i_0_0_0", "i_2_20_30", "i_5_14_0", "x_0_3_10", "x_0_25_33", "x_0_29_39", "x_4_7_38"])
+
+    # patches running off the volume only count the labels inside it, gathered a few patches at a time
+    histograms = class_histograms(labels, index, patch_size=_PATCH_SIZE, chunk_size=3)
+    for patch, histogram in zip(index, histograms):
+        patch_labels = _labels_of(labels, patch, _PATCH_SIZE)
+        np.testing.assert_array_equal(histogram, np.bincount(patch_labels[patch_labels < 6], minlength=6))
+
+    sections = class_histograms(labels, parse_split_ids(["i_3", "x_17"]))
+    np.testing.assert_array_equal(sections[0], np.bincount(labels[3][labels[3] < 6], minlength=6))
+    np.testing.assert_array_equal(sections[1], np.bincount(labels[:, 17][labels[:, 17] < 6], minlength=6))
+
+
+def test_class_balanced_weights():
+    histograms = np.array([[3, 1, 0], [0, 0, 0], [4, 0, 0], [1, 0, 1]])
+    # class frequencies 8/10, 1/10 and 1/10
+    expected = [(3 * 10 / 8 + 10) / 4, 0, 10 / 8, (10 / 8 + 10) / 2]
+    np.testing.assert_allclose(_class_balanced_weights(histograms), expected)
+    np.testing.assert_allclose(_class_balanced_weights(histograms, np.array([0.5, 0.5, 0])), [2, 0, 2, 1])
+
+
+def test_class_balanced_sampler_draws_from_one_direction():
+    histograms = np.random.RandomState(0).randint(1, 100, (20, 6))
+    directions = np.array([_IN_INLINE_DIRECTION] * 8 + [_IN_CROSSLINE_DIRECTION] * 12)
+    sampler = ClassBalancedSampler(histograms, num_samples=50, directions=directions)
+    assert len(sampler) == 50
+
+    torch.manual_seed(0)
+    drawn_directions = set()
+    for _ in range(20):
+        samples = list(sampler)
+        assert len(samples) == 50 and len(set(directions[samples])) == 1
+        drawn_directions.update(directions[samples])
+    assert drawn_directions == {_IN_INLINE_DIRECTION, _IN_CROSSLINE_DIRECTION}
+
+    with pytest.raises(ValueError):
+        ClassBalancedSampler(None)
+
+
+class _WorkerInfo(object):
+    def __init__(self, id, num_workers):
+        self.id = id
+        self.num_workers = num_workers
+
+
+@pytest.mark.parametrize("class_balanced", [False, True])
+def test_random_patch_loader(data_dir, monkeypatch, class_balanced):
+    patch_loader = TrainPatchLoader(data_dir, split=None, patch_size=_PATCH_SIZE)
+    patches = []
+    get_patches = patch_loader.get_patches
+
+    def _get_patches(batch):
+        patches.append(np.array(batch))
+        return get_patches(batch)
+
+    patch_loader.get_patches = _get_patches
+    dataset = RandomPatchLoader(patch_loader, 4, per_val=0.5, num_batches=7, class_balanced=class_balanced)
+    assert len(dataset) == 7
+
+    # the batches of an epoch are shared out between the workers
+    n_batches = []
+    for worker_id in range(3):
+        monkeypatch.setattr(data, "get_worker_info", lambda: _WorkerInfo(worker_id, 3))
+        batches = list(dataset)
+        assert all(images.shape == (4, 1, _PATCH_SIZE, _PATCH_SIZE) for images, _ in batches)
+        n_batches.append(len(batches))
+    assert n_batches == [3, 2, 2]
+
+    # only the sections of the split, with the patches inside the volume
+    patches = np.concatenate(patches)
+    inline, crossline = patches[:, 0] == _IN_INLINE_DIRECTION, patches[:, 0] == _IN_CROSSLINE_DIRECTION
+    assert inline.any() and crossline.any()
+    assert np.isin(patches[inline, 1], _split_sections(6, "train", per_val=0.5)).all()
+    assert np.isin(patches[crossline, 2], _split_sections(30, "train", per_val=0.5)).all()
+    assert (patches[inline, 2] <= 30 - _PATCH_SIZE).all() and (patches[:, 3] <= 40 - _PATCH_SIZE).all()
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from deepseismic_interpretation.dutchf3.data import SectionPredictions, parse_split_ids
+
+_SHAPE = (4, 5, 6)
+
+
+def test_section_predictions_write_and_resume(tmpdir):
+    sections = parse_split_ids(["i_1", "x_3"])
+    predictions = SectionPredictions(str(tmpdir), "test1", _SHAPE)
+    assert not predictions.done(sections[0]) and not predictions.done(sections[1])
+
+    # depth x width labels, as the sections are scored
+    inline = np.random.RandomState(0).randint(0, 6, (_SHAPE[2], _SHAPE[1]))
+    predictions.write(sections[0], inline)
+    np.testing.assert_array_equal(predictions.read(sections[0]), inline)
+    assert predictions.progress() == {"inline": (1, 4), "crossline": (0, 5)}
+
+    # opening the files again picks up the sections written
+    resumed = SectionPredictions(str(tmpdir), "test1", _SHAPE)
+    assert resumed.done(sections[0]) and not resumed.done(sections[1])
+    crossline = np.random.RandomState(1).randint(0, 6, (_SHAPE[2], _SHAPE[0]))
+    resumed.write(sections[1], crossline)
+
+    volume = np.load(str(tmpdir.join("test1_inline.npy")))
+    assert volume.dtype == np.uint8
+    np.testing.assert_array_equal(volume[1], inline.T)
+    np.testing.assert_array_equal(np.load(str(tmpdir.join("test1_crossline.npy")))[:, 3], crossline.T)
+
+
+def test_section_predictions_of_another_volume(tmpdir):
+    SectionPredictions(str(tmpdir), "test1", _SHAPE)
+    with pytest.raises(ValueError):
+        SectionPredictions(str(tmpdir), "test1", (4, 5, 7))
+
+
+def test_section_predictions_of_another_run(tmpdir):
+    section = parse_split_ids(["i_2"])[0]
+    predictions = SectionPredictions(str(tmpdir), "test1", _SHAPE, provenance="checkpoint a")
+    predictions.write(section, np.ones((_SHAPE[2], _SHAPE[1])))
+    assert SectionPredictions(str(tmpdir), "test1", _SHAPE, provenance="checkpoint a").done(section)
+
+    # labels predicted from another checkpoint, config or seismic, or of unknown provenance, aren't resumed
+    with pytest.raises(ValueError):
+        SectionPredictions(str(tmpdir), "test1", _SHAPE, provenance="checkpoint b")
+    SectionPredictions(str(tmpdir), "test2", _SHAPE)
+    with pytest.raises(ValueError):
+        SectionPredictions(str(tmpdir), "test2", _SHAPE, provenance="checkpoint a")
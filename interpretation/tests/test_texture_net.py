@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import torch
+
+from deepseismic_interpretation.models.texture_net import TextureNet
+
+_WINDOW = 65
+
+
+def _texture_net():
+    torch.manual_seed(0)
+    network = TextureNet(n_classes=3)
+    # batch norm statistics away from the identity, as after training
+    for module in network.modules():
+        if isinstance(module, torch.nn.BatchNorm3d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.2, 0.2)
+    return network.eval()
+
+
+def _voxel_scores(network, data, centre):
+    # the network run on the mini-cube around a single voxel
+    w = _WINDOW // 2
+    mini_cube = data[tuple(slice(c - w, c + w + 1) for c in centre)]
+    with torch.no_grad():
+        output = network(torch.from_numpy(np.ascontiguousarray(mini_cube))[None, None])
+    return output[0, :, 0, 0, 0].numpy()
+
+
+@pytest.mark.parametrize("axis", [0, 1, 2])
+def test_dense_scores_match_voxel_by_voxel_scores(axis):
+    network = _texture_net()
+    data = np.random.RandomState(0).randn(68, 69, 70).astype(np.float32)
+    index = 33
+
+    # tiles smaller than the slice to go through the tiling as well
+    scores = network.dense_scores(data, axis=axis, index=index, tile_size=3)
+    assert scores.shape == (3,) + tuple(1 if a == axis else n for a, n in enumerate(data.shape))
+
+    w = _WINDOW // 2
+    for centre in np.ndindex(*scores.shape[1:]):
+        voxel = list(centre)
+        voxel[axis] = index
+        if all(w <= v < n - w for v, n in zip(voxel, data.shape)):
+            np.testing.assert_allclose(scores[(slice(None),) + centre], _voxel_scores(network, data, voxel), atol=1e-6)
+        else:
+            assert not scores[(slice(None),) + centre].any()
+
+
+def test_dense_scores_of_a_cube_stack_the_slices():
+    network = _texture_net()
+    data = np.random.RandomState(1).randn(66, 66, 67).astype(np.float32)
+
+    scores = network.dense_scores(data, tile_size=2)
+    slices = [network.dense_scores(data, index=index, tile_size=2) for index in range(data.shape[0])]
+    np.testing.assert_array_equal(scores, np.concatenate(slices, axis=1))
+
+
+def test_dense_scores_unsupported_window():
+    with pytest.raises(ValueError):
+        _texture_net().dense_scores(np.zeros((200, 200, 200), dtype=np.float32), window=129)
@@ -13,6 +13,12 @@ from os import path
 
 import fire
 import numpy as np
+from deepseismic_interpretation.dutchf3.data import (
+    storage_path,
+    write_reduced_precision_volume,
+    write_split,
+    write_xline_volume,
+)
 from sklearn.model_selection import train_test_split
 
 
@@ -24,16 +30,11 @@ def _get_labels_path(data_dir):
     return path.join(data_dir, "train", "train_labels.npy")
 
 
-def _write_split_files(splits_path, train_list, test_list, loader_type):
-    file_object = open(path.join(splits_path, loader_type + "_train_val.txt"), "w")
-    file_object.write("\n".join(train_list + test_list))
-    file_object.close()
-    file_object = open(path.join(splits_path, loader_type + "_train.txt"), "w")
-    file_object.write("\n".join(train_list))
-    file_object.close()
-    file_object = open(path.join(splits_path, loader_type + "_val.txt"), "w")
-    file_object.write("\n".join(test_list))
-    file_object.close()
+def _write_split_files(splits_path, train_list, test_list, loader_type, labels=None, patch_size=None):
+    # with labels the class histograms for ClassBalancedSampler are written as well
+    write_split(splits_path, loader_type + "_train_val", train_list + test_list, labels=labels, patch_size=patch_size)
+    write_split(splits_path, loader_type + "_train", train_list, labels=labels, patch_size=patch_size)
+    write_split(splits_path, loader_type + "_val", test_list, labels=labels, patch_size=patch_size)
 
 
 def _get_aline_range(aline, per_val):
@@ -83,7 +84,7 @@ def split_section_train_val(data_dir, per_val=0.2, log_config=None):
 
     # write to files to disk
     splits_path = _get_splits_path(data_dir)
-    _write_split_files(splits_path, train_list, test_list, "section")
+    _write_split_files(splits_path, train_list, test_list, "section", labels=labels)
 
 
 def split_patch_train_val(data_dir, stride, patch, per_val=0.2, log_config=None):
@@ -161,7 +162,7 @@ def split_patch_train_val(data_dir, stride, patch, per_val=0.2, log_config=None)
     # write to files to disk:
     # NOTE: This isn't quite right we should calculate the patches again for the whole volume
     splits_path = _get_splits_path(data_dir)
-    _write_split_files(splits_path, train_list, test_list, "patch")
+    _write_split_files(splits_path, train_list, test_list, "patch", labels=labels, patch_size=patch)
 
 
 _LOADER_TYPES = {"section": split_section_train_val, "patch": split_patch_train_val}
@@ -260,6 +261,67 @@ def split_alaudah_et_al_19(data_dir, stride, fraction_validation=0.2, loader_typ
     _write_split_files(splits_path, train_list, test_list, loader_type)
 
 
+def _volume_paths(data_dir, kinds=("seismic", "labels")):
+    volumes = [path.join(data_dir, "train", "train_" + kind + ".npy") for kind in kinds]
+    volumes += [
+        path.join(data_dir, "test_once", split + "_" + kind + ".npy") for split in ("test1", "test2") for kind in kinds
+    ]
+    return volumes
+
+
+def write_crossline_major(data_dir, storage="float32", log_config=None):
+    """Write crossline-major copies of the Netherlands F3 volumes next to the originals.
+
+    The loaders read crossline sections and patches from these copies when they exist, which turns
+    the strided crossline reads into sequential ones at the cost of twice the disk space.
+
+    Args:
+        data_dir (str): data directory path
+        storage (str, optional): storage of the seismic volumes to copy, float32, float16 or int8.
+            The reduced precision volumes have to be written first. Defaults to float32.
+        log_config (str, optional): path to log config. Defaults to None.
+    """
+
+    if log_config is not None:
+        logging.config.fileConfig(log_config)
+
+    logger = logging.getLogger(__name__)
+
+    volumes = [storage_path(volume, storage) for volume in _volume_paths(data_dir, kinds=("seismic",))]
+    volumes += _volume_paths(data_dir, kinds=("labels",))
+    for volume in volumes:
+        if not path.exists(volume):
+            logger.warning(f"{volume} not found, skipping")
+            continue
+        logger.info(f"Writing crossline-major copy of {volume}")
+        logger.info(f"Written {write_xline_volume(volume)}")
+
+
+def write_reduced_precision(data_dir, storage="int8", log_config=None):
+    """Write float16 or int8 copies of the Netherlands F3 seismic volumes next to the originals.
+
+    Select them in the experiments with DATASET.STORAGE. int8 volumes are scaled by the largest
+    absolute amplitude of each volume.
+
+    Args:
+        data_dir (str): data directory path
+        storage (str, optional): float16 or int8. Defaults to int8.
+        log_config (str, optional): path to log config. Defaults to None.
+    """
+
+    if log_config is not None:
+        logging.config.fileConfig(log_config)
+
+    logger = logging.getLogger(__name__)
+
+    for volume in _volume_paths(data_dir, kinds=("seismic",)):
+        if not path.exists(volume):
+            logger.warning(f"{volume} not found, skipping")
+            continue
+        logger.info(f"Writing {storage} copy of {volume}")
+        logger.info(f"Written {write_reduced_precision_volume(volume, storage)}")
+
+
 # TODO: Try https://github.com/Chilipp/docrep for doscstring reuse
 class SplitTrainValCLI(object):
     def section(self, data_dir, per_val=0.2, log_config="logging.conf"):
@@ -292,8 +354,17 @@ if __name__ == "__main__":
     python prepare_data.py split_train_val section --data-dir=/mnt/dutch
     or
     python prepare_data.py split_train_val patch --data-dir=/mnt/dutch --stride=50 --patch=100
+    or
+    python prepare_data.py crossline_major --data-dir=/mnt/dutch
+    or
+    python prepare_data.py reduced_precision --data-dir=/mnt/dutch --storage=int8
 
     """
     fire.Fire(
-        {"split_train_val": SplitTrainValCLI, "split_alaudah_et_al_19": split_alaudah_et_al_19,}
+        {
+            "split_train_val": SplitTrainValCLI,
+            "split_alaudah_et_al_19": split_alaudah_et_al_19,
+            "crossline_major": write_crossline_major,
+            "reduced_precision": write_reduced_precision,
+        }
     )